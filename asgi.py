@@ -0,0 +1,306 @@
+"""
+ASGI entry point for the async serving mode.
+
+POST /api/chat is served natively on the event loop using the async Gemini
+streaming API, so an in-flight stream costs a coroutine instead of a worker
+thread. Every other route is the unchanged Flask app from backend.py, run in a
+small thread pool. Persistence goes through backend's write-behind queue after
+the response has been sent.
+
+Run with: uvicorn asgi:app --port 5000
+or:       SERVER_MODE=async gunicorn -c gunicorn.conf.py
+"""
+import os
+import json
+import time
+import asyncio
+from urllib.parse import parse_qsl
+from a2wsgi import WSGIMiddleware
+
+# The event loop holds far more streams than a threaded worker, so the per-process
+# stream cap defaults higher here; it must be set before backend reads it
+os.environ.setdefault("ADMISSION_MAX_ACTIVE", "256")
+
+import backend
+
+# Threads used for the regular (synchronous) Flask routes
+WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 8))
+
+flask_app = WSGIMiddleware(backend.app, workers=WSGI_THREADS)
+
+# --- HELPER: Raw ASGI responses ---
+def cors_headers(scope):
+    """Mirrors Flask-CORS for the natively served route."""
+    origin = None
+    for name, value in scope.get("headers", []):
+        if name == b"origin":
+            origin = value.decode("latin-1")
+    if origin in backend.CORS_ORIGINS:
+        return [(b"access-control-allow-origin", origin.encode("latin-1")),
+                (b"access-control-expose-headers", ", ".join(backend.CORS_EXPOSE_HEADERS).encode("ascii")),
+                (b"vary", b"Origin")]
+    return []
+
+async def send_json(scope, send, status, payload, headers=None):
+    body = json.dumps(payload).encode("utf-8")
+    extra = [(name.lower().encode("ascii"), value.encode("ascii")) for name, value in (headers or {}).items()]
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("ascii"))] + extra + cors_headers(scope)
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def send_sse(scope, send, stream, after=0, extra_headers=()):
+    """Async twin of backend.sse_events(): replays from seq `after`, then follows the stream."""
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream"),
+                    (b"x-stream-id", stream.id.encode("ascii"))]
+                   + [(name.lower().encode("ascii"), value.encode("ascii")) for name, value in backend.SSE_HEADERS.items()]
+                   + list(extra_headers) + cors_headers(scope)
+    })
+    while True:
+        events, finished, missed = stream.read(after)
+        if missed:
+            await send({"type": "http.response.body", "body": backend.stream_gone_event(stream).encode("utf-8"), "more_body": True})
+            break
+        for after, text in events:
+            await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+        if finished:
+            break
+        if not await stream.wait_async(after, backend.SSE_HEARTBEAT_SECONDS):
+            heartbeat = backend.format_sse('heartbeat', {"streamId": stream.id})
+            await send({"type": "http.response.body", "body": heartbeat.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+# --- HELPER: Event-stream generations ---
+# Generations run as tasks apart from the response so a dropped client can resume them
+background_tasks = set()
+
+async def produce_chat_stream(stream, ticket, history, prompt, user_data, session_id, user_msg, usage, cache_key=None,
+                              history_version=None):
+    """Async twin of backend.produce_chat_stream()."""
+    parts = []
+    stream_metrics = backend.StreamMetrics('async')
+    try:
+        async for text in backend.gemini.astream(history, prompt):
+            stream_metrics.chunk(text)
+            parts.append(text)
+            stream.publish('delta', {"text": text})
+        response_text = "".join(parts)
+        backend.log_chat_usage(session_id, usage, stream_metrics.ttfb, stream_metrics.finish(), response_text)
+        if cache_key:
+            backend.response_cache.put(cache_key, response_text)
+        saved = bool(session_id and backend.db) and await asyncio.to_thread(
+            backend.enqueue_chat_turn, user_data, session_id, user_msg, response_text)
+        stream.publish('done', backend.done_event(response_text, history_version if saved else None), final=True)
+    except Exception as e:
+        stream_metrics.error(e)
+        print(f"Gemini API Error: {type(e).__name__}: {str(e)}")
+        stream.publish('error', {"error": "Upstream Error", "message": backend.CHAT_ERROR_TEXT}, final=True)
+    finally:
+        ticket.release()
+
+# --- ROUTES ---
+async def resume_chat(scope, receive, send):
+    """Async twin of backend.resume_chat()."""
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+    user_data = await asyncio.to_thread(backend.verify_token, headers.get("authorization"))
+    if not user_data:
+        await send_json(scope, send, 401, {"error": "Unauthorized"})
+        return
+
+    stream_id = scope["path"].rsplit("/", 1)[-1]
+    query = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    stream, after, error = backend.resume_chat_stream(user_data, headers.get("last-event-id") or query.get("lastEventId"), stream_id)
+    if error:
+        await send_json(scope, send, *error)
+        return
+    await send_sse(scope, send, stream, after)
+
+async def chat(scope, receive, send):
+    """Async twin of backend.chat(): same request body, same text/plain or event stream."""
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+
+    # 1. Verify User (a cache miss may fetch Google's public keys, so keep it off the loop)
+    user_data = await asyncio.to_thread(backend.verify_token, headers.get("authorization"))
+    if not user_data:
+        await send_json(scope, send, 401, {
+            "error": "Unauthorized",
+            "message": "Invalid or missing authentication token. Please sign in again."
+        })
+        return
+
+    try:
+        data = json.loads(await read_body(receive) or b"{}")
+    except ValueError:
+        await send_json(scope, send, 400, {"error": "Bad Request", "message": "Invalid JSON body"})
+        return
+
+    sse = backend.wants_sse({"Accept": headers.get("accept")}, data)
+    # Reconnect after a dropped event stream: replay the buffered answer, no new generation
+    if sse and headers.get("last-event-id"):
+        stream, after, error = backend.resume_chat_stream(user_data, headers.get("last-event-id"))
+        if error:
+            await send_json(scope, send, *error)
+            return
+        await send_sse(scope, send, stream, after)
+        return
+
+    user_msg = data.get('message')
+    session_id = data.get('sessionId')
+    if not user_msg:
+        await send_json(scope, send, 400, {
+            "error": "Bad Request",
+            "message": "Message cannot be empty"
+        })
+        return
+
+    # 2. Construct Prompt with Context
+    # Without a 'history' list the server rebuilds it from the stored session
+    chat_history, history_version, error = await asyncio.to_thread(backend.resolve_chat_history, user_data, data)
+    if error:
+        await send_json(scope, send, error[0], error[1])
+        return
+    try:
+        # Attachments may be sent as content hashes; large ones are cut to relevant excerpts
+        context_str, context_hashes = await asyncio.to_thread(backend.build_context_str, user_data, data, user_msg)
+    except (backend.UnknownContextError, backend.InvalidContextError) as e:
+        await send_json(scope, send, *backend.context_error(e))
+        return
+    prompt_with_ctx = user_msg + context_str
+
+    # First message of a new session: start its title alongside the answer
+    if session_id and not chat_history:
+        backend.title_generator.submit(user_msg)
+
+    # Keep long conversations within the history token budget (may read the stored summary)
+    chat_history, usage = await asyncio.to_thread(backend.history_compactor.compact, user_data, session_id, chat_history)
+    usage['promptTokens'] = backend.estimate_tokens(prompt_with_ctx)
+
+    # 3. Stream Response
+    response_headers = []
+    # Lets clients send {"hash": ...} for the same attachment next time
+    for field, content_hash in context_hashes.items():
+        response_headers.append((backend.CONTEXT_HASH_HEADERS[field].lower().encode("ascii"), content_hash.encode("ascii")))
+
+    # Standalone questions may already have a cached answer; replay it without calling Gemini
+    cache_key, cached_text = backend.response_cache.lookup(chat_history, user_msg, context_str, data)
+    if cached_text is not None:
+        # No stream slot is needed, but a replay still costs the user a rate-limit token
+        try:
+            await asyncio.to_thread(backend.admission.check_rate, user_data)
+        except backend.AdmissionRejected as e:
+            await send_json(scope, send, *backend.admission_error(e))
+            return
+        saved = bool(session_id and backend.db) and await asyncio.to_thread(
+            backend.enqueue_chat_turn, user_data, session_id, user_msg, cached_text)
+        if sse:
+            stream = backend.chat_streams.create(user_data)
+            backend.publish_cached_answer(stream, cached_text, history_version if saved else None)
+            await send_sse(scope, send, stream, extra_headers=response_headers)
+            return
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8")] + response_headers + cors_headers(scope)})
+        for piece in backend.replay_chunks(cached_text):
+            await send({"type": "http.response.body", "body": piece.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    # Fail fast while Gemini's circuit breakers are open
+    if not backend.gemini.available():
+        await send_json(scope, send, *backend.upstream_unavailable_error(backend.UpstreamUnavailable(backend.gemini.retry_after())))
+        return
+
+    # Per-user stream cap and rate limits, then a bounded wait for a stream slot (awaited on the loop)
+    try:
+        ticket = await backend.admission.admit_async(user_data)
+    except backend.AdmissionRejected as e:
+        await send_json(scope, send, *backend.admission_error(e))
+        return
+
+    if sse:
+        stream = backend.chat_streams.create(user_data)
+        task = asyncio.create_task(produce_chat_stream(stream, ticket, chat_history, prompt_with_ctx, user_data, session_id, user_msg,
+                                                       usage, cache_key, history_version))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        await send_sse(scope, send, stream, extra_headers=response_headers)
+        return
+
+    try:
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8")] + response_headers + cors_headers(scope)})
+
+        parts = []
+        succeeded = False
+        stream_metrics = backend.StreamMetrics('async')
+        try:
+            async for text in backend.gemini.astream(chat_history, prompt_with_ctx):
+                stream_metrics.chunk(text)
+                await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+                parts.append(text)
+            succeeded = True
+            backend.log_chat_usage(session_id, usage, stream_metrics.ttfb, stream_metrics.finish(), "".join(parts))
+            if cache_key:
+                backend.response_cache.put(cache_key, "".join(parts))
+        except Exception as e:
+            stream_metrics.error(e)
+            print(f"Gemini API Error: {type(e).__name__}: {str(e)}")
+            await send({"type": "http.response.body", "body": backend.CHAT_ERROR_TEXT.encode("utf-8"), "more_body": True})
+
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        ticket.release()
+
+    # 4. Save Interaction to Firestore once the client has its answer
+    # (normally just a queue append; a full queue falls back to an inline write)
+    if succeeded and session_id and backend.db:
+        await asyncio.to_thread(backend.enqueue_chat_turn, user_data, session_id, user_msg, "".join(parts))
+
+async def timed_route(handler, route, scope, receive, send):
+    """
+    Records ada_http_request_duration_seconds for a natively served route, like Flask's after_request.
+    `route` is the Flask rule (e.g. '/api/chat/streams/<stream_id>'), so stream IDs don't become labels.
+    """
+    started = time.perf_counter()
+
+    async def send_wrapper(message):
+        if message["type"] == "http.response.start":
+            backend.HTTP_LATENCY.labels(route=route, method=scope["method"],
+                                        status=message["status"]).observe(time.perf_counter() - started)
+        await send(message)
+
+    await handler(scope, receive, send_wrapper)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Flush pending chat writes before the worker exits
+            await asyncio.to_thread(backend.chat_write_queue.stop)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/api/chat" and scope["method"] == "POST":
+        await timed_route(chat, '/api/chat', scope, receive, send)
+    elif scope["type"] == "http" and scope["path"].startswith("/api/chat/streams/") and scope["method"] == "GET":
+        await timed_route(resume_chat, '/api/chat/streams/<stream_id>', scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -1,131 +1,3780 @@
 import os
+import sys
 import json
+import time
+import re
+import math
+import base64
+import copy
+import hashlib
 import datetime
-from flask import Flask, request, jsonify, Response, stream_with_context
+import atexit
+import zipfile
+import zlib
+import sqlite3
+import threading
+import queue
+import uuid
+import asyncio
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import importlib
+from concurrent.futures import Future, ThreadPoolExecutor
+try:
+    import fcntl  # POSIX only; the temp-user sweeper's cross-worker lock
+except ImportError:
+    fcntl = None
+try:
+    import brotli  # optional; without it responses are only gzip-compressed
+except ImportError:
+    brotli = None
+IMPORT_STARTED = time.perf_counter()  # see Lazy Clients / startup_report()
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
-import google.generativeai as genai
-import firebase_admin
-from firebase_admin import credentials, auth, firestore
+from prometheus_client import (REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+# google.generativeai, firebase_admin and google.cloud.firestore are imported on first use (see Lazy Clients)
 
 # --- INIT APP & CONFIG ---
 app = Flask(__name__)
 # Allow CORS for your domain and localhost for testing
-CORS(app, resources={r"/api/*": {"origins": [
+CORS_ORIGINS = [
     "https://ada.amit.is-a.dev", 
     "https://amit.is-a.dev", 
     "http://127.0.0.1:5500", 
     "http://localhost:5000",
     "http://localhost:5500"
-]}})
+]
+CORS_EXPOSE_HEADERS = ["X-Code-Context-Hash", "X-File-Context-Hash", "X-Stream-Id", "ETag"]
+CORS(app, resources={r"/api/*": {"origins": CORS_ORIGINS, "expose_headers": CORS_EXPOSE_HEADERS}})
+
+# --- HELPER: Lazy Clients ---
+# Importing the Google SDKs and building the Firebase/Firestore/Gemini clients takes
+# seconds, so none of it happens at import: each client is built on first use, and
+# / and /health never touch them. Under gunicorn, post_worker_init warms them in the
+# background (WARM_START) so the first real request usually finds them ready.
+STARTUP_TIMINGS = OrderedDict()  # step -> milliseconds, reported by startup_report()
+
+def record_startup(step, started):
+    STARTUP_TIMINGS[step] = round((time.perf_counter() - started) * 1000, 1)
+
+record_startup('import flask, flask_cors, prometheus_client', IMPORT_STARTED)
+
+class Lazy:
+    """
+    Thread-safe stand-in for a module or client that is built once, on first use.
+    Attribute access and truthiness are forwarded, so `if not db:` and
+    `db.collection(...)` work unchanged.
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self.ready = False
+
+    def get(self):
+        if not self.ready:
+            with self._lock:
+                if not self.ready:
+                    started = time.perf_counter()
+                    self._value = self._factory()
+                    record_startup(self.name, started)
+                    self.ready = True
+        return self._value
+
+    def __getattr__(self, attr):
+        # Only reached for names not set in __init__ (or patched onto the proxy)
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+    def __bool__(self):
+        return self.get() is not None
+
+    def __repr__(self):
+        return f"<Lazy {self.name}: {'ready' if self.ready else 'not built'}>"
 
 # 1. Firebase Admin Init (Server-Side Security)
 # Ensure you have your service account json or environment variables set up in Render
-try:
-    if not firebase_admin._apps:
-        # Check for FIREBASE_CREDENTIALS environment variable (JSON string)
-        firebase_creds_json = os.environ.get("FIREBASE_CREDENTIALS")
-        
-        if firebase_creds_json:
-            # Parse JSON string from environment variable
-            cred_dict = json.loads(firebase_creds_json)
-            cred = credentials.Certificate(cred_dict)
-            print("Using Firebase credentials from FIREBASE_CREDENTIALS environment variable")
-        elif os.path.exists("firebase-adminsdk.json"):
-            cred = credentials.Certificate("firebase-adminsdk.json")
-            print("Using Firebase credentials from firebase-adminsdk.json file")
+def init_firebase_app():
+    """Initializes the Firebase Admin SDK once; None if it could not be initialized."""
+    import firebase_admin
+    from firebase_admin import credentials
+    try:
+        if not firebase_admin._apps:
+            # Check for FIREBASE_CREDENTIALS environment variable (JSON string)
+            firebase_creds_json = os.environ.get("FIREBASE_CREDENTIALS")
+            
+            if firebase_creds_json:
+                # Parse JSON string from environment variable
+                cred_dict = json.loads(firebase_creds_json)
+                cred = credentials.Certificate(cred_dict)
+                print("Using Firebase credentials from FIREBASE_CREDENTIALS environment variable")
+            elif os.path.exists("firebase-adminsdk.json"):
+                cred = credentials.Certificate("firebase-adminsdk.json")
+                print("Using Firebase credentials from firebase-adminsdk.json file")
+            else:
+                # Try application default credentials
+                cred = credentials.ApplicationDefault()
+                print("Using Firebase Application Default Credentials")
+            
+            firebase_admin.initialize_app(cred)
+            print("Firebase Admin SDK initialized successfully")
+        return firebase_admin.get_app()
+    except Exception as e:
+        print(f"Firebase initialization error: {type(e).__name__}: {e}")
+        print("API will run but Firestore features will not work")
+        return None
+
+def init_firestore():
+    """The Firestore client, or None when Firebase is unavailable."""
+    if not firebase_app:
+        return None
+    try:
+        from firebase_admin import firestore as firestore_module
+        client = firestore_module.client()
+        print("Firestore client initialized successfully")
+        return client
+    except Exception as e:
+        print(f"Firestore initialization error: {type(e).__name__}: {e}")
+        print("API will run but Firestore features will not work")
+        return None
+
+def load_auth():
+    """firebase_admin.auth, with the default app initialized for verify_id_token."""
+    firebase_app.get()
+    return importlib.import_module('firebase_admin.auth')
+
+firebase_app = Lazy('firebase app', init_firebase_app)
+db = Lazy('firestore client', init_firestore)
+auth = Lazy('import firebase_admin.auth', load_auth)
+firestore = Lazy('import firebase_admin.firestore', lambda: importlib.import_module('firebase_admin.firestore'))
+api_exceptions = Lazy('import google.api_core.exceptions', lambda: importlib.import_module('google.api_core.exceptions'))
+
+# 2. Gemini Init
+GENAI_API_KEY = os.environ.get("GEMINI_API_KEY")
+if not GENAI_API_KEY:
+    print("CRITICAL: GEMINI_API_KEY not found in env variables.")
+
+def load_genai():
+    """Imports google.generativeai and configures the API key."""
+    module = importlib.import_module('google.generativeai')
+    if GENAI_API_KEY:
+        module.configure(api_key=GENAI_API_KEY)
+    return module
+
+genai = Lazy('import google.generativeai', load_genai)
+
+# Generation Config
+generation_config = {
+    "temperature": 0.2, # Low temp for precise coding
+    "top_p": 0.95,
+    "top_k": 64,
+    "max_output_tokens": 8192,
+    "response_mime_type": "text/plain",
+}
+
+# System Instruction - THE STRICT CODING GATEKEEPER
+SYSTEM_PROMPT = """
+
+"""
+
+GEMINI_MODEL_NAME = "models/gemini-3.1-flash-lite-preview"
+
+model = Lazy('gemini model', lambda: genai.GenerativeModel(
+    model_name=GEMINI_MODEL_NAME,
+    generation_config=generation_config,
+    system_instruction=SYSTEM_PROMPT,
+))
+
+# Plain model (no system prompt / config) used for chat titles
+title_model = Lazy('gemini title model', lambda: genai.GenerativeModel(GEMINI_MODEL_NAME))
+
+# Optional second model used for hedged and fallback requests (see Gemini Resilience)
+GEMINI_FALLBACK_MODEL_NAME = os.environ.get("GEMINI_FALLBACK_MODEL")
+fallback_model = Lazy('gemini fallback model', lambda: genai.GenerativeModel(
+    model_name=GEMINI_FALLBACK_MODEL_NAME,
+    generation_config=generation_config,
+    system_instruction=SYSTEM_PROMPT,
+)) if GEMINI_FALLBACK_MODEL_NAME else None
+fallback_title_model = Lazy('gemini fallback title model', lambda: genai.GenerativeModel(GEMINI_FALLBACK_MODEL_NAME)) if GEMINI_FALLBACK_MODEL_NAME else None
+
+def warm_up(background=True):
+    """Builds every lazy client ahead of the first request (gunicorn post_worker_init)."""
+    def run():
+        for resource in (db, auth, firestore, api_exceptions, model, title_model, fallback_model, fallback_title_model):
+            # Skips clients that are disabled or were swapped out (benchmarks/fakes.py)
+            if isinstance(resource, Lazy):
+                try:
+                    resource.get()
+                except Exception as e:
+                    print(f"Warm-up of {resource.name} failed: {type(e).__name__}: {e}")
+        print("Startup timings (ms): " + ", ".join(f"{step}={ms}" for step, ms in STARTUP_TIMINGS.items()))
+    
+    if background:
+        threading.Thread(target=run, daemon=True, name="warm-up").start()
+    else:
+        run()
+
+def startup_report():
+    """Import and init costs so far, without building anything that is still pending."""
+    return {
+        "pid": os.getpid(),
+        "timingsMs": dict(STARTUP_TIMINGS),
+        "ready": {resource.name: resource.ready
+                  for resource in (firebase_app, db, genai, model, title_model, fallback_model, fallback_title_model)
+                  if isinstance(resource, Lazy)}
+    }
+
+# --- HELPER: Metrics ---
+# Prometheus metrics, served on /metrics. Under gunicorn, gunicorn.conf.py sets
+# PROMETHEUS_MULTIPROC_DIR so samples from every worker are aggregated.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # optional bearer token protecting /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HTTP_LATENCY = Histogram('ada_http_request_duration_seconds', 'Time to produce the response (streamed bodies excluded)',
+                         ['route', 'method', 'status'], buckets=LATENCY_BUCKETS)
+TOKEN_VERIFY_LATENCY = Histogram('ada_token_verify_duration_seconds', 'verify_token latency by outcome',
+                                 ['result'], buckets=LATENCY_BUCKETS)
+FIRESTORE_LATENCY = Histogram('ada_firestore_duration_seconds', 'Firestore call latency by operation',
+                              ['op'], buckets=LATENCY_BUCKETS)
+GEMINI_TTFB = Histogram('ada_gemini_ttfb_seconds', 'Time from send_message to the first streamed chunk',
+                        ['mode'], buckets=LATENCY_BUCKETS)
+GEMINI_STREAM_DURATION = Histogram('ada_gemini_stream_duration_seconds', 'Full Gemini stream duration',
+                                   ['mode'], buckets=LATENCY_BUCKETS)
+GEMINI_STREAM_CHUNKS = Histogram('ada_gemini_stream_chunks', 'Chunks per streamed response',
+                                 buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+GEMINI_STREAM_BYTES = Histogram('ada_gemini_stream_bytes', 'Bytes per streamed response',
+                                buckets=(256, 1024, 4096, 16384, 65536, 262144))
+TITLE_LATENCY = Histogram('ada_title_generation_duration_seconds', 'Chat title generation latency',
+                          buckets=LATENCY_BUCKETS)
+CHAT_HISTORY_TOKENS = Histogram('ada_chat_history_tokens', 'Estimated history tokens before/after compaction',
+                                ['stage'], buckets=(100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000))
+ERRORS = Counter('ada_errors_total', 'Errors by source and exception type', ['source', 'type'])
+WRITE_QUEUE_DEPTH = Gauge('ada_write_queue_depth', 'Chat turns waiting to be written', multiprocess_mode='livesum')
+
+@contextmanager
+def observe(histogram, source, **labels):
+    """Times the block into `histogram`, counting any exception under ERRORS{source}."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        ERRORS.labels(source=source, type=type(e).__name__).inc()
+        raise
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - started)
+
+def firestore_timer(op):
+    return observe(FIRESTORE_LATENCY, 'firestore', op=op)
+
+class StreamMetrics:
+    """Collects timing and size of one Gemini answer stream."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.ttfb = None
+        self.chunks = 0
+        self.bytes = 0
+
+    def chunk(self, text):
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.started
+            GEMINI_TTFB.labels(mode=self.mode).observe(self.ttfb)
+        self.chunks += 1
+        self.bytes += len(text.encode("utf-8"))
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.started
+        GEMINI_STREAM_DURATION.labels(mode=self.mode).observe(elapsed)
+        GEMINI_STREAM_CHUNKS.observe(self.chunks)
+        GEMINI_STREAM_BYTES.observe(self.bytes)
+        return elapsed
+
+    def error(self, exc):
+        ERRORS.labels(source='gemini', type=type(exc).__name__).inc()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_LATENCY.labels(route=route, method=request.method, status=response.status_code).observe(time.perf_counter() - started)
+    return response
+
+# --- HELPER: Response Compression ---
+# JSON responses (and NDJSON exports) are compressed with brotli or gzip,
+# whichever the client's Accept-Encoding prefers. Streamed exports are
+# compressed as they stream. /api/chat answers are text/plain or
+# text/event-stream and are never compressed, so each chunk reaches the client
+# as soon as Gemini produces it.
+RESPONSE_COMPRESSION = os.environ.get("RESPONSE_COMPRESSION", "true").lower() == "true"
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", 1024))
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5  # brotli's default of 11 is far too slow per request
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson'}
+RESPONSE_ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+RESPONSE_COMPRESSION_BYTES = Counter('ada_response_compression_bytes_total',
+                                     'Compressed response bytes before (raw) and after (sent) encoding',
+                                     ['encoding', 'stage'])
+
+class StreamCompressor:
+    """Incremental gzip or brotli encoder."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=RESPONSE_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(RESPONSE_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+        self.raw = 0
+        self.sent = 0
+
+    def compress(self, data):
+        self.raw += len(data)
+        out = self._compressor.process(data) if self.encoding == 'br' else self._compressor.compress(data)
+        self.sent += len(out)
+        return out
+
+    def finish(self):
+        out = self._compressor.finish() if self.encoding == 'br' else self._compressor.flush()
+        self.sent += len(out)
+        RESPONSE_COMPRESSION_BYTES.labels(encoding=self.encoding, stage='raw').inc(self.raw)
+        RESPONSE_COMPRESSION_BYTES.labels(encoding=self.encoding, stage='sent').inc(self.sent)
+        return out
+
+def compress_stream(body, encoding):
+    """Compresses a streamed body chunk by chunk, closing the original when done."""
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in body:
+            out = compressor.compress(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            if out:
+                yield out
+        yield compressor.finish()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+@app.after_request
+def compress_response(response):
+    if (not RESPONSE_COMPRESSION or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(RESPONSE_ENCODINGS)
+    if not encoding:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        body = response.get_data()
+        if len(body) < RESPONSE_COMPRESSION_MIN_BYTES:
+            return response
+        compressor = StreamCompressor(encoding)
+        response.set_data(compressor.compress(body) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    # The bytes differ per encoding, so a strong validator would be wrong
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# --- HELPER: Gemini Resilience ---
+# Every Gemini call goes through `gemini`:
+#   - streams must produce a first chunk within GEMINI_FIRST_CHUNK_TIMEOUT and
+#     then a chunk at least every GEMINI_CHUNK_TIMEOUT seconds;
+#   - if the first chunk is slower than GEMINI_HEDGE_AFTER (or the call fails
+#     before it), a second request is fired, to GEMINI_FALLBACK_MODEL when set,
+#     and whichever answers first wins while the other is cancelled;
+#   - each model has a circuit breaker that fails fast after repeated failures.
+# One-shot calls (titles, history summaries) share the breakers and fall back
+# to the fallback model on failure.
+GEMINI_FIRST_CHUNK_TIMEOUT = float(os.environ.get("GEMINI_FIRST_CHUNK_TIMEOUT", 30))
+GEMINI_CHUNK_TIMEOUT = float(os.environ.get("GEMINI_CHUNK_TIMEOUT", 20))
+GEMINI_HEDGE_AFTER = float(os.environ.get("GEMINI_HEDGE_AFTER", 6))  # 0 disables hedging
+GEMINI_CALL_TIMEOUT = float(os.environ.get("GEMINI_CALL_TIMEOUT", 15))  # one-shot calls
+GEMINI_BREAKER_THRESHOLD = int(os.environ.get("GEMINI_BREAKER_THRESHOLD", 5))  # consecutive failures
+GEMINI_BREAKER_COOLDOWN = float(os.environ.get("GEMINI_BREAKER_COOLDOWN", 30))  # seconds open
+
+GEMINI_HEDGES = Counter('ada_gemini_hedges_total', 'Hedged Gemini stream requests', ['outcome'])
+GEMINI_TIMEOUTS = Counter('ada_gemini_timeouts_total', 'Gemini stream deadlines missed', ['phase'])
+GEMINI_BREAKER_OPENED = Counter('ada_gemini_circuit_opened_total', 'Times a Gemini circuit breaker opened', ['model'])
+
+class UpstreamUnavailable(Exception):
+    """Every usable model's circuit breaker is open."""
+    def __init__(self, retry_after):
+        super().__init__("Gemini is temporarily unavailable")
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+class UpstreamTimeout(Exception):
+    pass
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; after `cooldown` seconds a single probe
+    call is let through (half-open) and its outcome closes or re-opens the breaker."""
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def _state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if time.time() - self.opened_at < self.cooldown else 'half_open'
+
+    def available(self):
+        with self._lock:
+            state = self._state()
+            return state == 'closed' or (state == 'half_open' and not self.probing)
+
+    def acquire(self):
+        """True if a call may go out now (claims the probe when half-open)."""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                print(f"Gemini circuit closed for {self.name}")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                if not self.probing:
+                    GEMINI_BREAKER_OPENED.labels(model=self.name).inc()
+                    print(f"Gemini circuit opened for {self.name} after {self.failures} failures")
+                self.opened_at = time.time()
+            self.probing = False
+
+    def abandon(self):
+        """A call that ended without a verdict (e.g. cancelled) gives the probe back."""
+        with self._lock:
+            self.probing = False
+
+    def retry_after(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 1
+            return max(1, self.cooldown - (time.time() - self.opened_at))
+
+    def stats(self):
+        with self._lock:
+            return {"state": self._state(), "failures": self.failures}
+
+class _Attempt:
+    """One upstream request inside a hedged stream."""
+
+    def __init__(self, name, breaker):
+        self.name = name
+        self.breaker = breaker
+        self.failed = False
+        self.settled = False
+
+    def settle(self, outcome):
+        if self.settled:
+            return
+        self.settled = True
+        if outcome == 'success':
+            self.breaker.record_success()
+        elif outcome == 'failure':
+            self.breaker.record_failure()
         else:
-            # Try application default credentials
-            cred = credentials.ApplicationDefault()
-            print("Using Firebase Application Default Credentials")
-        
-        firebase_admin.initialize_app(cred)
-        print("Firebase Admin SDK initialized successfully")
-    db = firestore.client()
-    print("Firestore client initialized successfully")
-except Exception as e:
-    print(f"Firebase initialization error: {type(e).__name__}: {e}")
-    print("API will run but Firestore features will not work")
-    db = None
+            self.breaker.abandon()
+
+class _ThreadAttempt(_Attempt):
+    def __init__(self, name, breaker, chat_model, history, prompt, events):
+        super().__init__(name, breaker)
+        self.cancelled = threading.Event()
+        threading.Thread(target=self._run, args=(chat_model, history, prompt, events),
+                         daemon=True, name=f"gemini-{name}").start()
+
+    def _run(self, chat_model, history, prompt, events):
+        try:
+            for chunk in chat_model.start_chat(history=history).send_message(prompt, stream=True):
+                if self.cancelled.is_set():
+                    return
+                if chunk.text:
+                    events.put((self, 'chunk', chunk.text))
+            events.put((self, 'end', None))
+        except Exception as e:
+            events.put((self, 'error', e))
+
+    def cancel(self):
+        # The SDK's blocking iterator can't be interrupted; the thread stops at its next chunk
+        self.cancelled.set()
+
+class _TaskAttempt(_Attempt):
+    def __init__(self, name, breaker, chat_model, history, prompt, events):
+        super().__init__(name, breaker)
+        self.task = asyncio.ensure_future(self._run(chat_model, history, prompt, events))
+
+    async def _run(self, chat_model, history, prompt, events):
+        try:
+            response = await chat_model.start_chat(history=history).send_message_async(prompt, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    events.put_nowait((self, 'chunk', chunk.text))
+            events.put_nowait((self, 'end', None))
+        except Exception as e:
+            events.put_nowait((self, 'error', e))
+
+    def cancel(self):
+        self.task.cancel()
+
+class HedgedStream:
+    """Bookkeeping for one streamed answer, shared by the thread and asyncio drivers."""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.attempts = []
+        self.started = time.monotonic()
+        self.hedged = False
+        self.winner = None
+        self.last_error = None
+
+    def next_step(self):
+        """While waiting for the first chunk: ('hedge', None) or ('wait', seconds); raises when out of options."""
+        elapsed = time.monotonic() - self.started
+        if elapsed >= self.gateway.first_chunk_timeout:
+            GEMINI_TIMEOUTS.labels(phase='first_chunk').inc()
+            raise UpstreamTimeout(f"No response from Gemini within {self.gateway.first_chunk_timeout:g}s")
+        live = [a for a in self.attempts if not a.failed]
+        can_hedge = not self.hedged and self.gateway.hedge_after > 0
+        if can_hedge and (elapsed >= self.gateway.hedge_after or not live):
+            self.hedged = True
+            return 'hedge', None
+        if not live:
+            raise self.last_error
+        wait = self.gateway.first_chunk_timeout - elapsed
+        if can_hedge:
+            wait = min(wait, self.gateway.hedge_after - elapsed)
+        return 'wait', max(wait, 0.001)
+
+    def first_event(self, attempt, kind, value):
+        """Handles an event before a winner exists; True once `attempt` has won."""
+        if kind == 'error':
+            attempt.failed = True
+            attempt.settle('failure')
+            self.last_error = value
+            return False
+        self.winner = attempt
+        for other in self.attempts:
+            if other is not attempt and not other.failed:
+                other.cancel()
+                other.settle('abandon')
+        if len(self.attempts) > 1 and attempt is self.attempts[-1]:
+            GEMINI_HEDGES.labels(outcome='won').inc()
+        return True
+
+    def close(self, outcome):
+        for attempt in self.attempts:
+            if not attempt.settled:
+                attempt.cancel()
+                attempt.settle(outcome)
+
+class GeminiGateway:
+    def __init__(self, first_chunk_timeout, chunk_timeout, hedge_after, call_timeout, breaker_threshold, breaker_cooldown):
+        self.first_chunk_timeout = first_chunk_timeout
+        self.chunk_timeout = chunk_timeout
+        self.hedge_after = hedge_after
+        self.call_timeout = call_timeout
+        self.breakers = {name: CircuitBreaker(name, breaker_threshold, breaker_cooldown)
+                         for name in (GEMINI_MODEL_NAME, GEMINI_FALLBACK_MODEL_NAME) if name}
+
+    def _routes(self, kind, prefer_fallback=False):
+        """(name, model, breaker) in the order they should be tried."""
+        primary, fallback = (model, fallback_model) if kind == 'chat' else (title_model, fallback_title_model)
+        routes = [(GEMINI_MODEL_NAME, primary, self.breakers[GEMINI_MODEL_NAME])]
+        if fallback is not None:
+            routes.append((GEMINI_FALLBACK_MODEL_NAME, fallback, self.breakers[GEMINI_FALLBACK_MODEL_NAME]))
+        return routes[::-1] if prefer_fallback else routes
+
+    def available(self):
+        """False while every chat model's breaker is open; callers answer 503 right away."""
+        return any(breaker.available() for _, _, breaker in self._routes('chat'))
+
+    def retry_after(self):
+        return min(breaker.retry_after() for _, _, breaker in self._routes('chat'))
+
+    def _start(self, call, attempt_class, history, prompt, events, hedge=False):
+        for name, chat_model, breaker in self._routes('chat', prefer_fallback=hedge):
+            if breaker.acquire():
+                call.attempts.append(attempt_class(name, breaker, chat_model, history, prompt, events))
+                if hedge:
+                    GEMINI_HEDGES.labels(outcome='fired').inc()
+                return True
+        return False
+
+    def stream(self, history, prompt):
+        """Yields answer chunks from the first model to respond (blocking; for worker threads)."""
+        events = queue.Queue()
+        call = HedgedStream(self)
+        if not self._start(call, _ThreadAttempt, history, prompt, events):
+            raise UpstreamUnavailable(self.retry_after())
+        try:
+            while call.winner is None:
+                step, wait = call.next_step()
+                if step == 'hedge':
+                    self._start(call, _ThreadAttempt, history, prompt, events, hedge=True)
+                    continue
+                try:
+                    event = events.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if call.first_event(*event) and event[1] == 'chunk':
+                    yield event[2]
+            if event[1] != 'end':
+                deadline = time.monotonic() + self.chunk_timeout
+                while True:
+                    try:
+                        attempt, kind, value = events.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        GEMINI_TIMEOUTS.labels(phase='inter_chunk').inc()
+                        raise UpstreamTimeout(f"Gemini stream stalled for {self.chunk_timeout:g}s")
+                    if attempt is not call.winner:
+                        continue
+                    if kind == 'error':
+                        raise value
+                    if kind == 'end':
+                        break
+                    yield value
+                    deadline = time.monotonic() + self.chunk_timeout
+            call.close('success')
+        except GeneratorExit:
+            # The client went away; that says nothing about Gemini's health
+            call.close('abandon')
+            raise
+        except Exception:
+            call.close('failure')
+            raise
+
+    async def astream(self, history, prompt):
+        """Async twin of stream() for the event loop."""
+        events = asyncio.Queue()
+        call = HedgedStream(self)
+        if not self._start(call, _TaskAttempt, history, prompt, events):
+            raise UpstreamUnavailable(self.retry_after())
+        try:
+            while call.winner is None:
+                step, wait = call.next_step()
+                if step == 'hedge':
+                    self._start(call, _TaskAttempt, history, prompt, events, hedge=True)
+                    continue
+                try:
+                    event = await asyncio.wait_for(events.get(), wait)
+                except asyncio.TimeoutError:
+                    continue
+                if call.first_event(*event) and event[1] == 'chunk':
+                    yield event[2]
+            if event[1] != 'end':
+                deadline = time.monotonic() + self.chunk_timeout
+                while True:
+                    try:
+                        attempt, kind, value = await asyncio.wait_for(events.get(), max(deadline - time.monotonic(), 0))
+                    except asyncio.TimeoutError:
+                        GEMINI_TIMEOUTS.labels(phase='inter_chunk').inc()
+                        raise UpstreamTimeout(f"Gemini stream stalled for {self.chunk_timeout:g}s")
+                    if attempt is not call.winner:
+                        continue
+                    if kind == 'error':
+                        raise value
+                    if kind == 'end':
+                        break
+                    yield value
+                    deadline = time.monotonic() + self.chunk_timeout
+            call.close('success')
+        except (GeneratorExit, asyncio.CancelledError):
+            call.close('abandon')
+            raise
+        except Exception:
+            call.close('failure')
+            raise
+
+    def generate(self, prompt):
+        """One-shot text generation (titles, summaries) with a deadline, trying the fallback model on failure."""
+        last_error = None
+        for name, text_model, breaker in self._routes('title'):
+            if not breaker.acquire():
+                continue
+            try:
+                text = text_model.generate_content(prompt, request_options={"timeout": self.call_timeout}).text
+            except Exception as e:
+                breaker.record_failure()
+                last_error = e
+                continue
+            breaker.record_success()
+            return text
+        raise last_error or UpstreamUnavailable(self.retry_after())
+
+    def stats(self):
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
+
+gemini = GeminiGateway(GEMINI_FIRST_CHUNK_TIMEOUT, GEMINI_CHUNK_TIMEOUT, GEMINI_HEDGE_AFTER, GEMINI_CALL_TIMEOUT,
+                       GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN)
+
+def upstream_unavailable_error(e):
+    """(status, payload, headers) while Gemini's circuit breakers are open."""
+    return 503, {
+        "error": "Service Unavailable",
+        "message": "The AI service is having trouble right now. Please try again shortly."
+    }, {"Retry-After": str(e.retry_after)}
+
+# --- HELPER: Verified Token Cache ---
+# Verified ID tokens are kept in memory until their own 'exp' claim, so polling
+# clients don't pay for a signature check on every request.
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get("TOKEN_CACHE_MAX_ENTRIES", 2048))
+TOKEN_CACHE_EXPIRY_MARGIN = 30  # seconds before 'exp' at which an entry is dropped
+
+class TokenCache:
+    """Thread-safe LRU cache of verified tokens, keyed by a SHA-256 of the token."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, user_data)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, key, user_data, exp):
+        expires_at = exp - TOKEN_CACHE_EXPIRY_MARGIN
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, dict(user_data))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+token_cache = TokenCache(TOKEN_CACHE_MAX_ENTRIES)
+
+# --- HELPER: Verify Firebase Token & Check Guest Status ---
+def verify_token(auth_header):
+    """
+    Verifies the Firebase ID Token sent from the client.
+    Returns a dictionary {'uid': str, 'is_guest': bool} if valid, None otherwise.
+    Enhanced to detect Anonymous (Guest) users.
+    """
+    if not auth_header:
+        print("No Authorization header provided")
+        return None
+    
+    if not auth_header.startswith("Bearer "):
+        print("Invalid Authorization header format (must start with 'Bearer ')")
+        return None
+    
+    token = auth_header.split("Bearer ")[1]
+    
+    # Serve repeat requests with the same token from the cache
+    started = time.perf_counter()
+    cache_key = TokenCache.key_for(token)
+    cached = token_cache.get(cache_key)
+    if cached:
+        TOKEN_VERIFY_LATENCY.labels(result='cached').observe(time.perf_counter() - started)
+        return cached
+    
+    error = None
+    try:
+        decoded_token = auth.verify_id_token(token)
+        user_id = decoded_token['uid']
+        
+        # Check the sign-in provider to see if it's an anonymous user
+        firebase_claim = decoded_token.get('firebase', {})
+        provider = firebase_claim.get('sign_in_provider')
+        is_guest = (provider == 'anonymous')
+        
+        user_data = {'uid': user_id, 'is_guest': is_guest}
+        if 'exp' in decoded_token:
+            token_cache.put(cache_key, user_data, decoded_token['exp'])
+        return user_data
+
+    except auth.InvalidIdTokenError as e:
+        error = e
+        print("Invalid ID token - token is malformed or invalid")
+        return None
+    except auth.ExpiredIdTokenError as e:
+        error = e
+        print("Token has expired - user needs to refresh their token")
+        return None
+    except auth.RevokedIdTokenError as e:
+        error = e
+        print("Token has been revoked")
+        return None
+    except Exception as e:
+        error = e
+        print(f"Token verification error: {type(e).__name__}: {e}")
+        return None
+    finally:
+        result = 'rejected' if error else 'verified'
+        TOKEN_VERIFY_LATENCY.labels(result=result).observe(time.perf_counter() - started)
+        if error:
+            ERRORS.labels(source='auth', type=type(error).__name__).inc()
+
+def get_user_ref(user_data):
+    """
+    Returns the Firestore Document Reference for the user.
+    Routes guests to 'temp-users' and registered users to 'users'.
+    """
+    if not db:
+        raise Exception("Database unavailable")
+    
+    # TRAFFIC ROUTING LOGIC
+    collection_name = 'temp-users' if user_data['is_guest'] else 'users'
+    return db.collection(collection_name).document(user_data['uid'])
+
+# --- HELPER: Profile Cache ---
+# Profiles are read on every page load but change only through PUT /api/profile,
+# so each process keeps them briefly. PUT invalidates the entry; the TTL bounds
+# staleness from writes made elsewhere (e.g. the Firebase console).
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", 60))  # seconds
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get("PROFILE_CACHE_MAX_ENTRIES", 1024))
+PROFILE_EDITABLE_FIELDS = ['displayName', 'age', 'location', 'bio', 'photoURL', 'theme', 'codeTheme', 'fontSize']
+
+def profile_key(user_data):
+    return ('temp-users' if user_data['is_guest'] else 'users', user_data['uid'])
+
+def default_profile(user_data):
+    return {
+        "uid": user_data['uid'],
+        "isGuest": user_data['is_guest'],
+        "displayName": "Guest User" if user_data['is_guest'] else "",
+        "email": "",
+        "photoURL": "",
+        "age": "",
+        "location": "",
+        "bio": "",
+        "totalChats": 0,
+        "totalMessages": 0,
+        "totalCodeSnippets": 0,
+        "theme": "dark",
+        "codeTheme": "dracula",
+        "fontSize": 13,
+        "createdAt": datetime.datetime.now(datetime.timezone.utc)
+    }
+
+class ProfileCache:
+    """Thread-safe TTL/LRU of profile dicts keyed by (collection, uid)."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, profile)
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a read that started before a write can't cache the old profile
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns (profile or None, generation to pass to put())."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None, self._generation
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1]), self._generation
+
+    def put(self, key, profile, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.time() + self.ttl, copy.deepcopy(profile))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+profile_cache = ProfileCache(PROFILE_CACHE_TTL, PROFILE_CACHE_MAX_ENTRIES)
+
+def load_profile(user_data):
+    """Read-through profile lookup. A missing profile is created with a create-only write,
+    so concurrent first loads agree on one document instead of overwriting each other."""
+    key = profile_key(user_data)
+    profile, generation = profile_cache.get(key)
+    if profile is not None:
+        return profile
+
+    user_ref = get_user_ref(user_data)
+    with firestore_timer('profile_get'):
+        doc = user_ref.get()
+    if doc.exists:
+        profile = doc.to_dict()
+    else:
+        profile = default_profile(user_data)
+        try:
+            with firestore_timer('profile_create'):
+                user_ref.create(profile)
+        except api_exceptions.AlreadyExists:
+            # Another request created it first; use theirs
+            with firestore_timer('profile_get'):
+                profile = user_ref.get().to_dict()
+    profile_cache.put(key, profile, generation)
+    return profile
+
+def profile_response(profile):
+    """JSON response with an ETag over the body; answers If-None-Match with 304."""
+    response = jsonify(profile)
+    response.set_etag(hashlib.sha256(response.get_data()).hexdigest()[:32])
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+# --- HELPER: Chat Message Storage ---
+# Messages live in a 'messages' subcollection under each chat document. Message
+# IDs are time-ordered ("<epoch_us>-<index>") so ordering by document ID gives the
+# transcript order and an ID doubles as a pagination cursor. The chat document
+# only keeps the denormalized 'messageCount' and 'lastMessageAt'.
+# Long contents are stored zlib-compressed: 'content' then holds the bytes and
+# 'contentEncoding' says how to read them. Messages without it are plain text,
+# as all messages written before compression are.
+MESSAGES_PAGE_MAX = 200
+FIRESTORE_BATCH_LIMIT = 500
+MESSAGE_COMPRESSION = os.environ.get("MESSAGE_COMPRESSION", "true").lower() == "true"
+MESSAGE_COMPRESS_MIN_BYTES = int(os.environ.get("MESSAGE_COMPRESS_MIN_BYTES", 512))
+MESSAGE_COMPRESS_LEVEL = 6
+MESSAGE_ENCODING_ZLIB = "zlib/1"
+
+def encode_message(msg):
+    """The message as stored: content compressed when it is long enough to be worth it."""
+    content = msg.get('content')
+    if not MESSAGE_COMPRESSION or not isinstance(content, str):
+        return msg
+    raw = content.encode("utf-8")
+    if len(raw) < MESSAGE_COMPRESS_MIN_BYTES:
+        return msg
+    packed = zlib.compress(raw, MESSAGE_COMPRESS_LEVEL)
+    if len(packed) > len(raw) * 0.9:
+        return msg
+    return dict(msg, content=packed, contentEncoding=MESSAGE_ENCODING_ZLIB)
+
+def decode_message(msg):
+    """Reverses encode_message in place (plain messages pass through); returns msg."""
+    encoding = msg.pop('contentEncoding', None)
+    if encoding == MESSAGE_ENCODING_ZLIB:
+        msg['content'] = zlib.decompress(msg['content']).decode("utf-8")
+    elif encoding is not None:
+        raise ValueError(f"Unknown message encoding: {encoding}")
+    return msg
+
+def make_message_id(timestamp, index=0):
+    """Builds a sortable message ID from a datetime and its position in the turn."""
+    return f"{int(timestamp.timestamp() * 1_000_000):016d}-{index:04d}"
+
+def append_messages(batch, chat_ref, messages):
+    """Queues the given messages as subcollection writes on a Firestore batch; returns their IDs."""
+    messages_ref = chat_ref.collection('messages')
+    message_ids = [make_message_id(msg['timestamp'], index) for index, msg in enumerate(messages)]
+    for message_id, msg in zip(message_ids, messages):
+        batch.set(messages_ref.document(message_id), encode_message(msg))
+    return message_ids
+
+def load_messages(chat_ref, before=None, limit=None):
+    """
+    Loads messages in chronological order.
+    With a limit, returns the newest `limit` messages older than the `before` cursor.
+    Returns (messages, next_cursor); next_cursor is None when there is nothing older.
+    """
+    query = chat_ref.collection('messages').order_by('__name__', direction='DESCENDING')
+    if before:
+        query = query.start_after({'__name__': before})
+    if limit:
+        query = query.limit(limit + 1)
+    
+    with firestore_timer('messages_load'):
+        docs = list(query.stream())
+    has_more = bool(limit) and len(docs) > limit
+    if has_more:
+        docs = docs[:limit]
+    
+    messages = []
+    for doc in reversed(docs):
+        msg = decode_message(doc.to_dict())
+        msg['id'] = doc.id
+        messages.append(msg)
+    
+    next_cursor = messages[0]['id'] if has_more else None
+    return messages, next_cursor
+
+def iter_messages(chat_ref, page_size=MESSAGES_PAGE_MAX):
+    """Yields messages oldest first, reading one page at a time."""
+    cursor = None
+    while True:
+        query = chat_ref.collection('messages').order_by('__name__').limit(page_size)
+        if cursor:
+            query = query.start_after({'__name__': cursor})
+        with firestore_timer('messages_load'):
+            docs = list(query.stream())
+        for doc in docs:
+            msg = decode_message(doc.to_dict())
+            msg['id'] = doc.id
+            yield msg
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1].id
+
+def delete_messages(chat_ref):
+    """Deletes every message in a chat's subcollection, in batches."""
+    messages_ref = chat_ref.collection('messages')
+    while True:
+        with firestore_timer('messages_delete'):
+            docs = list(messages_ref.limit(FIRESTORE_BATCH_LIMIT).stream())
+        if not docs:
+            return
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        with firestore_timer('messages_delete'):
+            batch.commit()
+
+def migrate_chat_messages(chat_ref, chat_data):
+    """
+    Moves a legacy 'messages' array into the subcollection.
+    Safe to re-run: message IDs are derived from the array, so retries overwrite.
+    Returns the number of messages migrated (0 if the chat was already migrated).
+    """
+    legacy = chat_data.get('messages')
+    if not isinstance(legacy, list):
+        return 0
+    
+    fallback = chat_data.get('createdAt') or datetime.datetime.now(datetime.timezone.utc)
+    writes = []
+    last_ts = fallback
+    for index, msg in enumerate(legacy):
+        ts = msg.get('timestamp') or last_ts
+        if ts < last_ts:
+            ts = last_ts  # keep array order even if stored timestamps disagree
+        last_ts = ts
+        writes.append((make_message_id(ts, index), msg))
+    
+    messages_ref = chat_ref.collection('messages')
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT - 1):
+        batch = db.batch()
+        for msg_id, msg in writes[start:start + FIRESTORE_BATCH_LIMIT - 1]:
+            batch.set(messages_ref.document(msg_id), encode_message(msg))
+        if start + FIRESTORE_BATCH_LIMIT - 1 >= len(writes):
+            batch.update(chat_ref, {
+                "messages": firestore.DELETE_FIELD,
+                "messageCount": len(writes),
+                "lastMessageAt": last_ts
+            })
+        with firestore_timer('messages_migrate'):
+            batch.commit()
+    
+    if not writes:
+        chat_ref.update({"messages": firestore.DELETE_FIELD, "messageCount": 0})
+    return len(writes)
+
+# --- HELPER: Chat Listing ---
+# The sidebar only needs these fields, so listings use a server-side projection
+# and never read message data.
+CHAT_LIST_FIELDS = ['title', 'createdAt', 'updatedAt', 'isPinned', 'messageCount']
+CHATS_PAGE_MAX = 100
+
+def chat_summary(doc):
+    """Builds the sidebar entry for a chat document snapshot."""
+    chat_data = doc.to_dict()
+    return {
+        'id': doc.id,
+        'title': chat_data.get('title', 'New Chat'),
+        'createdAt': chat_data.get('createdAt'),
+        'updatedAt': chat_data.get('updatedAt'),
+        'isPinned': chat_data.get('isPinned', False),
+        # Unknown (null) for legacy array-based chats until `migrate-messages` has run
+        'messageCount': chat_data.get('messageCount')
+    }
+
+def encode_chats_cursor(summary):
+    """Encodes the (updatedAt, id) position of the last listed chat as an opaque cursor."""
+    raw = json.dumps({"updatedAt": summary['updatedAt'].isoformat(), "id": summary['id']})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_chats_cursor(cursor):
+    """Inverse of encode_chats_cursor. Raises ValueError on a malformed cursor."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(raw['id'], str) or not raw['id'] or '/' in raw['id'] or raw['id'] in ('.', '..'):
+            raise ValueError("id is not a chat ID")
+        return {
+            'updatedAt': datetime.datetime.fromisoformat(raw['updatedAt']),
+            '__name__': raw['id']
+        }
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def migrate_all_chats():
+    """One-shot migration of every array-based chat in 'users' and 'temp-users'."""
+    if not db:
+        raise Exception("Database unavailable")
+    
+    migrated_chats = 0
+    migrated_messages = 0
+    for doc in db.collection_group('chats').stream():
+        chat_data = doc.to_dict()
+        if 'messages' not in chat_data:
+            continue
+        migrated_messages += migrate_chat_messages(doc.reference, chat_data)
+        migrated_chats += 1
+    print(f"Migrated {migrated_messages} messages across {migrated_chats} chats")
+
+# --- HELPER: Bulk Chat Operations ---
+# POST /api/chats/bulk applies one action to many chats in few round trips: one
+# batched read finds the chats, then every write (for deletes, their messages
+# too) is packed FIRESTORE_BATCH_LIMIT to a commit.
+BULK_CHAT_MAX_IDS = int(os.environ.get("BULK_CHAT_MAX_IDS", 100))
+BULK_CHAT_ACTIONS = ('delete', 'pin', 'rename')
+
+class BatchWriter:
+    """Queues writes, committing full batches; optionally paced to `writes_per_second`."""
+
+    def __init__(self, op, writes_per_second=0):
+        self.op = op
+        self.writes_per_second = writes_per_second
+        self._batch = None
+        self.pending = 0
+        self.written = 0
+
+    def _queue(self, method, *args):
+        if self._batch is None:
+            self._batch = db.batch()
+        getattr(self._batch, method)(*args)
+        self.pending += 1
+        if self.pending >= FIRESTORE_BATCH_LIMIT:
+            self.flush()
+
+    def set(self, ref, data):
+        self._queue('set', ref, data)
+
+    def delete(self, ref):
+        self._queue('delete', ref)
+
+    def update(self, ref, fields):
+        self._queue('update', ref, fields)
+
+    def flush(self):
+        if not self.pending:
+            return
+        started = time.monotonic()
+        with firestore_timer(self.op):
+            self._batch.commit()
+        self.written += self.pending
+        if self.writes_per_second > 0:
+            time.sleep(max(0.0, self.pending / self.writes_per_second - (time.monotonic() - started)))
+        self._batch = None
+        self.pending = 0
+
+def queue_chat_delete(writer, chat_ref):
+    """Queues the deletion of a chat and its messages subcollection; returns the number of writes."""
+    with firestore_timer('messages_list'):
+        message_refs = list(chat_ref.collection('messages').list_documents(page_size=FIRESTORE_BATCH_LIMIT))
+    for message_ref in message_refs:
+        writer.delete(message_ref)
+    writer.delete(chat_ref)
+    return len(message_refs) + 1
+
+def queue_contexts_delete(writer, user_ref):
+    """Queues the deletion of a user's stored attachments (contexts subcollection); returns the number of writes."""
+    with firestore_timer('contexts_list'):
+        context_refs = list(user_ref.collection('contexts').list_documents(page_size=FIRESTORE_BATCH_LIMIT))
+    for context_ref in context_refs:
+        writer.delete(context_ref)
+    return len(context_refs)
+
+def find_chats(user_ref, chat_ids):
+    """Splits chat IDs into (existing, missing) with one batched read."""
+    refs = [user_ref.collection('chats').document(chat_id) for chat_id in chat_ids]
+    with firestore_timer('chats_get_all'):
+        existing = {snap.id for snap in db.get_all(refs, field_paths=['title']) if snap.exists}
+    return ([chat_id for chat_id in chat_ids if chat_id in existing],
+            [chat_id for chat_id in chat_ids if chat_id not in existing])
+
+# --- HELPER: Temp-User Sweeper ---
+# Guest data lives under 'temp-users' (see get_user_ref) and nothing else removes
+# it. A background thread deletes guests with no activity for TEMP_USER_TTL_DAYS
+# (profile, chats and messages) in batches paced to SWEEP_WRITES_PER_SECOND.
+# Under gunicorn, a file lock (SWEEP_LOCK_PATH) keeps it to one worker.
+TEMP_USER_TTL_DAYS = float(os.environ.get("TEMP_USER_TTL_DAYS", 30))
+SWEEP_INTERVAL = int(os.environ.get("SWEEP_INTERVAL", 6 * 3600))  # seconds between sweeps; 0 disables
+SWEEP_START_DELAY = int(os.environ.get("SWEEP_START_DELAY", 60))  # first sweep this long after boot
+SWEEP_WRITES_PER_SECOND = float(os.environ.get("SWEEP_WRITES_PER_SECOND", 100))
+SWEEP_DRY_RUN = os.environ.get("SWEEP_DRY_RUN", "false").lower() == "true"  # count stale guests, delete nothing
+SWEEP_LOCK_PATH = os.environ.get("SWEEP_LOCK_PATH")
+
+SWEEP_USERS = Counter('ada_sweep_users_total', 'temp-users examined by the sweeper', ['result'])
+SWEEP_DELETES = Counter('ada_sweep_deletes_total', 'Documents deleted by the sweeper')
+SWEEP_LAST_RUN = Gauge('ada_sweep_last_run_timestamp_seconds', 'When the last complete sweep finished',
+                       multiprocess_mode='max')
+
+def last_activity(user_ref):
+    """Newest of the profile's createdAt/updatedAt and its latest chat's updatedAt; None if none exist."""
+    with firestore_timer('sweep_read'):
+        profile = user_ref.get(field_paths=['createdAt', 'updatedAt'])
+        latest_chat = list(user_ref.collection('chats')
+                           .order_by('updatedAt', direction='DESCENDING')
+                           .select(['updatedAt']).limit(1).stream())
+    stamps = []
+    if profile.exists:
+        stamps += [profile.get('createdAt'), profile.get('updatedAt')]
+    if latest_chat:
+        stamps.append(latest_chat[0].get('updatedAt'))
+    stamps = [s for s in stamps if isinstance(s, datetime.datetime)]
+    return max(stamps) if stamps else None
+
+class TempUserSweeper:
+    """Periodic, rate-limited deletion of stale guest accounts; one sweep at a time."""
+
+    def __init__(self, ttl_days, interval, writes_per_second, dry_run, lock_path):
+        self.ttl_days = ttl_days
+        self.interval = interval
+        self.writes_per_second = writes_per_second
+        self.dry_run = dry_run
+        self.lock_path = lock_path
+        self._lock_file = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._sweep_lock = threading.Lock()
+        self.current = None   # progress of the sweep in progress
+        self.last_run = None  # summary of the last finished sweep
+        self.runs = 0
+
+    def _hold_lock(self):
+        """True once this process owns the sweeper lock (kept until the process exits)."""
+        if self._lock_file is not None or not self.lock_path or fcntl is None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _delete_user(self, user_ref, writer):
+        queued = 0
+        for chat_doc in iter_chats(user_ref):
+            queued += queue_chat_delete(writer, chat_doc.reference)
+        queued += queue_search_delete(writer, user_ref)
+        queued += queue_contexts_delete(writer, user_ref)
+        writer.delete(user_ref)
+        # Commit each guest before moving on so the progress counts are exact
+        writer.flush()
+        search_index.forget(('temp-users', user_ref.id))
+        context_store.forget_user(user_ref.id)
+        return queued + 1
+
+    def sweep(self, dry_run=None):
+        """One pass over temp-users; returns the run summary."""
+        if not db:
+            raise Exception("Database unavailable")
+        dry_run = self.dry_run if dry_run is None else dry_run
+        with self._sweep_lock:
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.ttl_days)
+            run = {"startedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(), "dryRun": dry_run,
+                   "scanned": 0, "stale": 0, "deletedUsers": 0, "deletedDocs": 0, "failed": 0}
+            self.current = run
+            writer = BatchWriter('sweep_delete', self.writes_per_second)
+            try:
+                with firestore_timer('sweep_list'):
+                    user_refs = db.collection('temp-users').list_documents(page_size=FIRESTORE_BATCH_LIMIT)
+                for user_ref in user_refs:
+                    if self._stop.is_set():
+                        break
+                    run["scanned"] += 1
+                    try:
+                        activity = last_activity(user_ref)
+                        if activity is not None and activity >= cutoff:
+                            SWEEP_USERS.labels(result='active').inc()
+                            continue
+                        run["stale"] += 1
+                        if dry_run:
+                            SWEEP_USERS.labels(result='stale').inc()
+                            continue
+                        deleted = self._delete_user(user_ref, writer)
+                        run["deletedUsers"] += 1
+                        run["deletedDocs"] += deleted
+                        SWEEP_USERS.labels(result='deleted').inc()
+                        SWEEP_DELETES.inc(deleted)
+                    except Exception as e:
+                        run["failed"] += 1
+                        SWEEP_USERS.labels(result='failed').inc()
+                        ERRORS.labels(source='sweeper', type=type(e).__name__).inc()
+                        print(f"Sweeper failed on temp-user {user_ref.id}: {type(e).__name__}: {e}")
+                if not self._stop.is_set():
+                    SWEEP_LAST_RUN.set_to_current_time()
+            finally:
+                run["finishedAt"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+                self.current = None
+                self.last_run = run
+                self.runs += 1
+            print(f"Temp-user sweep{' (dry run)' if dry_run else ''}: scanned {run['scanned']}, "
+                  f"stale {run['stale']}, deleted {run['deletedUsers']} users / {run['deletedDocs']} docs, "
+                  f"failed {run['failed']}")
+            return run
+
+    def _loop(self):
+        delay = SWEEP_START_DELAY
+        while not self._stop.wait(delay):
+            delay = self.interval
+            # Another worker holds the lock: check again next interval in case it exited
+            if not self._hold_lock():
+                continue
+            try:
+                self.sweep()
+            except Exception as e:
+                ERRORS.labels(source='sweeper', type=type(e).__name__).inc()
+                print(f"Temp-user sweep failed: {type(e).__name__}: {e}")
+
+    def start(self):
+        """Starts the background thread (after any fork; see gunicorn.conf.py). No-op when disabled."""
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="temp-user-sweeper")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "enabled": self.interval > 0,
+            "intervalSeconds": self.interval,
+            "ttlDays": self.ttl_days,
+            "dryRun": self.dry_run,
+            "lockHeld": self._lock_file is not None,
+            "runs": self.runs,
+            "current": dict(self.current) if self.current else None,
+            "lastRun": self.last_run
+        }
+
+temp_user_sweeper = TempUserSweeper(TEMP_USER_TTL_DAYS, SWEEP_INTERVAL, SWEEP_WRITES_PER_SECOND,
+                                    SWEEP_DRY_RUN, SWEEP_LOCK_PATH)
+
+# --- HELPER: Chat Search ---
+# GET /api/chats/search is answered from a per-user inverted index, never by
+# reading chats. The index sits next to the chats as one zlib-compressed base
+# (searchIndex/<through>, split into chunks under the 1 MiB document limit)
+# plus a log of changes since (searchLog). Persisted turns, renames and deletes
+# append a log entry in the same batch as the change itself. Ops are versioned
+# by their log ID (last writer wins, deletes leave tombstones), so workers never
+# read-modify-write the index and may apply the log in any order. Once the log
+# reaches SEARCH_COMPACT_AFTER entries, the worker that reads it folds it into a
+# new base; a worker that wrote that many entries for a user reads it for this,
+# building the index first if the user never searched. Each process keeps the indexes of SEARCH_CACHE_MAX_USERS users and
+# checks the log at most every SEARCH_REFRESH_SECONDS.
+SEARCH_CACHE_MAX_USERS = int(os.environ.get("SEARCH_CACHE_MAX_USERS", 64))
+SEARCH_REFRESH_SECONDS = float(os.environ.get("SEARCH_REFRESH_SECONDS", 10))
+SEARCH_COMPACT_AFTER = int(os.environ.get("SEARCH_COMPACT_AFTER", 25))  # log entries
+SEARCH_LOG_SETTLE_SECONDS = 60   # a log entry is committed within this long of getting its ID
+SEARCH_WRITE_COUNTS_MAX = 10_000 # users whose log writes are counted towards compaction
+SEARCH_CHUNK_BYTES = 900_000     # compressed base bytes per document
+SEARCH_CHUNKS_PER_COMMIT = 8     # keeps a commit under Firestore's 10 MiB request limit
+SEARCH_RESULTS_MAX = 50
+SEARCH_QUERY_MAX_TERMS = 8
+SEARCH_PREFIX_EXPANSIONS = 20    # terms the last, unfinished query word may expand to
+SEARCH_SNIPPET_CHARS = 160
+SEARCH_TITLE_BOOST = 3
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+SEARCH_TOKEN_RE = re.compile(r"\w{2,32}")
+SEARCH_STOPWORDS = frozenset("""
+    an and are as at be but by can do does for from has have how if in into is it its of on or so
+    that the their then there these this to was what when where which why will with you your
+""".split())
+
+def search_terms(text):
+    """Lowercased term counts for indexing (stop words and bare numbers dropped)."""
+    counts = {}
+    for term in SEARCH_TOKEN_RE.findall((text or "").lower()):
+        if term in SEARCH_STOPWORDS or term.isdigit():
+            continue
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+def search_log_id(ts=None):
+    """Time-ordered log entry ID; also the version of every op in the entry."""
+    return f"{int((time.time() if ts is None else ts) * 1_000_000):020d}-{uuid.uuid4().hex[:8]}"
+
+def search_boundary(ts):
+    """Sorts before every log ID created at or after `ts`."""
+    return f"{int(ts * 1_000_000):020d}"
+
+def search_log_time(log_id):
+    return int(log_id[:20]) / 1_000_000
+
+def search_op_valid(entry):
+    """Whether a log op has the shape UserSearchIndex.apply() expects."""
+    if not isinstance(entry, list) or len(entry) < 2 or not isinstance(entry[1], str):
+        return False
+    if entry[0] == 'delete':
+        return len(entry) == 2
+    if entry[0] == 'rename':
+        return len(entry) == 3 and isinstance(entry[2], str)
+    if entry[0] != 'add' or len(entry) != 4 or not (entry[2] is None or isinstance(entry[2], str)):
+        return False
+    return isinstance(entry[3], list) and all(
+        isinstance(m, list) and len(m) == 2 and isinstance(m[0], str) and isinstance(m[1], dict)
+        and all(isinstance(tf, int) for tf in m[1].values()) for m in entry[3])
+
+class UserSearchIndex:
+    """
+    One user's inverted index. Postings map term -> chat -> message ordinal -> tf,
+    with ordinal -1 standing for the chat title. apply() is idempotent and
+    order-independent, which is what lets every worker append to the same log.
+    """
+
+    def __init__(self):
+        # chat_id -> {title, titleOp, updatedAt, length, next, messages: {msg_id: [ordinal, op, length]}}
+        self.chats = {}
+        self.postings = {}
+        self.tombstones = {}  # chat_id -> log ID of its latest delete
+        self.applied = set()  # log IDs applied on top of the base
+        self.base = None      # ID of the base this index was loaded from (= its `through`)
+        self.checked_at = 0.0
+        self.compacting = False
+        self.lock = threading.Lock()
+
+    def _chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = {"title": "", "titleOp": "", "updatedAt": 0.0, "length": 0,
+                                          "next": 0, "messages": {}}
+        return chat
+
+    def _post(self, chat_id, ordinal, counts):
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {}).setdefault(chat_id, {})[ordinal] = tf
+
+    def _unpost(self, chat_id, ordinals, terms=None):
+        for term in list(self.postings if terms is None else terms):
+            per_chat = self.postings.get(term)
+            per_msg = per_chat.get(chat_id) if per_chat else None
+            if per_msg is None:
+                continue
+            for ordinal in ordinals:
+                per_msg.pop(ordinal, None)
+            if not per_msg:
+                del per_chat[chat_id]
+                if not per_chat:
+                    del self.postings[term]
+
+    def _set_title(self, chat_id, chat, title, op):
+        if op <= chat["titleOp"]:
+            return
+        self._unpost(chat_id, [-1], search_terms(chat["title"]))
+        chat["title"], chat["titleOp"] = title, op
+        self._post(chat_id, -1, search_terms(title))
+
+    def _delete(self, chat_id, op):
+        if op <= self.tombstones.get(chat_id, ""):
+            return
+        self.tombstones[chat_id] = op
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return
+        # Only what was written before the delete goes; a chat re-created after it stays
+        stale = {msg_id: meta for msg_id, meta in chat["messages"].items() if meta[1] < op}
+        if stale:
+            self._unpost(chat_id, [meta[0] for meta in stale.values()])
+            for msg_id, meta in stale.items():
+                del chat["messages"][msg_id]
+                chat["length"] -= meta[2]
+        if chat["titleOp"] and chat["titleOp"] < op:
+            self._unpost(chat_id, [-1], search_terms(chat["title"]))
+            chat["title"], chat["titleOp"] = "", ""
+        if not chat["messages"] and not chat["titleOp"]:
+            del self.chats[chat_id]
+
+    def apply(self, op, ops):
+        """
+        Applies one log entry. ops: ["add", chat_id, title or None, [[msg_id, {term: tf}], ...]],
+        ["rename", chat_id, title] or ["delete", chat_id].
+        """
+        for entry in ops:
+            kind, chat_id = entry[0], entry[1]
+            if kind == 'delete':
+                self._delete(chat_id, op)
+                continue
+            if op < self.tombstones.get(chat_id, ""):
+                continue
+            chat = self._chat(chat_id)
+            chat["updatedAt"] = max(chat["updatedAt"], search_log_time(op))
+            if kind == 'rename' or entry[2] is not None:
+                self._set_title(chat_id, chat, entry[2], op)
+            if kind != 'add':
+                continue
+            for msg_id, counts in entry[3]:
+                if msg_id in chat["messages"]:
+                    continue
+                length = sum(counts.values())
+                chat["messages"][msg_id] = [chat["next"], op, length]
+                chat["length"] += length
+                self._post(chat_id, chat["next"], counts)
+                chat["next"] += 1
+
+    def encode(self, through):
+        """
+        Compressed base: chats with their message IDs in ordinal order, and per term
+        a flat list [chat, count, ordinal gap, tf, ordinal gap, tf, ...] over dense ordinals.
+        """
+        chat_ids = list(self.chats)
+        chat_index = {chat_id: i for i, chat_id in enumerate(chat_ids)}
+        chats, renumber = [], {}
+        for chat_id in chat_ids:
+            chat = self.chats[chat_id]
+            ordered = sorted(chat["messages"].items(), key=lambda item: item[1][0])
+            if chat["next"] != len(ordered):
+                # Deletes left gaps in the ordinals
+                renumber[chat_id] = {meta[0]: position for position, (_, meta) in enumerate(ordered)}
+                renumber[chat_id][-1] = -1
+            chats.append([chat_id, chat["title"], chat["titleOp"], chat["updatedAt"],
+                          [[msg_id, meta[1], meta[2]] for msg_id, meta in ordered]])
+        postings = {}
+        for term, per_chat in self.postings.items():
+            flat = []
+            for chat_id, per_msg in per_chat.items():
+                flat += [chat_index[chat_id], len(per_msg)]
+                last = 0
+                mapping = renumber.get(chat_id)
+                entries = sorted((mapping[o], tf) for o, tf in per_msg.items()) if mapping else sorted(per_msg.items())
+                for ordinal, tf in entries:
+                    flat += [ordinal + 1 - last, tf]
+                    last = ordinal + 1
+            postings[term] = flat
+        # Ops up to `through` are never replayed on this base, so older tombstones can go
+        tombstones = {chat_id: op for chat_id, op in self.tombstones.items() if op > through}
+        payload = {"v": 1, "chats": chats, "postings": postings, "tombstones": tombstones}
+        return zlib.compress(json.dumps(payload, separators=(',', ':')).encode("utf-8"))
+
+    @classmethod
+    def decode(cls, blob):
+        payload = json.loads(zlib.decompress(blob))
+        index = cls()
+        for chat_id, title, title_op, updated_at, messages in payload["chats"]:
+            chat = index._chat(chat_id)
+            chat.update(title=title, titleOp=title_op, updatedAt=updated_at, next=len(messages))
+            for ordinal, (msg_id, op, length) in enumerate(messages):
+                chat["messages"][msg_id] = [ordinal, op, length]
+                chat["length"] += length
+        chat_ids = [chat[0] for chat in payload["chats"]]
+        for term, flat in payload["postings"].items():
+            per_chat = index.postings[term] = {}
+            i = 0
+            while i < len(flat):
+                per_msg = per_chat[chat_ids[flat[i]]] = {}
+                count, i, last = flat[i + 1], i + 2, 0
+                for _ in range(count):
+                    last += flat[i]
+                    per_msg[last - 1] = flat[i + 1]
+                    i += 2
+        index.tombstones = payload["tombstones"]
+        return index
+
+    def search(self, terms, prefix, limit):
+        """
+        BM25 over each chat's title (boosted) and messages. Chats matching more query
+        words rank first. Returns [(chat_id, score, best matching message ID or None)].
+        """
+        n = len(self.chats)
+        if not n or not terms:
+            return []
+        avg_length = max(1.0, sum(chat["length"] for chat in self.chats.values()) / n)
+        scores, matched, by_message = {}, {}, {}
+        for i, word in enumerate(terms):
+            expansions = [word]
+            if prefix and i == len(terms) - 1:
+                expansions = [term for term in self.postings if term.startswith(word)][:SEARCH_PREFIX_EXPANSIONS]
+            for term in expansions:
+                per_chat = self.postings.get(term)
+                if not per_chat:
+                    continue
+                idf = math.log(1 + (n - len(per_chat) + 0.5) / (len(per_chat) + 0.5))
+                for chat_id, per_msg in per_chat.items():
+                    chat = self.chats[chat_id]
+                    tf = sum(v for o, v in per_msg.items() if o >= 0) + SEARCH_TITLE_BOOST * per_msg.get(-1, 0)
+                    norm = SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * chat["length"] / avg_length)
+                    scores[chat_id] = scores.get(chat_id, 0.0) + idf * tf * (SEARCH_BM25_K1 + 1) / (tf + norm)
+                    matched.setdefault(chat_id, set()).add(i)
+                    message_scores = by_message.setdefault(chat_id, {})
+                    for ordinal, v in per_msg.items():
+                        if ordinal >= 0:
+                            message_scores[ordinal] = message_scores.get(ordinal, 0.0) + idf * v
+        ranked = sorted(scores, key=lambda c: (len(matched[c]), scores[c], self.chats[c]["updatedAt"]), reverse=True)
+        results = []
+        for chat_id in ranked[:limit]:
+            message_scores = by_message.get(chat_id)
+            msg_id = None
+            if message_scores:
+                best = max(message_scores, key=message_scores.get)
+                msg_id = next(m for m, meta in self.chats[chat_id]["messages"].items() if meta[0] == best)
+            results.append((chat_id, scores[chat_id], msg_id))
+        return results
+
+def search_query_terms(query):
+    """(distinct query words, whether the last one may be a prefix of a longer term)."""
+    words = [w for w in SEARCH_TOKEN_RE.findall(query.lower()) if w not in SEARCH_STOPWORDS]
+    return list(dict.fromkeys(words))[:SEARCH_QUERY_MAX_TERMS], not query[-1:].isspace()
+
+def search_snippet(text, terms, prefix):
+    """(snippet of `text` around the first match, [[start, end], ...] of the matches in it)."""
+    if not terms:
+        return text[:SEARCH_SNIPPET_CHARS], []
+    words = [re.escape(t) + ("" if prefix and i == len(terms) - 1 else r"\b") for i, t in enumerate(terms)]
+    pattern = re.compile(r"\b(?:" + "|".join(words) + ")", re.IGNORECASE)
+    text = " ".join((text or "").split())
+    match = pattern.search(text)
+    start = 0
+    if match and match.start() > SEARCH_SNIPPET_CHARS // 3:
+        start = match.start() - SEARCH_SNIPPET_CHARS // 3
+        space = text.find(" ", start, match.start())
+        start = space + 1 if space >= 0 else start
+    end = min(len(text), start + SEARCH_SNIPPET_CHARS)
+    if end < len(text):
+        space = text.rfind(" ", match.end() if match else start, end)
+        end = space if space > 0 else end
+    snippet = ("…" if start else "") + text[start:end] + ("…" if end < len(text) else "")
+    return snippet, [[m.start(), m.end()] for m in pattern.finditer(snippet)]
+
+def queue_search_base_delete(writer, base_ref):
+    with firestore_timer('search_list'):
+        chunk_refs = list(base_ref.collection('chunks').list_documents())
+    for chunk_ref in chunk_refs:
+        writer.delete(chunk_ref)
+    writer.delete(base_ref)
+    return len(chunk_refs) + 1
+
+def queue_search_delete(writer, user_ref):
+    """Queues the deletion of a user's whole search index and log; returns the number of writes."""
+    count = 0
+    with firestore_timer('search_list'):
+        base_refs = list(user_ref.collection('searchIndex').list_documents())
+        log_refs = list(user_ref.collection('searchLog').list_documents(page_size=FIRESTORE_BATCH_LIMIT))
+    for base_ref in base_refs:
+        count += queue_search_base_delete(writer, base_ref)
+    for log_ref in log_refs:
+        writer.delete(log_ref)
+    return count + len(log_refs)
+
+class SearchIndexStore:
+    """Loads, caches, refreshes and compacts user indexes; builds one from the chats on first use."""
+
+    def __init__(self, max_users, refresh_seconds, compact_after):
+        self.max_users = max_users
+        self.refresh_seconds = refresh_seconds
+        self.compact_after = compact_after
+        self._entries = OrderedDict()  # (collection, uid) -> UserSearchIndex
+        self._written = OrderedDict()  # (collection, uid) -> log entries written here since the last check
+        self._maintaining = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.builds = 0
+        self.compactions = 0
+
+    # -- writes --
+    def queue(self, batch, user_ref, ops):
+        """Adds a log entry to `batch` (a Firestore batch or BatchWriter); pass the result to applied()."""
+        log_id = search_log_id()
+        data = zlib.compress(json.dumps(ops, separators=(',', ':')).encode("utf-8"))
+        batch.set(user_ref.collection('searchLog').document(log_id), {"ops": data})
+        return log_id, ops
+
+    def applied(self, user_data, entry):
+        """
+        Applies a committed log entry to this process's copy of the index, if cached.
+        Every SEARCH_COMPACT_AFTER entries written for a user, folds their log in the background.
+        """
+        key = profile_key(user_data)
+        with self._lock:
+            index = self._entries.get(key)
+            written = self._written.pop(key, 0) + 1
+            maintain = written >= self.compact_after and key not in self._maintaining
+            if maintain:
+                self._maintaining.add(key)
+            else:
+                self._written[key] = written
+                while len(self._written) > SEARCH_WRITE_COUNTS_MAX:
+                    self._written.popitem(last=False)
+        if index is not None:
+            with index.lock:
+                index.apply(*entry)
+                index.applied.add(entry[0])
+        if maintain:
+            threading.Thread(target=self._maintain, args=(key, get_user_ref(user_data)),
+                             daemon=True, name="search-maintain").start()
+
+    def _maintain(self, key, user_ref):
+        """Reads the user's log so it gets compacted; builds the index if the user has none."""
+        try:
+            latest = self._latest_base(user_ref)
+            with self._lock:
+                index = self._entries.get(key)
+            if index is not None and index.base == (latest.id if latest else None):
+                self._catch_up(user_ref, index)
+            else:
+                # Not cached here: load it just for this, without evicting a searcher's index
+                self._open(user_ref, latest)
+        except Exception as e:
+            ERRORS.labels(source='search', type=type(e).__name__).inc()
+            print(f"Error maintaining search index {user_ref.id}: {type(e).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._maintaining.discard(key)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # -- reads --
+    def get(self, user_data):
+        """The user's index: cached, refreshed from the log when due, loaded, or built."""
+        key = profile_key(user_data)
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+        user_ref = get_user_ref(user_data)
+        if index is not None and time.time() - index.checked_at < self.refresh_seconds:
+            self.hits += 1
+            return index
+        
+        latest = self._latest_base(user_ref)
+        if index is None or index.base != (latest.id if latest else None):
+            # Not cached, or another worker compacted the log into a newer base
+            index = self._open(user_ref, latest)
+            with self._lock:
+                self._entries[key] = index
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        else:
+            self._catch_up(user_ref, index)
+        return index
+
+    def ensure_built(self, user_ref):
+        """Builds the user's index if it has none yet; True if it did."""
+        if self._latest_base(user_ref) is not None:
+            return False
+        self._build(user_ref)
+        return True
+
+    def _open(self, user_ref, latest):
+        """Loads the latest base, or builds the index if the user has none yet."""
+        for _ in range(3):
+            if latest is None:
+                return self._build(user_ref)
+            index = self._load(user_ref, latest)
+            if index is not None:
+                return index
+            latest = self._latest_base(user_ref)
+        raise Exception("Search index kept changing while loading")
+
+    def _latest_base(self, user_ref):
+        query = user_ref.collection('searchIndex').order_by('__name__', direction='DESCENDING').limit(1)
+        with firestore_timer('search_base'):
+            docs = list(query.stream())
+        return docs[0] if docs else None
+
+    def _load(self, user_ref, header):
+        """Index from a base plus the log after it; None if the base vanished (compacted meanwhile)."""
+        refs = [header.reference.collection('chunks').document(str(i)) for i in range(header.get('chunks'))]
+        with firestore_timer('search_base'):
+            chunks = {snap.id: snap for snap in db.get_all(refs) if snap.exists}
+        if len(chunks) < len(refs):
+            return None
+        index = UserSearchIndex.decode(b"".join(chunks[str(i)].get('data') for i in range(len(refs))))
+        index.base = header.id
+        self._catch_up(user_ref, index)
+        self.loads += 1
+        return index
+
+    def _catch_up(self, user_ref, index):
+        read_at = time.time()
+        query = user_ref.collection('searchLog').order_by('__name__').start_after({'__name__': index.base})
+        with firestore_timer('search_log'):
+            docs = list(query.stream())
+        with index.lock:
+            for doc in docs:
+                if doc.id in index.applied:
+                    continue
+                try:
+                    ops = json.loads(zlib.decompress(doc.get('ops')))
+                except Exception:
+                    ops = None
+                valid = [op for op in ops if search_op_valid(op)] if isinstance(ops, list) else []
+                if not isinstance(ops, list) or len(valid) < len(ops):
+                    # One bad entry must not fail every load of this user's index
+                    ERRORS.labels(source='search', type='MalformedOp').inc()
+                    print(f"Skipping malformed search log ops in {user_ref.id}/{doc.id}")
+                index.apply(doc.id, valid)
+                index.applied.add(doc.id)
+            index.checked_at = read_at
+            compact = len(docs) >= self.compact_after and not index.compacting
+            index.compacting = index.compacting or compact
+        if compact:
+            # Encoding a large index takes a while; searches keep using the log meanwhile
+            threading.Thread(target=self._compact, args=(user_ref, index, [doc.id for doc in docs], read_at),
+                             daemon=True, name="search-compact").start()
+
+    def _write_base(self, user_ref, index, through):
+        """Writes a base named `through`: chunks first, then the header readers look for."""
+        with index.lock:
+            blob = index.encode(through)
+            chats, terms = len(index.chats), len(index.postings)
+        base_ref = user_ref.collection('searchIndex').document(through)
+        chunks = [blob[i:i + SEARCH_CHUNK_BYTES] for i in range(0, len(blob), SEARCH_CHUNK_BYTES)]
+        writer = BatchWriter('search_base_write')
+        for i, chunk in enumerate(chunks):
+            writer.set(base_ref.collection('chunks').document(str(i)), {"data": chunk})
+            if (i + 1) % SEARCH_CHUNKS_PER_COMMIT == 0:
+                writer.flush()
+        writer.flush()
+        writer.set(base_ref, {"chunks": len(chunks), "bytes": len(blob), "chats": chats, "terms": terms,
+                              "createdAt": datetime.datetime.now(datetime.timezone.utc)})
+        writer.flush()
+        with index.lock:
+            index.base = through
+            index.applied = {op for op in index.applied if op > through}
+        return writer
+
+    def _compact(self, user_ref, index, log_ids, read_at):
+        """Folds settled log entries into a new base, then drops older bases and the folded entries."""
+        settled = [op for op in log_ids if op < search_boundary(read_at - SEARCH_LOG_SETTLE_SECONDS)]
+        if not settled:
+            index.compacting = False
+            return
+        previous = index.base
+        through = settled[-1]
+        try:
+            writer = self._write_base(user_ref, index, through)
+            for base_ref in user_ref.collection('searchIndex').list_documents():
+                if base_ref.id < through:
+                    queue_search_base_delete(writer, base_ref)
+            for op in settled:
+                writer.delete(user_ref.collection('searchLog').document(op))
+            writer.flush()
+            self.compactions += 1
+        except Exception as e:
+            # The log is still intact; a later read tries again
+            with index.lock:
+                index.base = previous
+            ERRORS.labels(source='search', type=type(e).__name__).inc()
+            print(f"Error compacting search index {user_ref.id}: {type(e).__name__}: {e}")
+        finally:
+            index.compacting = False
+
+    def _build(self, user_ref):
+        """First index for a user, read from every chat once and saved as a base."""
+        started = time.time()
+        through = search_boundary(started - SEARCH_LOG_SETTLE_SECONDS)
+        index = UserSearchIndex()
+        for chat_doc in iter_chats(user_ref):
+            chat_data = chat_doc.to_dict()
+            if 'messages' in chat_data:
+                migrate_chat_messages(chat_doc.reference, chat_data)
+            messages = [[msg['id'], search_terms(msg.get('content'))] for msg in iter_messages(chat_doc.reference)]
+            title = chat_data.get('title')
+            index.apply(through, [["add", chat_doc.id, title if isinstance(title, str) else '', messages]])
+            if chat_doc.id in index.chats and isinstance(chat_data.get('updatedAt'), datetime.datetime):
+                index.chats[chat_doc.id]["updatedAt"] = chat_data['updatedAt'].timestamp()
+        writer = self._write_base(user_ref, index, through)
+        # Entries before `through` were committed before the chats were read, so the base has them
+        with firestore_timer('search_list'):
+            log_refs = list(user_ref.collection('searchLog').list_documents(page_size=FIRESTORE_BATCH_LIMIT))
+        for log_ref in log_refs:
+            if log_ref.id < through:
+                writer.delete(log_ref)
+        writer.flush()
+        self._catch_up(user_ref, index)
+        self.builds += 1
+        print(f"Built search index for {user_ref.id}: {len(index.chats)} chats, {len(index.postings)} terms "
+              f"in {(time.time() - started) * 1000:.0f}ms")
+        return index
+
+    def search(self, user_data, query, limit):
+        """Ranked results with snippets; reads each hit's chat doc and only its best-matching message."""
+        terms, prefix = search_query_terms(query)
+        if not terms:
+            return []
+        index = self.get(user_data)
+        with index.lock:
+            hits = [(chat_id, score, msg_id, index.chats[chat_id]["title"], index.chats[chat_id]["updatedAt"])
+                    for chat_id, score, msg_id in index.search(terms, prefix, limit)]
+        
+        chats_ref = get_user_ref(user_data).collection('chats')
+        refs = {chats_ref.document(chat_id).collection('messages').document(msg_id): chat_id
+                for chat_id, _, msg_id, _, _ in hits if msg_id}
+        # A chat deleted without going through this server (e.g. from the Firestore
+        # console) never reaches the log, so its hits are checked against the chat doc
+        chat_refs = {chats_ref.document(chat_id): chat_id for chat_id, _, _, _, _ in hits}
+        messages, existing = {}, set()
+        if hits:
+            with firestore_timer('search_snippets'):
+                for snap in db.get_all(list(refs) + list(chat_refs)):
+                    if not snap.exists:
+                        continue
+                    if snap.reference in chat_refs:
+                        existing.add(chat_refs[snap.reference])
+                    else:
+                        messages[refs[snap.reference]] = decode_message(snap.to_dict())
+        
+        results = []
+        for chat_id, score, msg_id, title, updated_at in hits:
+            msg = messages.get(chat_id)
+            if chat_id not in existing or (msg_id and msg is None):
+                continue  # deleted since it was indexed
+            snippet, highlights = search_snippet(msg.get('content', '') if msg else title, terms, prefix)
+            results.append({
+                "chatId": chat_id,
+                "title": title,
+                "updatedAt": datetime.datetime.fromtimestamp(updated_at, datetime.timezone.utc).isoformat(),
+                "score": round(score, 3),
+                "messageId": msg_id,
+                "role": msg.get('role') if msg else None,
+                "snippet": snippet,
+                "highlights": highlights
+            })
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "hits": self.hits,
+                "loads": self.loads,
+                "builds": self.builds,
+                "compactions": self.compactions
+            }
+
+search_index = SearchIndexStore(SEARCH_CACHE_MAX_USERS, SEARCH_REFRESH_SECONDS, SEARCH_COMPACT_AFTER)
+
+def build_all_search_indexes():
+    """One-shot build of the search index of every user that doesn't have one yet."""
+    if not db:
+        raise Exception("Database unavailable")
+    
+    built = 0
+    for collection in ('users', 'temp-users'):
+        for user_ref in db.collection(collection).list_documents():
+            built += search_index.ensure_built(user_ref)
+    print(f"Built {built} search indexes")
+
+# --- HELPER: Chat Export ---
+# Exports are streamed: messages are read a page at a time and written out as
+# they arrive, so memory stays flat however long the chat (or account) is.
+EXPORT_FORMATS = {'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+
+def json_ready(value):
+    """Copy of `value` with Firestore timestamps as ISO 8601 strings (shared by get_chat and exports)."""
+    if isinstance(value, dict):
+        return {k: json_ready(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [json_ready(v) for v in value]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+def iter_chats(user_ref, page_size=CHATS_PAGE_MAX):
+    """Yields every chat document snapshot of a user, reading one page at a time."""
+    cursor = None
+    while True:
+        query = user_ref.collection('chats').order_by('__name__').limit(page_size)
+        if cursor:
+            query = query.start_after({'__name__': cursor})
+        with firestore_timer('chats_list'):
+            docs = list(query.stream())
+        yield from docs
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1].id
+
+def iter_chat_export(chat_ref, chat_data, fmt):
+    """
+    Yields one chat as text chunks.
+    json:   {...chat fields, "id": ..., "messages": [...]}
+    ndjson: a {"type": "chat", ...} line, then one {"type": "message", "chatId": ...} line per message.
+    """
+    if 'messages' in chat_data:
+        migrate_chat_messages(chat_ref, chat_data)
+        chat_data = {k: v for k, v in chat_data.items() if k != 'messages'}
+    meta = json_ready(dict(chat_data, id=chat_ref.id))
+
+    if fmt == 'ndjson':
+        yield json.dumps(dict(meta, type='chat')) + "\n"
+        for msg in iter_messages(chat_ref):
+            yield json.dumps(dict(json_ready(msg), type='message', chatId=chat_ref.id)) + "\n"
+        return
+
+    head = json.dumps(meta)[:-1]
+    yield head + (', ' if meta else '') + '"messages": ['
+    for i, msg in enumerate(iter_messages(chat_ref)):
+        yield (', ' if i else '') + json.dumps(json_ready(msg))
+    yield ']}'
+
+class ZipStream:
+    """Write-only file object for zipfile that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def iter_account_archive(user_ref, fmt):
+    """Yields a zip archive (one chats/<id>.<fmt> entry per chat) as it is built."""
+    out = ZipStream()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for doc in iter_chats(user_ref):
+            with archive.open(f"chats/{doc.id}.{fmt}", 'w') as entry:
+                for text in iter_chat_export(doc.reference, doc.to_dict(), fmt):
+                    entry.write(text.encode("utf-8"))
+                    data = out.drain()
+                    if data:
+                        yield data
+            yield out.drain()
+    yield out.drain()
+
+# --- HELPER: Chat Prompt & Persistence ---
+# Shared by the Flask /api/chat route and the async server in asgi.py.
+TITLE_PROMPT = "Summarize this coding query into a 3-5 word title: '{message}'"
+CHAT_ERROR_TEXT = "\n\nError: I encountered an issue while processing your request. Please try again."
+
+def build_chat_history(history):
+    """Converts client history [{'user': str, 'model': str}, ...] to Gemini format."""
+    chat_history = []
+    for turn in history:
+        # Gemini expects 'user' and 'model' roles
+        chat_history.append({"role": "user", "parts": [turn.get('user', '')]})
+        chat_history.append({"role": "model", "parts": [turn.get('model', '')]})
+    return chat_history
+
+# --- HELPER: Attached Context Store & Retrieval ---
+# Editor buffers and uploaded files are stored by the SHA-256 of their content,
+# so after the first upload a client can send {"hash": ...} instead of the
+# content. Attachments larger than CONTEXT_TOKEN_BUDGET are split into line
+# chunks and only the chunks most relevant to the message (BM25 over a local
+# lexical index) are put in the prompt.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 3000))  # per attachment
+CONTEXT_STORE_MAX_BYTES = int(os.environ.get("CONTEXT_STORE_MAX_BYTES", 32 * 1024 * 1024))
+CONTEXT_CHUNK_LINES = 40
+CONTEXT_CHUNK_MAX_CHARS = 2000
+CONTEXT_FIRESTORE_MAX_BYTES = 900_000  # stay under Firestore's 1 MiB document limit
+BM25_K1 = 1.2
+BM25_B = 0.75
+CONTEXT_STOPWORDS = {
+    "the", "and", "for", "this", "that", "with", "what", "why", "how", "does", "not",
+    "are", "can", "you", "my", "in", "is", "it", "of", "to", "a", "an", "do", "me", "i"
+}
+
+class UnknownContextError(Exception):
+    """A context hash was sent that this server has no content for."""
+
+    def __init__(self, field):
+        super().__init__(f"Unknown {field} hash")
+        self.field = field
+
+class InvalidContextError(Exception):
+    """A context value whose content is not a string."""
+
+    def __init__(self, field):
+        super().__init__(f"{field} content must be a string")
+        self.field = field
+
+CONTEXT_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")  # context_hash() output
+
+def context_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def lexical_terms(text):
+    """Lowercased identifier/word terms, with camelCase and snake_case split apart."""
+    terms = []
+    for word in re.findall(r"[A-Za-z_][A-Za-z0-9_]*|\d+", text):
+        parts = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", word)
+        for term in [word] + (parts if len(parts) > 1 else []):
+            term = term.lower()
+            if len(term) > 1 and term not in CONTEXT_STOPWORDS:
+                terms.append(term)
+    return terms
+
+def chunk_lines(content):
+    """Splits text into (first_line, last_line, text) chunks of a few dozen lines."""
+    chunks = []
+    buf, size, first, last = [], 0, 1, 1
+    for number, line in enumerate(content.split("\n"), start=1):
+        # Hard-wrap very long lines (minified code) so one line can't exceed a chunk
+        pieces = [line[i:i + CONTEXT_CHUNK_MAX_CHARS] for i in range(0, len(line), CONTEXT_CHUNK_MAX_CHARS)] or [""]
+        for piece in pieces:
+            if buf and (len(buf) >= CONTEXT_CHUNK_LINES or size + len(piece) > CONTEXT_CHUNK_MAX_CHARS):
+                chunks.append((first, last, "\n".join(buf)))
+                buf, size, first = [], 0, number
+            buf.append(piece)
+            size += len(piece) + 1
+            last = number
+    if buf:
+        chunks.append((first, last, "\n".join(buf)))
+    return chunks
+
+class ContextIndex:
+    """BM25 index over the line chunks of one attachment."""
+
+    def __init__(self, content):
+        self.chunks = chunk_lines(content)
+        self.term_freqs = []
+        self.doc_freq = {}
+        for _, _, text in self.chunks:
+            freqs = {}
+            for term in lexical_terms(text):
+                freqs[term] = freqs.get(term, 0) + 1
+            self.term_freqs.append(freqs)
+            for term in freqs:
+                self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+        self.lengths = [sum(freqs.values()) for freqs in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+
+    def score(self, query):
+        terms = set(lexical_terms(query))
+        total = len(self.chunks)
+        scores = []
+        for freqs, length in zip(self.term_freqs, self.lengths):
+            score = 0.0
+            for term in terms:
+                tf = freqs.get(term)
+                if not tf:
+                    continue
+                idf = math.log(1 + (total - self.doc_freq[term] + 0.5) / (self.doc_freq[term] + 0.5))
+                norm = 1 - BM25_B + BM25_B * (length / self.avg_length if self.avg_length else 1)
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+            scores.append(score)
+        return scores
+
+    def select(self, query, budget_tokens):
+        """Best-scoring chunks that fit the budget, in file order (file head if nothing matches)."""
+        scores = self.score(query)
+        order = sorted(range(len(self.chunks)), key=lambda i: (-scores[i], i))
+        picked, used = [], 0
+        for i in order:
+            cost = estimate_tokens(self.chunks[i][2])
+            if used + cost > budget_tokens:
+                continue
+            picked.append(i)
+            used += cost
+        return [self.chunks[i] for i in sorted(picked)]
+
+class ContextEntry:
+    def __init__(self, content):
+        self.content = content
+        self.hash = context_hash(content)
+        self.tokens = estimate_tokens(content)
+        self._index = None
+
+    @property
+    def index(self):
+        # Built on first use; small attachments never need one
+        if self._index is None:
+            self._index = ContextIndex(self.content)
+        return self._index
+
+    @property
+    def size(self):
+        return len(self.content) * (3 if self._index is not None else 1)
+
+class ContextStore:
+    """Per-user LRU of attachments by content hash, backed by users/{uid}/contexts/{hash}."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (uid, hash) -> ContextEntry
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context")
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            total = sum(e.size for e in self._entries.values())
+            while total > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted.size
+
+    def _persist(self, user_data, entry):
+        try:
+            with firestore_timer('context_save'):
+                get_user_ref(user_data).collection('contexts').document(entry.hash).set({
+                    "content": entry.content,
+                    "size": len(entry.content),
+                    "createdAt": datetime.datetime.now(datetime.timezone.utc)
+                })
+        except Exception as e:
+            print(f"Error saving context {entry.hash[:12]}: {type(e).__name__}: {e}")
+
+    def put(self, user_data, content):
+        """Stores content (if new) and returns its entry."""
+        key = (user_data['uid'], context_hash(content))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = ContextEntry(content)
+        self._remember(key, entry)
+        if db and len(content.encode("utf-8")) <= CONTEXT_FIRESTORE_MAX_BYTES:
+            self._executor.submit(self._persist, user_data, entry)
+        return entry
+
+    def get(self, user_data, content_hash):
+        """Returns the entry for a hash from memory or Firestore, or None if unknown."""
+        key = (user_data['uid'], content_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        if not db:
+            return None
+        with firestore_timer('context_get'):
+            doc = get_user_ref(user_data).collection('contexts').document(content_hash).get()
+        if not doc.exists:
+            return None
+        entry = ContextEntry(doc.to_dict().get('content', ''))
+        self._remember(key, entry)
+        return entry
+
+    def forget_user(self, uid):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == uid]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "bytes": sum(e.size for e in self._entries.values()),
+                    "hits": self.hits, "misses": self.misses}
+
+context_store = ContextStore(CONTEXT_STORE_MAX_BYTES)
+
+def resolve_context(user_data, value, field):
+    """
+    Resolves a codeContext/fileContext value (plain string, {"name", "content"}
+    or {"name", "hash"}) to (name, entry), or None when empty.
+    Raises UnknownContextError for a hash the server doesn't have, or one that
+    isn't a context_hash() at all (it is used as a Firestore document ID), and
+    InvalidContextError for content that is not a string.
+    """
+    if not value:
+        return None
+    if isinstance(value, dict):
+        name, content, content_hash = value.get('name'), value.get('content'), value.get('hash')
+    else:
+        name, content, content_hash = None, value, None
+    
+    if content:
+        if not isinstance(content, str):
+            raise InvalidContextError(field)
+        return name, context_store.put(user_data, content)
+    if content_hash:
+        if not isinstance(content_hash, str) or not CONTEXT_HASH_PATTERN.fullmatch(content_hash):
+            raise UnknownContextError(field)
+        entry = context_store.get(user_data, content_hash)
+        if entry is None:
+            raise UnknownContextError(field)
+        return name, entry
+    return None
+
+def render_context(label, entry, query):
+    """Formats one attachment for the prompt, reduced to relevant excerpts if it is large."""
+    if entry.tokens <= CONTEXT_TOKEN_BUDGET:
+        return f"\n\n[{label}]:\n{entry.content}\n"
+    
+    excerpts = "\n...\n".join(f"(lines {first}-{last})\n{text}" for first, last, text in entry.index.select(query, CONTEXT_TOKEN_BUDGET))
+    total_lines = entry.content.count("\n") + 1
+    return f"\n\n[{label} - excerpts relevant to the question, {total_lines} lines in total]:\n{excerpts}\n"
+
+def build_context_str(user_data, data, query):
+    """
+    Builds the editor / uploaded-file context appended to the user's message.
+    Returns (context_str, hashes) where hashes maps field -> content hash.
+    """
+    context_str = ""
+    hashes = {}
+    code = resolve_context(user_data, data.get('codeContext', ''), 'codeContext')
+    if code:
+        context_str += render_context("CURRENT EDITOR CONTENT", code[1], query)
+        hashes['codeContext'] = code[1].hash
+    
+    uploaded = resolve_context(user_data, data.get('fileContext', ''), 'fileContext')
+    if uploaded:
+        # Handle both string and object formats
+        name, entry = uploaded
+        if isinstance(data.get('fileContext'), dict):
+            label = f"UPLOADED FILE: {name or 'uploaded_file'}"
+        else:
+            label = "UPLOADED FILE CONTENT"
+        context_str += render_context(label, entry, query)
+        hashes['fileContext'] = entry.hash
+    return context_str, hashes
+
+CONTEXT_HASH_HEADERS = {'codeContext': 'X-Code-Context-Hash', 'fileContext': 'X-File-Context-Hash'}
+
+def context_error(e):
+    if isinstance(e, InvalidContextError):
+        return (400, {"error": "Bad Request", "message": str(e), "field": e.field})
+    field = e.field
+    return (422, {
+        "error": "Unknown Context",
+        "message": f"The server has no content for this {field} hash. Send the full content instead.",
+        "field": field
+    })
+
+# --- HELPER: Server-Side Conversation State ---
+# Clients may omit 'history' from /api/chat and send just the new message; the
+# server then rebuilds the Gemini history from the stored session. Recent
+# sessions are kept in an LRU in front of Firestore and updated as turns
+# complete. The version of a session's history is its message count.
+HISTORY_CACHE_MAX_ENTRIES = int(os.environ.get("HISTORY_CACHE_MAX_ENTRIES", 256))
+
+class HistoryVersionConflict(Exception):
+    """The client's historyVersion doesn't match the stored session."""
+
+    def __init__(self, version):
+        super().__init__(f"Stored history is at version {version}")
+        self.version = version
+
+def chat_key(user_data, session_id):
+    """Identifies a chat session across collections (users vs temp-users)."""
+    return (user_data['is_guest'], user_data['uid'], session_id)
+
+def to_gemini_history(messages):
+    return [{"role": msg['role'], "parts": [msg['content']]} for msg in messages]
+
+class HistoryCache:
+    """Thread-safe LRU of (version, Gemini-format history) per chat session."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # chat_key -> (version, history)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], list(entry[1])
+
+    def put(self, key, version, history):
+        with self._lock:
+            self._entries[key] = (version, list(history))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def append_turn(self, key, turn):
+        """Adds a completed exchange to a cached session (no-op if not cached)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0] + len(turn), entry[1] + to_gemini_history(turn))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+history_cache = HistoryCache(HISTORY_CACHE_MAX_ENTRIES)
+
+def load_session_history(user_data, session_id):
+    """Rebuilds (version, history) from Firestore plus turns still waiting in the write queue."""
+    # Snapshot the queue first: a turn written between the two reads is then in
+    # both (and deduplicated by message ID) instead of in neither
+    pending = chat_write_queue.pending_turns(chat_key(user_data, session_id))
+    chat_ref = get_user_ref(user_data).collection('chats').document(session_id)
+    with firestore_timer('history_load'):
+        doc = chat_ref.get()
+    messages = []
+    if doc.exists:
+        migrate_chat_messages(chat_ref, doc.to_dict())
+        messages, _ = load_messages(chat_ref)
+    
+    stored = {msg['id'] for msg in messages}
+    for turn in pending:
+        if make_message_id(turn[-1]['timestamp'], len(turn) - 1) not in stored:
+            messages.extend(turn)
+    return len(messages), to_gemini_history(messages)
+
+def get_session_history(user_data, session_id, client_version=None):
+    """
+    Returns (version, history) for a session, from the cache when it agrees with
+    the client's version. Raises HistoryVersionConflict if the stored history
+    doesn't match client_version either.
+    """
+    key = chat_key(user_data, session_id)
+    cached = history_cache.get(key)
+    if cached and (client_version is None or cached[0] == client_version):
+        return cached
+    
+    # Missing or stale (e.g. the last turn went through another worker)
+    version, history = load_session_history(user_data, session_id)
+    history_cache.put(key, version, history)
+    if client_version is not None and version != client_version:
+        raise HistoryVersionConflict(version)
+    return version, history
+
+def resolve_chat_history(user_data, data):
+    """
+    Picks the Gemini history for a /api/chat body: the client's 'history' list
+    if sent, otherwise the stored session's. Returns (history, version, error);
+    version is None for client-supplied history, error is (status, payload) or None.
+    """
+    if 'history' in data:
+        return build_chat_history(data.get('history') or []), None, None
+    
+    session_id = data.get('sessionId')
+    client_version = data.get('historyVersion')
+    if client_version is not None and (not isinstance(client_version, int) or isinstance(client_version, bool)):
+        return None, None, (400, {"error": "Bad Request", "message": "historyVersion must be an integer"})
+    if not session_id:
+        return [], 0, None
+    if not db:
+        return None, None, (503, {"error": "Database unavailable"})
+    
+    try:
+        version, history = get_session_history(user_data, session_id, client_version)
+        return history, version, None
+    except HistoryVersionConflict as e:
+        return None, None, (409, {
+            "error": "Conflict",
+            "message": "Chat history is out of date. Reload the chat and try again.",
+            "historyVersion": e.version
+        })
+    except Exception as e:
+        print(f"Error loading chat history: {type(e).__name__}: {e}")
+        return None, None, (500, {"error": "Internal Server Error", "message": "Failed to load chat history"})
+
+# --- HELPER: History Compaction ---
+# Keeps the history sent to Gemini within a token budget. The newest turns are
+# kept verbatim; older ones are folded into a rolling summary stored on the chat
+# document ('historySummary' covering the first 'historySummaryUpTo' messages).
+# The summary and the verbatim turns share the budget; only the newest
+# HISTORY_MIN_RECENT_TURNS turns are sent even if they alone exceed it. The
+# summary is extended in the background about every HISTORY_FOLD_MIN_TOKENS of
+# new conversation, so it is not regenerated every turn.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 6000))
+HISTORY_MIN_RECENT_TURNS = int(os.environ.get("HISTORY_MIN_RECENT_TURNS", 2))  # always verbatim
+HISTORY_FOLD_MIN_TOKENS = int(os.environ.get("HISTORY_FOLD_MIN_TOKENS", 1500))  # unsummarized tokens before a fold
+SUMMARY_CACHE_MAX_ENTRIES = 512
+CHARS_PER_TOKEN = 4  # rough estimate for English text and code
+
+SUMMARY_PROMPT = """Update the running summary of a coding conversation between a user and an AI assistant.
+Keep the user's goals, languages, file and function names, errors seen, decisions made and any code the user is still working on.
+Reply with the updated summary only, in under 300 words.
+
+[CURRENT SUMMARY]:
+{summary}
+
+[NEW MESSAGES]:
+{messages}"""
+
+def estimate_tokens(text):
+    """Cheap local token estimate (no API round trip)."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def history_tokens(history):
+    return sum(estimate_tokens(part) for msg in history for part in msg['parts'])
+
+def split_turns(history):
+    """Groups Gemini history into turns, each starting at a user message."""
+    turns = []
+    for msg in history:
+        if msg['role'] == 'user' or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+class HistoryCompactor:
+    """Applies the history token budget, maintaining per-chat rolling summaries."""
+
+    def __init__(self, budget, min_recent_turns, fold_min_tokens, max_entries):
+        self.budget = budget
+        self.min_recent_turns = min_recent_turns
+        self.fold_min_tokens = fold_min_tokens
+        self.max_entries = max_entries
+        self._summaries = OrderedDict()  # chat_key -> (summary, up_to)
+        self._folding = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+        self.folds = 0
+
+    def _get_summary(self, user_data, session_id):
+        key = chat_key(user_data, session_id)
+        with self._lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key]
+        
+        summary = ("", 0)
+        if db:
+            with firestore_timer('summary_get'):
+                doc = get_user_ref(user_data).collection('chats').document(session_id).get()
+            if doc.exists:
+                chat_data = doc.to_dict()
+                summary = (chat_data.get('historySummary', ""), chat_data.get('historySummaryUpTo', 0))
+        self._remember(key, summary)
+        return summary
+
+    def _remember(self, key, summary):
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._summaries.pop(key, None)
+
+    def _fold(self, user_data, session_id, summary, messages, up_to):
+        """Extends a chat's summary with `messages` so it covers the first `up_to` messages."""
+        key = chat_key(user_data, session_id)
+        try:
+            transcript = "\n\n".join(f"{msg['role'].upper()}: {msg['parts'][0]}" for msg in messages)
+            new_summary = gemini.generate(SUMMARY_PROMPT.format(summary=summary or "(none yet)", messages=transcript)).strip()
+            self._remember(key, (new_summary, up_to))
+            if db:
+                with firestore_timer('summary_save'):
+                    get_user_ref(user_data).collection('chats').document(session_id).update({
+                        "historySummary": new_summary,
+                        "historySummaryUpTo": up_to
+                    })
+            with self._lock:
+                self.folds += 1
+        except Exception as e:
+            print(f"History summary failed for session {session_id}: {type(e).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._folding.discard(key)
+
+    def _tail_length(self, turns, limit):
+        """Number of messages in the newest turns that fit in `limit` tokens (at least min_recent_turns turns)."""
+        length, used = 0, 0
+        for kept, turn in enumerate(reversed(turns)):
+            cost = history_tokens(turn)
+            if used + cost > limit and kept >= self.min_recent_turns:
+                break
+            used += cost
+            length += len(turn)
+        return length
+
+    def compact(self, user_data, session_id, history):
+        """
+        Returns (history, usage) with history trimmed to the budget. usage reports
+        estimated tokens before and after compaction.
+        """
+        raw_tokens = history_tokens(history)
+        usage = {"historyTokens": raw_tokens, "compactedTokens": raw_tokens, "summaryTokens": 0, "droppedMessages": 0}
+        CHAT_HISTORY_TOKENS.labels(stage='raw').observe(raw_tokens)
+        # Folds start `reserve` tokens before the budget is reached, leaving room for
+        # turns that arrive while the fold runs
+        reserve = self.fold_min_tokens // 2
+        if raw_tokens <= self.budget - reserve:
+            CHAT_HISTORY_TOKENS.labels(stage='compacted').observe(raw_tokens)
+            return history, usage
+        
+        summary, up_to = ("", 0)
+        if session_id:
+            try:
+                summary, up_to = self._get_summary(user_data, session_id)
+            except Exception as e:
+                print(f"Error loading history summary: {type(e).__name__}: {e}")
+        if up_to > len(history):
+            summary, up_to = ("", 0)  # summary of a different history, ignore it
+        
+        compacted = []
+        if summary:
+            compacted = [
+                {"role": "user", "parts": [f"[SUMMARY OF EARLIER CONVERSATION]:\n{summary}"]},
+                {"role": "model", "parts": ["Understood, I'll keep that context in mind."]}
+            ]
+        
+        # The summary counts against the budget; the rest goes to the newest messages it
+        # doesn't cover. Older unsummarized ones are only dropped when they no longer fit.
+        available = self.budget - history_tokens(compacted)
+        turns = split_turns(history[up_to:])
+        
+        # Folding down to fold_min_tokens below the trigger point means the next fold is
+        # at least that far off. A failed fold is simply retried on the next turn.
+        if session_id and history_tokens(history[up_to:]) > available - reserve:
+            fold_to = len(history) - self._tail_length(turns, available - reserve - self.fold_min_tokens)
+            key = chat_key(user_data, session_id)
+            with self._lock:
+                start_fold = fold_to > up_to and key not in self._folding
+                if start_fold:
+                    self._folding.add(key)
+            if start_fold:
+                self._executor.submit(self._fold, user_data, session_id, summary, history[up_to:fold_to], fold_to)
+        
+        if raw_tokens <= self.budget:
+            CHAT_HISTORY_TOKENS.labels(stage='compacted').observe(raw_tokens)
+            return history, usage
+        
+        start = len(history) - self._tail_length(turns, available)
+        compacted += history[start:]
+        usage["compactedTokens"] = history_tokens(compacted)
+        CHAT_HISTORY_TOKENS.labels(stage='compacted').observe(usage["compactedTokens"])
+        usage["summaryTokens"] = estimate_tokens(summary)
+        usage["droppedMessages"] = start - up_to
+        return compacted, usage
+
+history_compactor = HistoryCompactor(HISTORY_TOKEN_BUDGET, HISTORY_MIN_RECENT_TURNS, HISTORY_FOLD_MIN_TOKENS, SUMMARY_CACHE_MAX_ENTRIES)
+
+def log_chat_usage(session_id, usage, ttfb, total_time, response_text):
+    """Per-request token report, for tuning HISTORY_TOKEN_BUDGET against time to first chunk."""
+    ttfb_ms = f"{ttfb * 1000:.0f}ms" if ttfb is not None else "n/a"
+    print(f"Chat usage (session {session_id}): history {usage['historyTokens']} -> {usage['compactedTokens']} tokens "
+          f"(summary {usage['summaryTokens']}, dropped {usage['droppedMessages']} msgs), "
+          f"prompt {usage['promptTokens']} tokens, response {estimate_tokens(response_text)} tokens, "
+          f"ttfb {ttfb_ms}, total {total_time * 1000:.0f}ms")
+
+# --- HELPER: Response Cache ---
+# Opt-in (RESPONSE_CACHE_ENABLED=true) cache of whole answers to standalone
+# questions: a first message with no history and no attachments. The key
+# covers everything that shapes the answer (system prompt, model, generation
+# config, history, normalized message, context). Hits are replayed as a
+# stream, so clients can't tell them from a live answer.
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))  # seconds
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+RESPONSE_CACHE_REPLAY_CHARS = 200  # size of the chunks a cached answer is replayed in
+RESPONSE_CACHE_ENTRY_OVERHEAD = 200  # rough per-entry bytes beyond the answer itself
+
+RESPONSE_CACHE_REQUESTS = Counter('ada_response_cache_requests_total', 'Response cache lookups', ['result'])
+
+def normalize_message(text):
+    """Case- and whitespace-insensitive form of a question, for cache keys."""
+    return " ".join(text.split()).casefold()
+
+def replay_chunks(text):
+    return [text[i:i + RESPONSE_CACHE_REPLAY_CHARS] for i in range(0, len(text), RESPONSE_CACHE_REPLAY_CHARS)]
+
+class ResponseCache:
+    """Thread-safe LRU of answers with a TTL and a memory budget in bytes."""
+
+    def __init__(self, enabled, ttl, max_bytes):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, text, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def key_for(self, history, message, context_str):
+        payload = json.dumps({
+            "system": SYSTEM_PROMPT,
+            "model": GEMINI_MODEL_NAME,
+            "config": generation_config,
+            "history": history,
+            "message": normalize_message(message),
+            "context": context_str
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, history, message, context_str, data):
+        """Returns (key, cached answer or None); key is None when the request must not use the cache."""
+        if not self.enabled:
+            return None, None
+        if history or context_str or data.get('noCache'):
+            self._count('bypass')
+            return None, None
+        key = self.key_for(history, message, context_str)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        self._count('hit' if entry is not None else 'miss')
+        return key, entry[1] if entry is not None else None
+
+    def put(self, key, text):
+        size = len(text.encode("utf-8")) + RESPONSE_CACHE_ENTRY_OVERHEAD
+        if not text or size > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.time() + self.ttl, text, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _count(self, result):
+        with self._lock:
+            if result == 'hit':
+                self.hits += 1
+            elif result == 'miss':
+                self.misses += 1
+            else:
+                self.bypassed += 1
+        RESPONSE_CACHE_REQUESTS.labels(result=result).inc()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+
+def publish_cached_answer(stream, text, history_version=None):
+    """Replays a cached answer into an event stream as if it were being generated."""
+    for piece in replay_chunks(text):
+        stream.publish('delta', {"text": piece})
+    stream.publish('done', done_event(text, history_version), final=True)
+
+# --- HELPER: Chat Titles ---
+# A new chat's title is requested as soon as its first message arrives, in
+# parallel with the answer stream. Requests for the same message share one
+# upstream call (single-flight) and the result is kept briefly, so the
+# persistence path and /api/generate-title don't generate it twice.
+TITLE_CACHE_TTL = int(os.environ.get("TITLE_CACHE_TTL", 300))  # seconds
+TITLE_CACHE_MAX_ENTRIES = 512
+TITLE_WORKERS = 4
+TITLE_PATCH_ATTEMPTS = 3
+
+class TitleGenerator:
+    """Single-flight title generation with a short-lived cache keyed by message hash."""
+
+    def __init__(self, ttl, max_entries, max_workers):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="title")
+        self._entries = OrderedDict()  # key -> (expires_at, future)
+        self._lock = threading.Lock()
+        self.generated = 0
+        self.shared = 0
+
+    @staticmethod
+    def key_for(message):
+        return hashlib.sha256(message.encode("utf-8")).hexdigest()
+
+    def _generate(self, message):
+        with observe(TITLE_LATENCY, 'title'):
+            return gemini.generate(TITLE_PROMPT.format(message=message)).strip()
+
+    def submit(self, message):
+        """Starts (or joins) title generation for a message and returns its Future."""
+        key = self.key_for(message)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (not entry[1].done() or entry[0] > now):
+                self._entries.move_to_end(key)
+                self.shared += 1
+                return entry[1]
+            inline = False
+            try:
+                future = self._executor.submit(self._generate, message)
+            except RuntimeError:
+                # Pool already shut down (interpreter exit while the write queue flushes):
+                # generate in this thread, after releasing the lock
+                future = Future()
+                inline = True
+            self._entries[key] = (now + self.ttl, future)
+            self.generated += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        future.add_done_callback(lambda f: self._forget_failure(key, f))
+        if inline:
+            try:
+                future.set_result(self._generate(message))
+            except Exception as e:
+                future.set_exception(e)
+        return future
+
+    def _forget_failure(self, key, future):
+        # Failed generations are not cached, so the next caller retries
+        if future.exception() is not None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[1] is future:
+                    del self._entries[key]
+
+    def get(self, message, timeout=None):
+        """Returns the title for a message, raising if generation failed or timed out."""
+        return self.submit(message).result(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "generated": self.generated, "shared": self.shared}
+
+title_generator = TitleGenerator(TITLE_CACHE_TTL, TITLE_CACHE_MAX_ENTRIES, TITLE_WORKERS)
+
+def make_chat_turn(user_msg, response_text):
+    """Builds the user/model message pair for one exchange, timestamped now."""
+    msg_data = {
+        "role": "user",
+        "content": user_msg,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc)
+    }
+    
+    # We store the raw AI response. The client parses the code blocks.
+    ai_data = {
+        "role": "model",
+        "content": response_text, 
+        "timestamp": datetime.datetime.now(datetime.timezone.utc)
+    }
+    return [msg_data, ai_data]
+
+def patch_chat_title(user_data, session_id, future):
+    """
+    Replaces a new chat's 'New Chat' placeholder once its generated title arrives.
+    Conditional on the chat being unchanged since it was read, so a rename wins.
+    """
+    try:
+        title = future.result()
+    except Exception as title_err:
+        print(f"⚠️  Title generation failed: {title_err}")
+        return
+    try:
+        user_ref = get_user_ref(user_data)
+        chat_ref = user_ref.collection('chats').document(session_id)
+        for _ in range(TITLE_PATCH_ATTEMPTS):
+            with firestore_timer('chat_title_patch'):
+                doc = chat_ref.get()
+            if not doc.exists or doc.get('title') != "New Chat":
+                return  # deleted or renamed meanwhile
+            batch = db.batch()
+            batch.update(chat_ref, {"title": title}, option=db.write_option(last_update_time=doc.update_time))
+            search_entry = search_index.queue(batch, user_ref, [["rename", session_id, title]])
+            try:
+                with firestore_timer('chat_title_patch'):
+                    batch.commit()
+            except api_exceptions.FailedPrecondition:
+                continue  # another turn updated the chat; read it again
+            search_index.applied(user_data, search_entry)
+            return
+    except Exception as e:
+        print(f"Error saving title for session {session_id}: {type(e).__name__}: {e}")
+
+def persist_chat_turns(user_data, session_id, turns):
+    """
+    Writes one or more exchanges for a session in a single batch, creating the
+    chat if new. Raises on Firestore errors so callers can retry. Turns that an
+    earlier attempt already stored (a commit whose outcome was unknown) are
+    skipped, so retries never count messages twice.
+    """
+    # Get correct reference (users vs temp-users)
+    user_ref = get_user_ref(user_data)
+    doc_ref = user_ref.collection('chats').document(session_id)
+    # A turn's messages are committed together, so its last message shows whether it was stored
+    turn_refs = [doc_ref.collection('messages').document(make_message_id(turn[-1]['timestamp'], len(turn) - 1))
+                 for turn in turns]
+    with firestore_timer('chat_turn_get'):
+        snaps = {snap.reference: snap for snap in db.get_all([doc_ref] + turn_refs)}
+    doc = snaps[doc_ref]
+    turns = [turn for turn, ref in zip(turns, turn_refs) if not snaps[ref].exists]
+    if not turns:
+        print(f"Chat turns for session {session_id} were already saved")
+        return
+    messages = [msg for turn in turns for msg in turn]
+    last_ts = messages[-1]['timestamp']
+    
+    batch = db.batch()
+    new_title = None
+    title_future = None
+    if not doc.exists:
+        # First message - the title was usually generated while the answer streamed.
+        # If it is still pending, save 'New Chat' now and patch the title in later,
+        # so a slow title never holds up the writes queued behind this one.
+        chat_title = "New Chat"
+        title_future = title_generator.submit(messages[0]['content'])
+        if title_future.done():
+            try:
+                chat_title = title_future.result()
+            except Exception as title_err:
+                print(f"⚠️  Title generation failed: {title_err}")
+            title_future = None
+        new_title = chat_title
+        
+        batch.set(doc_ref, {
+            "title": chat_title,
+            "createdAt": messages[0]['timestamp'],
+            "updatedAt": datetime.datetime.now(datetime.timezone.utc),
+            "userId": user_data['uid'],
+            "isGuest": user_data['is_guest'], # Mark for easy identification
+            "isPinned": False,
+            "messageCount": len(messages),
+            "lastMessageAt": last_ts
+        })
+    else:
+        # Older chats may still keep their messages in an array
+        migrate_chat_messages(doc_ref, doc.to_dict())
+        batch.update(doc_ref, {
+            "messageCount": firestore.Increment(len(messages)),
+            "lastMessageAt": last_ts,
+            "updatedAt": datetime.datetime.now(datetime.timezone.utc)
+        })
+    message_ids = []
+    for turn in turns:
+        message_ids += append_messages(batch, doc_ref, turn)
+    search_entry = search_index.queue(batch, user_ref, [[
+        "add", session_id, new_title,
+        [[message_id, search_terms(msg['content'])] for message_id, msg in zip(message_ids, messages)]
+    ]])
+    with firestore_timer('chat_turn_commit'):
+        batch.commit()
+    search_index.applied(user_data, search_entry)
+    if title_future is not None:
+        title_future.add_done_callback(lambda future: patch_chat_title(user_data, session_id, future))
+    print(f"Chat saved to Firestore for session: {session_id} (Guest: {user_data['is_guest']}, turns: {len(turns)})")
+
+# --- HELPER: Write-Behind Chat Persistence ---
+# Completed turns are handed to a background thread so the response can close
+# without waiting on Firestore. Turns for the same session that queue up
+# together are coalesced into one batch; failed writes are retried with
+# exponential backoff, and pending writes are flushed on shutdown.
+WRITE_QUEUE_MAX_PENDING = int(os.environ.get("WRITE_QUEUE_MAX_PENDING", 1000))
+WRITE_QUEUE_BATCH_WAIT = float(os.environ.get("WRITE_QUEUE_BATCH_WAIT", 0.05))  # seconds to let writes coalesce
+WRITE_QUEUE_MAX_RETRIES = int(os.environ.get("WRITE_QUEUE_MAX_RETRIES", 5))
+WRITE_QUEUE_BACKOFF_BASE = 0.5   # seconds, doubled per attempt
+WRITE_QUEUE_BACKOFF_MAX = 30.0
+WRITE_QUEUE_MAX_TURNS_PER_WRITE = 100  # keeps one write well under Firestore's 500-op batch limit
+
+class ChatWriteQueue:
+    """Background persistence pipeline for completed chat turns."""
+
+    def __init__(self, max_pending, batch_wait, max_retries):
+        self.max_pending = max_pending
+        self.batch_wait = batch_wait
+        self.max_retries = max_retries
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._in_flight = []
+        self.enqueued = 0
+        self.written = 0
+        self.retries = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        # Started lazily (and again after a fork) since threads don't survive gunicorn preloading
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="chat-write-queue", daemon=True)
+            self._thread.start()
+
+    def submit(self, user_data, session_id, turn):
+        """Queues one turn. Returns False when the queue is full or shutting down."""
+        item = {
+            "key": chat_key(user_data, session_id),
+            "user_data": user_data,
+            "session_id": session_id,
+            "turns": [turn],
+            "attempts": 0,
+            "not_before": 0.0,
+            "enqueued_at": time.time()
+        }
+        with self._cond:
+            if self._stopping or len(self._pending) >= self.max_pending:
+                return False
+            self._ensure_started()
+            self._pending.append(item)
+            self.enqueued += 1
+            WRITE_QUEUE_DEPTH.inc()
+            self._cond.notify_all()
+        return True
+
+    def _take_ready(self):
+        """Blocks until some items are due, then removes and coalesces them per session."""
+        with self._cond:
+            while True:
+                now = time.time()
+                if any(item['not_before'] <= now for item in self._pending):
+                    break
+                if self._stopping and not self._pending:
+                    return None
+                wait = min((item['not_before'] for item in self._pending), default=now + 1.0) - now
+                self._cond.wait(max(wait, 0.01))
+        
+        # Give concurrent turns for the same session a moment to arrive
+        if self.batch_wait:
+            time.sleep(self.batch_wait)
+        
+        with self._cond:
+            now = time.time()
+            groups = OrderedDict()
+            remaining = deque()
+            held = set()  # sessions with an earlier turn still waiting, so order is kept
+            for item in self._pending:
+                group = groups.get(item['key'])
+                if (item['key'] in held or item['not_before'] > now
+                        or (group and len(group['turns']) >= WRITE_QUEUE_MAX_TURNS_PER_WRITE)):
+                    held.add(item['key'])
+                    remaining.append(item)
+                elif group is None:
+                    groups[item['key']] = dict(item, turns=list(item['turns']))
+                else:
+                    group['turns'].extend(item['turns'])
+                    group['attempts'] = max(group['attempts'], item['attempts'])
+                    group['enqueued_at'] = min(group['enqueued_at'], item['enqueued_at'])
+            self._pending = remaining
+            ready = list(groups.values())
+            self._in_flight.extend(ready)
+            return ready
+
+    def _run(self):
+        while True:
+            groups = self._take_ready()
+            if groups is None:
+                return
+            for group in groups:
+                try:
+                    persist_chat_turns(group['user_data'], group['session_id'], group['turns'])
+                    outcome = "written"
+                except Exception as e:
+                    print(f"Database Save Error (attempt {group['attempts'] + 1}): {type(e).__name__}: {e}")
+                    outcome = "failed"
+                with self._cond:
+                    self._in_flight.remove(group)
+                    if outcome == "written":
+                        self.written += len(group['turns'])
+                        WRITE_QUEUE_DEPTH.dec(len(group['turns']))
+                    elif group['attempts'] < self.max_retries:
+                        group['attempts'] += 1
+                        self.retries += 1
+                        backoff = min(WRITE_QUEUE_BACKOFF_BASE * 2 ** (group['attempts'] - 1), WRITE_QUEUE_BACKOFF_MAX)
+                        group['not_before'] = time.time() + backoff
+                        self._pending.appendleft(group)
+                    else:
+                        self.dropped += len(group['turns'])
+                        WRITE_QUEUE_DEPTH.dec(len(group['turns']))
+                        history_cache.invalidate(group['key'])
+                        print(f"Dropping {len(group['turns'])} turn(s) for session {group['session_id']} after {group['attempts'] + 1} attempts")
+                    self._cond.notify_all()
 
-# 2. Gemini Init
-GENAI_API_KEY = os.environ.get("GEMINI_API_KEY")
-if not GENAI_API_KEY:
-    print("CRITICAL: GEMINI_API_KEY not found in env variables.")
-else:
-    genai.configure(api_key=GENAI_API_KEY)
+    def flush(self, timeout=None):
+        """Waits until every queued write has finished. Returns True if the queue drained."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            if self._pending and (self._thread is None or not self._thread.is_alive()):
+                self._ensure_started()
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
 
-# Generation Config
-generation_config = {
-    "temperature": 0.2, # Low temp for precise coding
-    "top_p": 0.95,
-    "top_k": 64,
-    "max_output_tokens": 8192,
-    "response_mime_type": "text/plain",
-}
+    def stop(self, timeout=10.0):
+        """Stops accepting turns and flushes what is pending (used on graceful shutdown)."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        drained = self.flush(timeout)
+        if not drained:
+            with self._cond:
+                lost = sum(len(item['turns']) for item in self._pending)
+                self.dropped += lost
+                WRITE_QUEUE_DEPTH.dec(lost)
+                self._pending.clear()
+            print(f"Write queue shutdown timed out, {lost} turn(s) not saved")
+        return drained
 
-# System Instruction - THE STRICT CODING GATEKEEPER
-SYSTEM_PROMPT = """
+    def pending_turns(self, key):
+        """Turns for a session that are queued or being written, oldest first."""
+        with self._cond:
+            groups = [g for g in self._in_flight if g['key'] == key]
+            groups += [item for item in self._pending if item['key'] == key]
+            turns = [turn for group in groups for turn in group['turns']]
+        return sorted(turns, key=lambda turn: turn[0]['timestamp'])
 
-"""
+    def stats(self):
+        with self._cond:
+            oldest = min((item['enqueued_at'] for item in self._pending), default=None)
+            return {
+                "depth": len(self._pending) + len(self._in_flight),
+                "lagSeconds": round(time.time() - oldest, 3) if oldest else 0.0,
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "retries": self.retries,
+                "dropped": self.dropped
+            }
 
-model = genai.GenerativeModel(
-    model_name="models/gemini-3.1-flash-lite-preview",
-    generation_config=generation_config,
-    system_instruction=SYSTEM_PROMPT,
-)
+chat_write_queue = ChatWriteQueue(WRITE_QUEUE_MAX_PENDING, WRITE_QUEUE_BATCH_WAIT, WRITE_QUEUE_MAX_RETRIES)
+atexit.register(chat_write_queue.stop)
 
-# --- HELPER: Verify Firebase Token & Check Guest Status ---
-def verify_token(auth_header):
+def enqueue_chat_turn(user_data, session_id, user_msg, response_text):
     """
-    Verifies the Firebase ID Token sent from the client.
-    Returns a dictionary {'uid': str, 'is_guest': bool} if valid, None otherwise.
-    Enhanced to detect Anonymous (Guest) users.
+    Hands a completed exchange to the write queue, saving inline if the queue is full.
+    Returns False if it could not be queued or saved.
     """
-    if not auth_header:
-        print("No Authorization header provided")
-        return None
-    
-    if not auth_header.startswith("Bearer "):
-        print("Invalid Authorization header format (must start with 'Bearer ')")
-        return None
-    
-    token = auth_header.split("Bearer ")[1]
-    
+    turn = make_chat_turn(user_msg, response_text)
+    key = chat_key(user_data, session_id)
+    history_cache.append_turn(key, turn)
+    if chat_write_queue.submit(user_data, session_id, turn):
+        return True
+    print(f"Write queue full, saving session {session_id} inline")
     try:
-        decoded_token = auth.verify_id_token(token)
-        user_id = decoded_token['uid']
+        persist_chat_turns(user_data, session_id, [turn])
+        return True
+    except Exception as db_err:
+        history_cache.invalidate(key)
+        print(f"Database Save Error: {type(db_err).__name__}: {db_err}")
+        return False
+
+# --- HELPER: Admission Control ---
+# Gemini calls are admitted in three steps: a cap on each user's concurrent
+# streams, token buckets per user and per tier (guest / registered), and a
+# bounded number of streams per process with a short wait queue in front.
+# Rejections are fast 429s with Retry-After. Buckets and stream counts live in
+# memory, or in a SQLite file shared by all gunicorn workers when
+# ADMISSION_DB_PATH is set (gunicorn.conf.py sets it). 0 disables any limit.
+def _limit(name, default):
+    return float(os.environ.get(name, default))
+
+ADMISSION_LIMITS = {
+    'registered': {
+        "perMinute": _limit("RATE_LIMIT_REGISTERED_PER_MINUTE", 20),
+        "burst": _limit("RATE_LIMIT_REGISTERED_BURST", 10),
+        "tierPerMinute": _limit("RATE_LIMIT_REGISTERED_TIER_PER_MINUTE", 0),
+        "streams": int(_limit("STREAM_LIMIT_REGISTERED", 3))
+    },
+    'guest': {
+        "perMinute": _limit("RATE_LIMIT_GUEST_PER_MINUTE", 6),
+        "burst": _limit("RATE_LIMIT_GUEST_BURST", 3),
+        "tierPerMinute": _limit("RATE_LIMIT_GUEST_TIER_PER_MINUTE", 120),
+        "streams": int(_limit("STREAM_LIMIT_GUEST", 1))
+    }
+}
+ADMISSION_MAX_ACTIVE = int(_limit("ADMISSION_MAX_ACTIVE", 16))   # concurrent Gemini streams per process
+ADMISSION_MAX_WAITING = int(_limit("ADMISSION_MAX_WAITING", 16)) # requests allowed to queue for a slot
+ADMISSION_WAIT_TIMEOUT = _limit("ADMISSION_WAIT_TIMEOUT", 5)     # seconds a queued request waits
+ADMISSION_DB_PATH = os.environ.get("ADMISSION_DB_PATH")
+STREAM_LEASE_SECONDS = 600    # a shared stream slot left by a crashed worker frees itself after this
+STREAM_RETRY_AFTER = 5        # seconds suggested when a user has too many streams open
+
+ADMISSION_DECISIONS = Counter('ada_admission_decisions_total', 'Admission decisions for Gemini calls', ['result'])
+ADMISSION_WAIT = Histogram('ada_admission_wait_seconds', 'Time spent queued for a stream slot', buckets=LATENCY_BUCKETS)
+ACTIVE_STREAMS = Gauge('ada_active_streams', 'Admitted Gemini streams in progress', multiprocess_mode='livesum')
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after, message):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.message = message
+
+def refill_bucket(tokens, updated, now, rate, burst):
+    """Token bucket step: returns (tokens left, allowed, seconds until the next token)."""
+    tokens = burst if tokens is None else min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, True, 0.0
+    return tokens, False, (1 - tokens) / rate
+
+class MemoryAdmissionBackend:
+    """Buckets and stream leases for a single process."""
+    name = 'memory'
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._streams = {}             # key -> set of lease ids
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        with self._lock:
+            now = time.time()
+            tokens, updated = self._buckets.pop(key, (None, now))
+            tokens, allowed, retry_after = refill_bucket(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            # Forgetting an idle bucket only refills it early
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed, retry_after
+
+    def acquire_stream(self, key, limit, lease_id):
+        with self._lock:
+            leases = self._streams.setdefault(key, set())
+            if len(leases) >= limit:
+                return False
+            leases.add(lease_id)
+            return True
+
+    def release_stream(self, key, lease_id):
+        with self._lock:
+            leases = self._streams.get(key)
+            if leases is not None:
+                leases.discard(lease_id)
+                if not leases:
+                    del self._streams[key]
+
+class SqliteAdmissionBackend:
+    """Buckets and stream leases in a SQLite file, so limits hold across gunicorn workers on one host."""
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS streams (key TEXT, lease TEXT PRIMARY KEY, expires REAL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def take(self, key, rate, burst):
+        with self._transaction() as conn:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, allowed, retry_after = refill_bucket(row[0] if row else None, row[1] if row else now, now, rate, burst)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            return allowed, retry_after
+
+    def acquire_stream(self, key, limit, lease_id):
+        with self._transaction() as conn:
+            now = time.time()
+            conn.execute("DELETE FROM streams WHERE expires < ?", (now,))
+            (count,) = conn.execute("SELECT COUNT(*) FROM streams WHERE key = ?", (key,)).fetchone()
+            if count >= limit:
+                return False
+            conn.execute("INSERT INTO streams (key, lease, expires) VALUES (?, ?, ?)", (key, lease_id, now + STREAM_LEASE_SECONDS))
+            return True
+
+    def release_stream(self, key, lease_id):
+        self._conn().execute("DELETE FROM streams WHERE lease = ?", (lease_id,))
+
+class AdmissionTicket:
+    """An admitted stream; release() is idempotent and must run when the generation ends."""
+
+    def __init__(self, controller, stream_key, lease_id):
+        self._controller = controller
+        self._stream_key = stream_key
+        self._lease_id = lease_id
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._controller._release(self._stream_key, self._lease_id)
+
+class AdmissionController:
+    def __init__(self, backend, limits, max_active, max_waiting, wait_timeout):
+        self.backend = backend
+        self.limits = limits
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {}
+        self._cond = threading.Condition()
+        self._async_waiters = deque()  # wake-up callbacks of admit_async() calls queued for a slot
+
+    def _reject(self, reason, retry_after, message):
+        with self._cond:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        ADMISSION_DECISIONS.labels(result=reason).inc()
+        raise AdmissionRejected(reason, retry_after, message)
+
+    def check_rate(self, user_data, scope='chat'):
+        """Takes a token from the user's and the tier's bucket; raises AdmissionRejected when empty."""
+        tier = 'guest' if user_data['is_guest'] else 'registered'
+        limits = self.limits[tier]
+        buckets = ((f"{scope}:user:{tier}:{user_data['uid']}", limits["perMinute"], limits["burst"]),
+                   (f"{scope}:tier:{tier}", limits["tierPerMinute"], limits["tierPerMinute"]))
+        for key, per_minute, burst in buckets:
+            if per_minute <= 0:
+                continue
+            allowed, retry_after = self.backend.take(key, per_minute / 60.0, max(1.0, burst))
+            if not allowed:
+                self._reject('rate_limited', retry_after, "Too many requests. Please wait a moment and try again.")
+
+    def _reserve(self, user_data):
+        """Per-user stream cap, then rate limits; returns a ticket that holds no process slot yet."""
+        tier = 'guest' if user_data['is_guest'] else 'registered'
+        stream_key = f"{tier}:{user_data['uid']}"
+        lease_id = uuid.uuid4().hex
+        stream_limit = self.limits[tier]["streams"]
+        if stream_limit > 0 and not self.backend.acquire_stream(stream_key, stream_limit, lease_id):
+            self._reject('too_many_streams', STREAM_RETRY_AFTER,
+                         "Too many answers in progress. Wait for one to finish and try again.")
+        ticket = AdmissionTicket(self, stream_key if stream_limit > 0 else None, lease_id)
+        try:
+            self.check_rate(user_data)
+        except AdmissionRejected:
+            self._abandon(ticket)
+            raise
+        return ticket
+
+    def _abandon(self, ticket):
+        """Gives back the stream lease of a ticket that never got a slot."""
+        ticket._released = True
+        if ticket._stream_key is not None:
+            self.backend.release_stream(ticket._stream_key, ticket._lease_id)
+
+    def admit(self, user_data):
+        """Admits one Gemini stream or raises AdmissionRejected; returns an AdmissionTicket."""
+        ticket = self._reserve(user_data)
+        try:
+            self._acquire_slot()
+        except AdmissionRejected:
+            self._abandon(ticket)
+            raise
+        ADMISSION_DECISIONS.labels(result='admitted').inc()
+        return ticket
+
+    async def admit_async(self, user_data):
+        """admit() for the event loop (asgi.py): queued requests await a slot instead of blocking a thread."""
+        # The checks may touch the shared SQLite file, which is quick but blocking
+        ticket = await asyncio.to_thread(self._reserve, user_data)
+        try:
+            await self._acquire_slot_async()
+        except BaseException:
+            self._abandon(ticket)
+            raise
+        ADMISSION_DECISIONS.labels(result='admitted').inc()
+        return ticket
+
+    def _take_slot(self):
+        # Caller holds self._cond
+        if self.max_active > 0 and self.active >= self.max_active:
+            return False
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def _acquire_slot(self):
+        with self._cond:
+            if self._take_slot():
+                busy, got_slot = False, True
+            elif self.waiting >= self.max_waiting:
+                busy, got_slot = True, False
+            else:
+                busy = False
+                self.waiting += 1
+                started = time.perf_counter()
+                try:
+                    got_slot = self._cond.wait_for(self._take_slot, self.wait_timeout)
+                finally:
+                    self.waiting -= 1
+                    ADMISSION_WAIT.observe(time.perf_counter() - started)
+        if busy or not got_slot:
+            self._reject('busy', self.wait_timeout, "The server is busy. Please try again in a few seconds.")
+        ACTIVE_STREAMS.inc()
+
+    async def _acquire_slot_async(self):
+        loop = asyncio.get_running_loop()
         
-        # Check the sign-in provider to see if it's an anonymous user
-        firebase_claim = decoded_token.get('firebase', {})
-        provider = firebase_claim.get('sign_in_provider')
-        is_guest = (provider == 'anonymous')
+        def enqueue():
+            # Caller holds self._cond; _release() wakes the oldest waiter from its own thread
+            waiter = loop.create_future()
+            wake = lambda: loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+            self._async_waiters.append(wake)
+            return waiter, wake
+        
+        with self._cond:
+            if self._take_slot():
+                ACTIVE_STREAMS.inc()
+                return
+            if self.waiting >= self.max_waiting:
+                waiter = None
+            else:
+                self.waiting += 1
+                waiter, wake = enqueue()
+        if waiter is None:
+            self._reject('busy', self.wait_timeout, "The server is busy. Please try again in a few seconds.")
         
-        return {'uid': user_id, 'is_guest': is_guest}
+        started = time.perf_counter()
+        deadline = loop.time() + self.wait_timeout
+        got_slot = False
+        try:
+            while not got_slot:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                with self._cond:
+                    got_slot = self._take_slot()
+                    if not got_slot:
+                        waiter, wake = enqueue()  # a request that never queued took the slot first
+        finally:
+            with self._cond:
+                self.waiting -= 1
+                if wake in self._async_waiters:
+                    self._async_waiters.remove(wake)
+                    wake_next = None
+                elif not got_slot and self._async_waiters:
+                    wake_next = self._async_waiters.popleft()  # woken but leaving: pass the wake-up on
+                else:
+                    wake_next = None
+            if wake_next:
+                wake_next()
+            ADMISSION_WAIT.observe(time.perf_counter() - started)
+        if not got_slot:
+            self._reject('busy', self.wait_timeout, "The server is busy. Please try again in a few seconds.")
+        ACTIVE_STREAMS.inc()
 
-    except auth.InvalidIdTokenError:
-        print("Invalid ID token - token is malformed or invalid")
-        return None
-    except auth.ExpiredIdTokenError:
-        print("Token has expired - user needs to refresh their token")
-        return None
-    except auth.RevokedIdTokenError:
-        print("Token has been revoked")
-        return None
-    except Exception as e:
-        print(f"Token verification error: {type(e).__name__}: {e}")
-        return None
+    def _release(self, stream_key, lease_id):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+            wake = self._async_waiters.popleft() if self._async_waiters else None
+        if wake:
+            wake()
+        ACTIVE_STREAMS.dec()
+        if stream_key is not None:
+            try:
+                self.backend.release_stream(stream_key, lease_id)
+            except Exception as e:
+                print(f"Admission release error: {type(e).__name__}: {e}")
 
-def get_user_ref(user_data):
+    def stats(self):
+        with self._cond:
+            return {
+                "backend": self.backend.name,
+                "active": self.active,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected)
+            }
+
+admission = AdmissionController(
+    SqliteAdmissionBackend(ADMISSION_DB_PATH) if ADMISSION_DB_PATH else MemoryAdmissionBackend(),
+    ADMISSION_LIMITS, ADMISSION_MAX_ACTIVE, ADMISSION_MAX_WAITING, ADMISSION_WAIT_TIMEOUT
+)
+
+def admission_error(e):
+    """(status, payload, headers) for a rejected request."""
+    return 429, {"error": "Too Many Requests", "message": e.message, "reason": e.reason}, {"Retry-After": str(e.retry_after)}
+
+# --- HELPER: Resumable SSE Streams ---
+# With 'Accept: text/event-stream' (or "stream": "sse" in the body) /api/chat
+# answers with typed events. The generation runs apart from the response and
+# its events are buffered, so a client that reconnects with Last-Event-ID
+# picks up where it left off instead of paying for a new Gemini call.
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", 256))
+SSE_REPLAY_MAX_BYTES = int(os.environ.get("SSE_REPLAY_MAX_BYTES", 256 * 1024))  # per stream
+SSE_REPLAY_TTL = int(os.environ.get("SSE_REPLAY_TTL", 120))  # seconds a finished stream stays resumable
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", 15))
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def wants_sse(headers, data):
+    """True when the client asked for the event-stream protocol."""
+    return 'text/event-stream' in (headers.get('Accept') or '') or data.get('stream') == 'sse'
+
+def format_sse(event, payload, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(payload)}")
+    return "\n".join(lines) + "\n\n"
+
+def parse_last_event_id(value):
+    """'<stream_id>:<seq>' -> (stream_id, seq); (None, 0) when absent or malformed."""
+    stream_id, _, seq = (value or '').strip().rpartition(':')
+    if not stream_id or not seq.isdigit():
+        return None, 0
+    return stream_id, int(seq)
+
+class ChatStream:
+    """Events of one generation, numbered from 1 and trimmed to SSE_REPLAY_MAX_BYTES."""
+
+    def __init__(self, stream_id, owner, max_bytes):
+        self.id = stream_id
+        self.owner = owner
+        self.max_bytes = max_bytes
+        self.seq = 0
+        self.finished_at = None
+        self._events = deque()  # (seq, wire text)
+        self._bytes = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # (loop, future) of asyncio readers
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def publish(self, event, payload, final=False):
+        with self._cond:
+            self.seq += 1
+            text = format_sse(event, dict(payload, streamId=self.id, seq=self.seq), f"{self.id}:{self.seq}")
+            self._events.append((self.seq, text))
+            self._bytes += len(text)
+            # Keep at least the newest event so a finished stream can still report how it ended
+            while self._bytes > self.max_bytes and len(self._events) > 1:
+                self._bytes -= len(self._events.popleft()[1])
+            if final:
+                self.finished_at = time.time()
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    def read(self, after):
+        """Returns (events after seq `after`, finished, missed); missed means some were already trimmed."""
+        with self._cond:
+            first = self._events[0][0] if self._events else self.seq + 1
+            events = [event for event in self._events if event[0] > after]
+            return events, self.finished, after + 1 < first
+
+    def wait(self, after, timeout):
+        """Blocks until there is an event past `after` or the stream ends; False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.seq > after or self.finished, timeout)
+
+    async def wait_async(self, after, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if self.seq > after or self.finished:
+                return True
+            self._async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class StreamRegistry:
+    """Bounded set of resumable streams. Finished streams expire after SSE_REPLAY_TTL;
+    past max_streams the oldest are forgotten (they keep running, they just can't be resumed)."""
+
+    def __init__(self, max_streams, max_bytes, ttl):
+        self.max_streams = max_streams
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.resumed = 0
+        self.evicted = 0
+
+    def create(self, user_data):
+        stream = ChatStream(uuid.uuid4().hex, (user_data['is_guest'], user_data['uid']), self.max_bytes)
+        with self._lock:
+            self._prune()
+            self._streams[stream.id] = stream
+            while len(self._streams) > self.max_streams:
+                victim = next((sid for sid, s in self._streams.items() if s.finished), next(iter(self._streams)))
+                del self._streams[victim]
+                self.evicted += 1
+            self.started += 1
+        return stream
+
+    def get(self, user_data, stream_id):
+        with self._lock:
+            self._prune()
+            stream = self._streams.get(stream_id)
+            if stream is None or stream.owner != (user_data['is_guest'], user_data['uid']):
+                return None
+            self.resumed += 1
+            return stream
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        for sid in [sid for sid, s in self._streams.items() if s.finished and s.finished_at < cutoff]:
+            del self._streams[sid]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "streams": len(self._streams),
+                "active": sum(1 for s in self._streams.values() if not s.finished),
+                "started": self.started,
+                "resumed": self.resumed,
+                "evicted": self.evicted
+            }
+
+chat_streams = StreamRegistry(SSE_MAX_STREAMS, SSE_REPLAY_MAX_BYTES, SSE_REPLAY_TTL)
+
+def resume_chat_stream(user_data, last_event_id, stream_id=None):
+    """Looks up the stream to resume; returns (stream, last seq seen, None) or (None, 0, (status, payload))."""
+    event_stream_id, after = parse_last_event_id(last_event_id)
+    stream_id = stream_id or event_stream_id
+    stream = chat_streams.get(user_data, stream_id) if stream_id else None
+    if stream is None:
+        return None, 0, (404, {
+            "error": "Stream Not Found",
+            "message": "This answer can no longer be resumed. Send the message again."
+        })
+    if event_stream_id not in (None, stream.id):
+        after = 0
+    return stream, after, None
+
+def stream_gone_event(stream):
+    return format_sse('error', {"streamId": stream.id, "error": "Gone",
+                                "message": "Part of this answer is no longer buffered. Send the message again."})
+
+def sse_events(stream, after=0):
+    """Replays buffered events after seq `after`, then follows the stream, with heartbeats while idle."""
+    while True:
+        events, finished, missed = stream.read(after)
+        if missed:
+            yield stream_gone_event(stream)
+            return
+        for after, text in events:
+            yield text
+        if finished:
+            return
+        if not stream.wait(after, SSE_HEARTBEAT_SECONDS):
+            yield format_sse('heartbeat', {"streamId": stream.id})
+
+def done_event(text, history_version=None):
     """
-    Returns the Firestore Document Reference for the user.
-    Routes guests to 'temp-users' and registered users to 'users'.
+    Data of a stream's 'done' event. With the session's history_version from
+    before the turn, also the version it reaches once the turn is saved; pass
+    it only when the turn was handed to the write queue.
     """
-    if not db:
-        raise Exception("Database unavailable")
-    
-    # TRAFFIC ROUTING LOGIC
-    collection_name = 'temp-users' if user_data['is_guest'] else 'users'
-    return db.collection(collection_name).document(user_data['uid'])
+    data = {"chars": len(text)}
+    if history_version is not None:
+        data["historyVersion"] = history_version + 2
+    return data
+
+def produce_chat_stream(stream, ticket, history, prompt, user_data, session_id, user_msg, usage, cache_key=None,
+                        history_version=None):
+    """Runs one generation into `stream`; saves the turn before 'done' so the next message sees it."""
+    parts = []
+    stream_metrics = StreamMetrics('sync')
+    try:
+        for text in gemini.stream(history, prompt):
+            stream_metrics.chunk(text)
+            parts.append(text)
+            stream.publish('delta', {"text": text})
+        response_text = "".join(parts)
+        log_chat_usage(session_id, usage, stream_metrics.ttfb, stream_metrics.finish(), response_text)
+        if cache_key:
+            response_cache.put(cache_key, response_text)
+        saved = bool(session_id and db) and enqueue_chat_turn(user_data, session_id, user_msg, response_text)
+        stream.publish('done', done_event(response_text, history_version if saved else None), final=True)
+    except Exception as e:
+        stream_metrics.error(e)
+        print(f"Gemini API Error: {type(e).__name__}: {str(e)}")
+        stream.publish('error', {"error": "Upstream Error", "message": CHAT_ERROR_TEXT}, final=True)
+    finally:
+        ticket.release()
+
+def with_chat_headers(response, context_hashes):
+    """Adds the /api/chat response headers describing the attachments."""
+    # The session's new historyVersion is not a header: it is only known once the
+    # turn is saved, so it comes in the event stream's 'done' event.
+    # Lets clients send {"hash": ...} for the same attachment next time
+    for field, content_hash in context_hashes.items():
+        response.headers[CONTEXT_HASH_HEADERS[field]] = content_hash
+    return response
+
+def sse_response(stream, after=0):
+    response = Response(stream_with_context(sse_events(stream, after)), mimetype='text/event-stream')
+    response.headers.update(SSE_HEADERS)
+    response.headers['X-Stream-Id'] = stream.id
+    return response
 
 # --- ROUTES ---
 
@@ -140,12 +3789,46 @@ def home():
 
 @app.route('/health')
 def health():
-    """Health check endpoint for UptimeRobot and monitoring services"""
-    return jsonify({
+    """
+    Health check endpoint for UptimeRobot and monitoring services.
+    The internal stats are only included for requests carrying METRICS_TOKEN.
+    """
+    body = {
         "status": "healthy",
         "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+    if not METRICS_TOKEN or request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify(body)
+    return jsonify({
+        **body,
+        "tokenCache": token_cache.stats(),
+        "writeQueue": chat_write_queue.stats(),
+        "titles": title_generator.stats(),
+        "historyCache": history_cache.stats(),
+        "contextStore": context_store.stats(),
+        "chatStreams": chat_streams.stats(),
+        "admission": admission.stats(),
+        "profileCache": profile_cache.stats(),
+        "responseCache": response_cache.stats(),
+        "gemini": gemini.stats(),
+        "startup": startup_report(),
+        "sweeper": temp_user_sweeper.stats(),
+        "search": search_index.stats()
     })
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics in text exposition format, aggregated across gunicorn workers."""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
 @app.route('/api/generate-title', methods=['POST'])
 def generate_title():
     """Generates a short 3-5 word title for the chat history."""
@@ -159,18 +3842,22 @@ def generate_title():
 
     data = request.json
     message = data.get('message', '')
+    try:
+        admission.check_rate(user_data, scope='title')
+    except AdmissionRejected as e:
+        status, payload, headers = admission_error(e)
+        return jsonify(payload), status, headers
     
     try:
-        title_model = genai.GenerativeModel("models/gemini-3.1-flash-lite-preview")
-        res = title_model.generate_content(f"Summarize this coding query into a 3-5 word title: '{message}'")
-        return jsonify({"title": res.text.strip()})
+        # Shares the call already started by /api/chat for the same message
+        return jsonify({"title": title_generator.get(message)})
     except Exception as e:
         print(f"Error generating title: {type(e).__name__}: {e}")
         return jsonify({"title": "New Chat"})
 
 @app.route('/api/profile', methods=['GET'])
 def get_profile():
-    """Get user profile from Firestore."""
+    """Get user profile from Firestore (created with defaults on first load). Supports If-None-Match."""
     user_data = verify_token(request.headers.get('Authorization'))
     if not user_data:
         return jsonify({"error": "Unauthorized"}), 401
@@ -179,33 +3866,8 @@ def get_profile():
         return jsonify({"error": "Database unavailable"}), 503
     
     try:
-        # Use helper to get correct collection path
-        user_ref = get_user_ref(user_data)
-        doc = user_ref.get()
-        
-        if doc.exists:
-            return jsonify(doc.to_dict())
-        else:
-            # Create default profile
-            default_profile = {
-                "uid": user_data['uid'],
-                "isGuest": user_data['is_guest'],
-                "displayName": "Guest User" if user_data['is_guest'] else "",
-                "email": "",
-                "photoURL": "",
-                "age": "",
-                "location": "",
-                "bio": "",
-                "totalChats": 0,
-                "totalMessages": 0,
-                "totalCodeSnippets": 0,
-                "theme": "dark",
-                "codeTheme": "dracula",
-                "fontSize": 13,
-                "createdAt": datetime.datetime.now(datetime.timezone.utc)
-            }
-            user_ref.set(default_profile)
-            return jsonify(default_profile)
+        # Cached per process; unchanged profiles come back as 304 for If-None-Match
+        return profile_response(load_profile(user_data))
     except Exception as e:
         print(f"Error getting profile: {type(e).__name__}: {e}")
         return jsonify({"error": "Failed to get profile"}), 500
@@ -222,12 +3884,23 @@ def update_profile():
     
     try:
         data = request.json
-        allowed_fields = ['displayName', 'age', 'location', 'bio', 'photoURL', 'theme', 'codeTheme', 'fontSize']
-        update_data = {k: v for k, v in data.items() if k in allowed_fields}
+        update_data = {k: v for k, v in data.items() if k in PROFILE_EDITABLE_FIELDS}
         update_data['updatedAt'] = datetime.datetime.now(datetime.timezone.utc)
         
         user_ref = get_user_ref(user_data)
-        user_ref.update(update_data)
+        try:
+            with firestore_timer('profile_update'):
+                user_ref.update(update_data)
+        except api_exceptions.NotFound:
+            # Saved before the profile was ever loaded: create it with the edits applied
+            try:
+                with firestore_timer('profile_create'):
+                    user_ref.create({**default_profile(user_data), **update_data})
+            except api_exceptions.AlreadyExists:
+                with firestore_timer('profile_update'):
+                    user_ref.update(update_data)
+        finally:
+            profile_cache.invalidate(profile_key(user_data))
         
         return jsonify({"success": True, "message": "Profile updated"})
     except Exception as e:
@@ -236,7 +3909,10 @@ def update_profile():
 
 @app.route('/api/chats', methods=['GET'])
 def get_chats():
-    """Get all user's chat sessions from Firestore."""
+    """
+    Get user's chat sessions from Firestore.
+    Query: ?limit=N&cursor=<nextCursor>. Pinned chats are returned first, on the first page only.
+    """
     user_data = verify_token(request.headers.get('Authorization'))
     if not user_data:
         return jsonify({"error": "Unauthorized"}), 401
@@ -244,32 +3920,84 @@ def get_chats():
     if not db:
         return jsonify({"error": "Database unavailable"}), 503
     
+    limit = request.args.get('limit', type=int)
+    if limit:
+        limit = max(1, min(limit, CHATS_PAGE_MAX))
+    cursor = request.args.get('cursor')
+    try:
+        start_after = decode_chats_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({"error": "Bad Request", "message": "Invalid cursor"}), 400
+    
     try:
         user_ref = get_user_ref(user_data)
         chats_ref = user_ref.collection('chats')
         
-        # Order by updatedAt descending (most recent first)
-        docs = chats_ref.order_by('updatedAt', direction='DESCENDING').stream()
+        # Pinned chats are few, so fetch them in a small filtered query and sort in memory
+        pinned = []
+        if not start_after:
+            from google.cloud.firestore_v1 import FieldFilter
+            with firestore_timer('chats_list_pinned'):
+                pinned_docs = list(chats_ref.where(filter=FieldFilter('isPinned', '==', True)).select(CHAT_LIST_FIELDS).stream())
+            pinned = sorted((chat_summary(doc) for doc in pinned_docs),
+                            key=lambda c: c['updatedAt'] or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
+                            reverse=True)
         
-        chats = []
-        for doc in docs:
-            chat_data = doc.to_dict()
-            chat_data['id'] = doc.id
-            # Only send metadata, not full messages
-            chats.append({
-                'id': chat_data.get('id'),
-                'title': chat_data.get('title', 'New Chat'),
-                'createdAt': chat_data.get('createdAt'),
-                'updatedAt': chat_data.get('updatedAt'),
-                'isPinned': chat_data.get('isPinned', False),
-                'messageCount': len(chat_data.get('messages', []))
-            })
+        # Order by updatedAt descending (most recent first), ID as tie-breaker for stable cursors.
+        # Pinned chats were already listed above, so they are skipped here; another
+        # page is read when skipping them leaves this one short.
+        query = (chats_ref.select(CHAT_LIST_FIELDS)
+                 .order_by('updatedAt', direction='DESCENDING')
+                 .order_by('__name__', direction='DESCENDING'))
+        page = []
+        while True:
+            page_query = query.start_after(start_after) if start_after else query
+            if limit:
+                page_query = page_query.limit(limit + 1)
+            with firestore_timer('chats_list'):
+                rows = [chat_summary(doc) for doc in page_query.stream()]
+            page += [c for c in rows if not c['isPinned']]
+            if not limit or len(rows) <= limit or len(page) > limit:
+                break
+            start_after = {'updatedAt': rows[-1]['updatedAt'], '__name__': rows[-1]['id']}
+        next_cursor = None
+        if limit and len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_chats_cursor(page[-1])
         
-        return jsonify({"chats": chats})
+        return jsonify({"chats": pinned + page, "nextCursor": next_cursor})
     except Exception as e:
         print(f"Error getting chats: {type(e).__name__}: {e}")
         return jsonify({"error": "Failed to get chats"}), 500
 
+@app.route('/api/chats/search', methods=['GET'])
+def search_chats():
+    """
+    Full-text search over the user's chat titles and messages.
+    Query: ?q=<words>&limit=10 (max 50). The last word also matches as a prefix
+    unless the query ends with a space.
+    """
+    user_data = verify_token(request.headers.get('Authorization'))
+    if not user_data:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if not db:
+        return jsonify({"error": "Database unavailable"}), 503
+    
+    query = request.args.get('q', '')
+    if not query.strip() or len(query) > 200:
+        return jsonify({"error": "Bad Request", "message": "q must be 1-200 characters"}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), SEARCH_RESULTS_MAX))
+    except ValueError:
+        return jsonify({"error": "Bad Request", "message": "limit must be a number"}), 400
+    
+    try:
+        return jsonify({"query": query, "results": search_index.search(user_data, query, limit)})
+    except Exception as e:
+        print(f"Error searching chats: {type(e).__name__}: {e}")
+        return jsonify({"error": "Failed to search chats"}), 500
+
 @app.route('/api/chats/<chat_id>', methods=['GET'])
 def get_chat(chat_id):
     """Get specific chat session."""
@@ -280,17 +4008,35 @@ def get_chat(chat_id):
     if not db:
         return jsonify({"error": "Database unavailable"}), 503
     
+    # Optional pagination: ?before=<message_id>&limit=50 (no params returns the full history)
+    before = request.args.get('before')
+    if before is not None and (not before or '/' in before or before in ('.', '..')):
+        return jsonify({"error": "Bad Request", "message": "before must be a message ID"}), 400
+    limit = request.args.get('limit', type=int)
+    if before and not limit:
+        limit = MESSAGES_PAGE_MAX
+    if limit:
+        limit = max(1, min(limit, MESSAGES_PAGE_MAX))
+    
     try:
         user_ref = get_user_ref(user_data)
         chat_ref = user_ref.collection('chats').document(chat_id)
-        doc = chat_ref.get()
+        with firestore_timer('chat_get'):
+            doc = chat_ref.get()
         
         if not doc.exists:
             return jsonify({"error": "Chat not found"}), 404
         
         chat_data = doc.to_dict()
+        if 'messages' in chat_data:
+            chat_data['messageCount'] = migrate_chat_messages(chat_ref, chat_data)
+            del chat_data['messages']
+        
+        messages, next_cursor = load_messages(chat_ref, before=before, limit=limit)
         chat_data['id'] = doc.id
-        return jsonify(chat_data)
+        chat_data['messages'] = messages
+        chat_data['nextCursor'] = next_cursor
+        return jsonify(json_ready(chat_data))
     except Exception as e:
         print(f"Error getting chat: {type(e).__name__}: {e}")
         return jsonify({"error": "Failed to get chat"}), 500
@@ -308,7 +4054,15 @@ def delete_chat(chat_id):
     try:
         user_ref = get_user_ref(user_data)
         chat_ref = user_ref.collection('chats').document(chat_id)
-        chat_ref.delete()
+        delete_messages(chat_ref)
+        batch = db.batch()
+        batch.delete(chat_ref)
+        search_entry = search_index.queue(batch, user_ref, [["delete", chat_id]])
+        with firestore_timer('chat_delete'):
+            batch.commit()
+        search_index.applied(user_data, search_entry)
+        history_cache.invalidate(chat_key(user_data, chat_id))
+        history_compactor.forget(chat_key(user_data, chat_id))
         return jsonify({"success": True, "message": "Chat deleted"})
     except Exception as e:
         print(f"Error deleting chat: {type(e).__name__}: {e}")
@@ -324,16 +4078,24 @@ def rename_chat(chat_id):
     if not db:
         return jsonify({"error": "Database unavailable"}), 503
     
+    data = request.get_json(silent=True) or {}
+    new_title = data.get('title')
+    if not isinstance(new_title, str) or not new_title.strip():
+        return jsonify({"error": "Bad Request", "message": "title must be a non-empty string"}), 400
+    
     try:
-        data = request.json
-        new_title = data.get('title', 'New Chat')
-        
         user_ref = get_user_ref(user_data)
         chat_ref = user_ref.collection('chats').document(chat_id)
-        chat_ref.update({
+        batch = db.batch()
+        batch.update(chat_ref, {
             'title': new_title,
             'updatedAt': datetime.datetime.now(datetime.timezone.utc)
         })
+        search_entry = search_index.queue(batch, user_ref, [["rename", chat_id, new_title]])
+        with firestore_timer('chat_rename'):
+            batch.commit()
+        search_index.applied(user_data, search_entry)
+        history_cache.invalidate(chat_key(user_data, chat_id))
         
         return jsonify({"success": True, "message": "Chat renamed"})
     except Exception as e:
@@ -342,7 +4104,7 @@ def rename_chat(chat_id):
 
 @app.route('/api/chats/<chat_id>/export', methods=['GET'])
 def export_chat(chat_id):
-    """Export chat as JSON."""
+    """Export chat as a streamed download. Query: ?format=json (default) | ndjson."""
     user_data = verify_token(request.headers.get('Authorization'))
     if not user_data:
         return jsonify({"error": "Unauthorized"}), 401
@@ -350,31 +4112,63 @@ def export_chat(chat_id):
     if not db:
         return jsonify({"error": "Database unavailable"}), 503
     
+    fmt = request.args.get('format', 'json')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "Bad Request", "message": "format must be 'json' or 'ndjson'"}), 400
+    
     try:
         user_ref = get_user_ref(user_data)
         chat_ref = user_ref.collection('chats').document(chat_id)
-        doc = chat_ref.get()
+        with firestore_timer('chat_get'):
+            doc = chat_ref.get()
         
         if not doc.exists:
             return jsonify({"error": "Chat not found"}), 404
         
         chat_data = doc.to_dict()
-        chat_data['id'] = doc.id
-        
-        # Convert timestamps to ISO format for JSON serialization
-        if 'createdAt' in chat_data:
-            chat_data['createdAt'] = chat_data['createdAt'].isoformat() if hasattr(chat_data['createdAt'], 'isoformat') else str(chat_data['createdAt'])
-        if 'updatedAt' in chat_data:
-            chat_data['updatedAt'] = chat_data['updatedAt'].isoformat() if hasattr(chat_data['updatedAt'], 'isoformat') else str(chat_data['updatedAt'])
-        
-        for msg in chat_data.get('messages', []):
-            if 'timestamp' in msg:
-                msg['timestamp'] = msg['timestamp'].isoformat() if hasattr(msg['timestamp'], 'isoformat') else str(msg['timestamp'])
-        
-        return jsonify(chat_data)
+        if 'messages' in chat_data:
+            migrate_chat_messages(chat_ref, chat_data)
+            del chat_data['messages']
     except Exception as e:
         print(f"Error exporting chat: {type(e).__name__}: {e}")
         return jsonify({"error": "Failed to export chat"}), 500
+    
+    def generate():
+        try:
+            yield from iter_chat_export(chat_ref, chat_data, fmt)
+        except Exception as e:
+            # Headers are already sent; the client sees a truncated file
+            ERRORS.labels(source='export', type=type(e).__name__).inc()
+            print(f"Error exporting chat {chat_id}: {type(e).__name__}: {e}")
+    
+    return Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[fmt],
+                    headers={"Content-Disposition": f'attachment; filename="chat-{chat_id}.{fmt}"'})
+
+@app.route('/api/export', methods=['GET'])
+def export_all_chats():
+    """Export every chat of the user as a streamed zip archive. Query: ?format=json (default) | ndjson."""
+    user_data = verify_token(request.headers.get('Authorization'))
+    if not user_data:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if not db:
+        return jsonify({"error": "Database unavailable"}), 503
+    
+    fmt = request.args.get('format', 'json')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "Bad Request", "message": "format must be 'json' or 'ndjson'"}), 400
+    
+    user_ref = get_user_ref(user_data)
+    
+    def generate():
+        try:
+            yield from iter_account_archive(user_ref, fmt)
+        except Exception as e:
+            ERRORS.labels(source='export', type=type(e).__name__).inc()
+            print(f"Error exporting chats for {user_data['uid']}: {type(e).__name__}: {e}")
+    
+    return Response(stream_with_context(generate()), mimetype='application/zip',
+                    headers={"Content-Disposition": 'attachment; filename="ada-chats.zip"'})
 
 @app.route('/api/chats/<chat_id>/pin', methods=['PUT'])
 def pin_chat(chat_id):
@@ -392,22 +4186,115 @@ def pin_chat(chat_id):
         
         user_ref = get_user_ref(user_data)
         chat_ref = user_ref.collection('chats').document(chat_id)
-        chat_ref.update({
-            'isPinned': is_pinned,
-            'updatedAt': datetime.datetime.now(datetime.timezone.utc)
-        })
+        with firestore_timer('chat_pin'):
+            chat_ref.update({
+                'isPinned': is_pinned,
+                'updatedAt': datetime.datetime.now(datetime.timezone.utc)
+            })
         
         return jsonify({"success": True, "isPinned": is_pinned})
     except Exception as e:
         print(f"Error pinning chat: {type(e).__name__}: {e}")
         return jsonify({"error": "Failed to pin chat"}), 500
 
+@app.route('/api/chats/bulk', methods=['POST'])
+def bulk_chats():
+    """
+    Applies one action to many chats in batched writes.
+    Body: {"action": "delete" | "pin", "chatIds": [...], "isPinned": bool}
+       or {"action": "rename", "titles": {chatId: title, ...}}
+    Chats that don't exist are reported in "notFound" and otherwise ignored.
+    """
+    user_data = verify_token(request.headers.get('Authorization'))
+    if not user_data:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if not db:
+        return jsonify({"error": "Database unavailable"}), 503
+    
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action not in BULK_CHAT_ACTIONS:
+        return jsonify({"error": "Bad Request", "message": "action must be 'delete', 'pin' or 'rename'"}), 400
+    
+    titles = data.get('titles') if action == 'rename' else None
+    if action == 'rename':
+        if not isinstance(titles, dict) or not all(isinstance(t, str) and t.strip() for t in titles.values()):
+            return jsonify({"error": "Bad Request", "message": "titles must map chat IDs to non-empty titles"}), 400
+        chat_ids = list(titles)
+    else:
+        chat_ids = data.get('chatIds')
+    is_pinned = data.get('isPinned', False)
+    if action == 'pin' and not isinstance(is_pinned, bool):
+        return jsonify({"error": "Bad Request", "message": "isPinned must be true or false"}), 400
+    
+    if (not isinstance(chat_ids, list) or not chat_ids
+            or not all(isinstance(c, str) and c and '/' not in c for c in chat_ids)):
+        return jsonify({"error": "Bad Request", "message": "chatIds must be a non-empty list of chat IDs"}), 400
+    chat_ids = list(dict.fromkeys(chat_ids))
+    if len(chat_ids) > BULK_CHAT_MAX_IDS:
+        return jsonify({"error": "Bad Request", "message": f"At most {BULK_CHAT_MAX_IDS} chats per request"}), 400
+    
+    try:
+        user_ref = get_user_ref(user_data)
+        found, missing = find_chats(user_ref, chat_ids)
+        writer = BatchWriter('chats_bulk')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for chat_id in found:
+            chat_ref = user_ref.collection('chats').document(chat_id)
+            if action == 'delete':
+                queue_chat_delete(writer, chat_ref)
+            elif action == 'pin':
+                writer.update(chat_ref, {'isPinned': is_pinned, 'updatedAt': now})
+            else:
+                writer.update(chat_ref, {'title': titles[chat_id], 'updatedAt': now})
+        search_entry = None
+        if action != 'pin' and found:
+            search_entry = search_index.queue(writer, user_ref, [
+                ["delete", chat_id] if action == 'delete' else ["rename", chat_id, titles[chat_id]]
+                for chat_id in found])
+        writer.flush()
+        if search_entry:
+            search_index.applied(user_data, search_entry)
+        
+        if action != 'pin':
+            for chat_id in found:
+                history_cache.invalidate(chat_key(user_data, chat_id))
+                if action == 'delete':
+                    history_compactor.forget(chat_key(user_data, chat_id))
+        
+        return jsonify({"success": True, "action": action, "chatIds": found, "notFound": missing})
+    except Exception as e:
+        print(f"Error in bulk {action}: {type(e).__name__}: {e}")
+        return jsonify({"error": "Failed to update chats"}), 500
+
+@app.route('/api/chat/streams/<stream_id>', methods=['GET'])
+def resume_chat(stream_id):
+    """
+    Resumes an event-stream answer (e.g. an EventSource reconnect).
+    Headers: Last-Event-ID: <stream_id>:<seq> (or ?lastEventId=); events after it are replayed.
+    """
+    user_data = verify_token(request.headers.get('Authorization'))
+    if not user_data:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    stream, after, error = resume_chat_stream(user_data, last_event_id, stream_id)
+    if error:
+        return jsonify(error[1]), error[0]
+    return sse_response(stream, after)
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """
     Main Chat Endpoint (Streaming).
     Headers: Authorization: Bearer <firebase_id_token>
     Body: { "message": str, "history": list, "codeContext": str, "fileContext": str, "sessionId": str }
+    Omit "history" (optionally sending "historyVersion": int) to use the server-side session history.
+    codeContext / fileContext may be {"hash": str} for content sent earlier (see X-*-Context-Hash).
+    With Accept: text/event-stream (or "stream": "sse") the answer is sent as delta/done/error/heartbeat
+    events; repeating the request with Last-Event-ID resumes it from the replay buffer.
+    "noCache": true skips the response cache for this request.
     """
     # 1. Verify User & Get Identity Info
     user_data = verify_token(request.headers.get('Authorization'))
@@ -418,10 +4305,14 @@ def chat():
         }), 401
 
     data = request.json
+    # Reconnect after a dropped event stream: replay the buffered answer, no new generation
+    if request.headers.get('Last-Event-ID') and wants_sse(request.headers, data):
+        stream, after, error = resume_chat_stream(user_data, request.headers.get('Last-Event-ID'))
+        if error:
+            return jsonify(error[1]), error[0]
+        return sse_response(stream, after)
+
     user_msg = data.get('message')
-    history = data.get('history', []) 
-    code_ctx = data.get('codeContext', '') 
-    file_ctx = data.get('fileContext', '') 
     session_id = data.get('sessionId')
 
     if not user_msg:
@@ -431,108 +4322,126 @@ def chat():
         }), 400
 
     # 2. Construct Prompt with Context
-    context_str = ""
-    if code_ctx:
-        context_str += f"\n\n[CURRENT EDITOR CONTENT]:\n{code_ctx}\n"
-    if file_ctx:
-        # Handle both string and object formats
-        if isinstance(file_ctx, dict):
-            file_name = file_ctx.get('name', 'uploaded_file')
-            file_content = file_ctx.get('content', '')
-            context_str += f"\n\n[UPLOADED FILE: {file_name}]:\n{file_content}\n"
-        else:
-            context_str += f"\n\n[UPLOADED FILE CONTENT]:\n{file_ctx}\n"
+    # Without a 'history' list the server rebuilds it from the stored session
+    chat_history, history_version, error = resolve_chat_history(user_data, data)
+    if error:
+        return jsonify(error[1]), error[0]
+    try:
+        # Attachments may be sent as content hashes; large ones are cut to relevant excerpts
+        context_str, context_hashes = build_context_str(user_data, data, user_msg)
+    except (UnknownContextError, InvalidContextError) as e:
+        error = context_error(e)
+        return jsonify(error[1]), error[0]
+    prompt_with_ctx = user_msg + context_str
     
-    # Add History (Gemini format)
-    chat_history = []
-    for turn in history:
-        # Gemini expects 'user' and 'model' roles
-        chat_history.append({"role": "user", "parts": [turn.get('user', '')]})
-        chat_history.append({"role": "model", "parts": [turn.get('model', '')]})
+    # First message of a new session: start its title alongside the answer
+    if session_id and not chat_history:
+        title_generator.submit(user_msg)
+    
+    # Keep long conversations within the history token budget
+    chat_history, usage = history_compactor.compact(user_data, session_id, chat_history)
+    usage['promptTokens'] = estimate_tokens(prompt_with_ctx)
     
+    # Standalone questions may already have a cached answer; replay it without calling Gemini
+    cache_key, cached_text = response_cache.lookup(chat_history, user_msg, context_str, data)
+    if cached_text is not None:
+        # No stream slot is needed, but a replay still costs the user a rate-limit token
+        try:
+            admission.check_rate(user_data)
+        except AdmissionRejected as e:
+            status, payload, headers = admission_error(e)
+            return jsonify(payload), status, headers
+        saved = bool(session_id and db) and enqueue_chat_turn(user_data, session_id, user_msg, cached_text)
+        if wants_sse(request.headers, data):
+            stream = chat_streams.create(user_data)
+            publish_cached_answer(stream, cached_text, history_version if saved else None)
+            response = sse_response(stream)
+        else:
+            response = Response(replay_chunks(cached_text), mimetype='text/plain')
+        return with_chat_headers(response, context_hashes)
+    
+    # Fail fast while Gemini's circuit breakers are open
+    if not gemini.available():
+        status, payload, headers = upstream_unavailable_error(UpstreamUnavailable(gemini.retry_after()))
+        return jsonify(payload), status, headers
+
+    # Per-user stream cap and rate limits, then a bounded wait for a stream slot
     try:
-        chat_session = model.start_chat(history=chat_history)
-    except Exception as e:
-        print(f"Error starting chat session: {type(e).__name__}: {e}")
-        return jsonify({
-            "error": "Internal Server Error",
-            "message": "Failed to initialize chat session"
-        }), 500
+        ticket = admission.admit(user_data)
+    except AdmissionRejected as e:
+        status, payload, headers = admission_error(e)
+        return jsonify(payload), status, headers
 
     # 3. Stream Response
-    def generate():
-        final_text_acc = ""
-        
-        prompt_with_ctx = user_msg + context_str
-        
-        try:
-            response = chat_session.send_message(prompt_with_ctx, stream=True)
-            
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
-                    final_text_acc += chunk.text
+    if wants_sse(request.headers, data):
+        # The generation outlives this response, so a dropped client can resume it
+        stream = chat_streams.create(user_data)
+        threading.Thread(target=produce_chat_stream, daemon=True,
+                         args=(stream, ticket, chat_history, prompt_with_ctx, user_data, session_id, user_msg, usage,
+                               cache_key, history_version)).start()
+        response = sse_response(stream)
+    else:
+        def generate():
+            parts = []
+            stream_metrics = StreamMetrics('sync')
             
-            # 4. Save Interaction to Firestore (Specific Path)
-            # We save this asynchronously (conceptually) after streaming is done.
-            if session_id and db:
-                try:
-                    # Get correct reference (users vs temp-users)
-                    user_ref = get_user_ref(user_data)
-                    doc_ref = user_ref.collection('chats').document(session_id)
-                    
-                    msg_data = {
-                        "role": "user",
-                        "content": user_msg,
-                        "timestamp": datetime.datetime.now(datetime.timezone.utc)
-                    }
-                    
-                    # We store the raw AI response. The client parses the code blocks.
-                    ai_data = {
-                        "role": "model",
-                        "content": final_text_acc, 
-                        "timestamp": datetime.datetime.now(datetime.timezone.utc)
-                    }
-                    
-                    doc = doc_ref.get()
-                    if not doc.exists:
-                        # First message - generate title
-                        chat_title = "New Chat"
-                        try:
-                            title_model = genai.GenerativeModel("models/gemini-3.1-flash-lite-preview")
-                            title_response = title_model.generate_content(f"Summarize this coding query into a 3-5 word title: '{user_msg}'")
-                            chat_title = title_response.text.strip()
-                        except Exception as title_err:
-                            print(f"⚠️  Title generation failed: {title_err}")
-                        
-                        doc_ref.set({
-                            "title": chat_title,
-                            "createdAt": datetime.datetime.now(datetime.timezone.utc),
-                            "updatedAt": datetime.datetime.now(datetime.timezone.utc),
-                            "userId": user_data['uid'],
-                            "isGuest": user_data['is_guest'], # Mark for easy identification
-                            "isPinned": False,
-                            "messages": [msg_data, ai_data]
-                        })
-                    else:
-                        doc_ref.update({
-                            "messages": firestore.ArrayUnion([msg_data, ai_data]),
-                            "updatedAt": datetime.datetime.now(datetime.timezone.utc)
-                        })
-                    print(f"Chat saved to Firestore for session: {session_id} (Guest: {user_data['is_guest']})")
-                except Exception as db_err:
-                    print(f"Database Save Error: {type(db_err).__name__}: {db_err}")
+            try:
+                # Deadlines, hedging and circuit breaking live in the gateway
+                for text in gemini.stream(chat_history, prompt_with_ctx):
+                    stream_metrics.chunk(text)
+                    yield text
+                    parts.append(text)
+                
+                response_text = "".join(parts)
+                log_chat_usage(session_id, usage, stream_metrics.ttfb, stream_metrics.finish(), response_text)
+                if cache_key:
+                    response_cache.put(cache_key, response_text)
+                
+                # 4. Save Interaction to Firestore (Specific Path)
+                # Handed to the write-behind queue so the response closes right away.
+                if session_id and db:
+                    enqueue_chat_turn(user_data, session_id, user_msg, response_text)
 
-        except Exception as e:
-            error_msg = f"Gemini API Error: {type(e).__name__}: {str(e)}"
-            print(error_msg)
-            yield f"\n\nError: I encountered an issue while processing your request. Please try again."
+            except Exception as e:
+                stream_metrics.error(e)
+                error_msg = f"Gemini API Error: {type(e).__name__}: {str(e)}"
+                print(error_msg)
+                yield CHAT_ERROR_TEXT
+            finally:
+                ticket.release()
+
+        response = Response(stream_with_context(generate()), mimetype='text/plain')
+        # Frees the stream slot even if the client leaves before the body starts
+        response.call_on_close(ticket.release)
+    return with_chat_headers(response, context_hashes)
 
-    return Response(stream_with_context(generate()), mimetype='text/plain')
+record_startup('import backend', IMPORT_STARTED)
 
 if __name__ == '__main__':
+    # Build every client once and print where the cold-start time goes: python backend.py startup-report
+    if len(sys.argv) > 1 and sys.argv[1] == 'startup-report':
+        warm_up(background=False)
+        print(json.dumps(startup_report(), indent=2))
+        sys.exit(0)
+    
+    # One-shot search index build for users that have none: python backend.py build-search-index
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-search-index':
+        build_all_search_indexes()
+        sys.exit(0)
+    
+    # One temp-users sweep now: python backend.py sweep-temp-users [--dry-run]
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep-temp-users':
+        print(json.dumps(temp_user_sweeper.sweep(dry_run='--dry-run' in sys.argv[2:] or None), indent=2))
+        sys.exit(0)
+    
+    # One-shot migration of array-based chats: python backend.py migrate-messages
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate-messages':
+        migrate_all_chats()
+        sys.exit(0)
+    
     port = int(os.environ.get('PORT', 5000))
     # Use debug=False in production (Render)
     # Gunicorn will be used for production: gunicorn backend:app
     debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+    temp_user_sweeper.start()
     app.run(host='0.0.0.0', port=port, debug=debug_mode)
@@ -0,0 +1,162 @@
+"""
+Compression benchmark: size and CPU cost of the two compression layers in
+backend.py, measured on chat transcripts.
+
+At rest   - encode_message/decode_message (zlib on message content) at several
+            zlib levels: stored bytes vs plain, and encode/decode time per message.
+In flight - gzip and brotli on each chat's JSON body (what GET /api/chats/<id>
+            and the exports send): bytes on the wire and compress time per response.
+
+    python -m benchmarks.compression ada-chats.zip
+    python -m benchmarks.compression chat-1.json chat-2.ndjson --repeat 20
+
+Inputs are files saved from the export endpoints: GET /api/export (zip),
+GET /api/chats/<id>/export?format=json or ndjson. Without inputs it falls
+back to a synthetic sample built from this repository's own source files;
+real transcripts compress differently, so prefer exports from production.
+"""
+import os
+import sys
+import json
+import time
+import gzip
+import zlib
+import zipfile
+import argparse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_EXTENSIONS = ('.py', '.md', '.html', '.txt')
+
+# --- HELPER: Transcripts ---
+def parse_export(name, data):
+    """Chats ({'id', 'messages': [...]}) in one json or ndjson export."""
+    if name.endswith('.ndjson'):
+        chats = {}
+        for line in data.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row.get('type') == 'chat':
+                chats[row['id']] = dict(row, messages=[])
+            elif row.get('type') == 'message':
+                chats.setdefault(row['chatId'], {'id': row['chatId'], 'messages': []})['messages'].append(row)
+        return list(chats.values())
+    return [json.loads(data)]
+
+def load_transcripts(paths):
+    chats = []
+    for path in paths:
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                for name in archive.namelist():
+                    chats += parse_export(name, archive.read(name))
+        else:
+            with open(path, 'rb') as f:
+                chats += parse_export(path, f.read())
+    return chats
+
+def sample_transcripts():
+    """One chat per source file: a short question, the file as a fenced answer, a follow-up."""
+    chats = []
+    for folder, _, files in os.walk(REPO_ROOT):
+        if '.git' in folder or '__pycache__' in folder:
+            continue
+        for name in sorted(files):
+            if not name.endswith(SAMPLE_EXTENSIONS):
+                continue
+            with open(os.path.join(folder, name), encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            for start in range(0, len(text), 6000):
+                chats.append({'id': f"{name}:{start}", 'title': f"About {name}", 'messages': [
+                    {'role': 'user', 'content': f"Can you explain what {name} does?"},
+                    {'role': 'model', 'content': f"Here is the relevant part of `{name}`:\n\n```\n{text[start:start + 6000]}\n```"},
+                    {'role': 'user', 'content': "Thanks, and how would I test it?"},
+                ]})
+    return chats
+
+# --- HELPER: Measurements ---
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - started) / repeat
+
+def at_rest(backend, messages, level, repeat):
+    """(stored bytes, share of messages compressed, encode µs/msg, decode µs/msg) for one zlib level."""
+    backend.MESSAGE_COMPRESS_LEVEL = level
+    stored, compressed, encode_s, decode_s = 0, 0, 0.0, 0.0
+    for msg in messages:
+        encoded, seconds = timed(lambda: backend.encode_message(msg), repeat)
+        encode_s += seconds
+        content = encoded['content']
+        stored += len(content) if isinstance(content, bytes) else len(content.encode("utf-8"))
+        if 'contentEncoding' in encoded:
+            compressed += 1
+        _, seconds = timed(lambda: backend.decode_message(dict(encoded)), repeat)
+        decode_s += seconds
+    n = max(len(messages), 1)
+    return stored, compressed / n, encode_s / n * 1e6, decode_s / n * 1e6
+
+def in_flight(bodies, compress, repeat):
+    """(bytes on the wire, compress µs per response)."""
+    sent, seconds_total = 0, 0.0
+    for body in bodies:
+        out, seconds = timed(lambda: compress(body), repeat)
+        sent += len(out)
+        seconds_total += seconds
+    return sent, seconds_total / max(len(bodies), 1) * 1e6
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Size/CPU trade-off of message and response compression.")
+    parser.add_argument('exports', nargs='*', help="export files (.zip, .json, .ndjson); default: synthetic sample")
+    parser.add_argument('--repeat', type=int, default=5, help="timing repetitions per message/response")
+    parser.add_argument('--output', help="also append the report to this file")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, REPO_ROOT)
+    import backend
+    chats = load_transcripts(args.exports) if args.exports else sample_transcripts()
+    messages = [{'role': m.get('role'), 'content': m.get('content', '')} for chat in chats for m in chat['messages']]
+    bodies = [json.dumps(chat).encode("utf-8") for chat in chats]
+    plain = sum(len(m['content'].encode("utf-8")) for m in messages)
+    raw_body = sum(len(b) for b in bodies)
+    source = ", ".join(args.exports) if args.exports else "SYNTHETIC sample from repository sources"
+
+    report = [f"Transcripts: {source}",
+              f"{len(chats)} chats, {len(messages)} messages, {plain} content bytes, {raw_body} JSON bytes",
+              "",
+              f"At rest (zlib, messages >= {backend.MESSAGE_COMPRESS_MIN_BYTES} bytes; * = default level)",
+              f"{'level':>7} {'stored':>12} {'ratio':>7} {'msgs zipped':>12} {'enc µs':>8} {'dec µs':>8}"]
+    default_level = backend.MESSAGE_COMPRESS_LEVEL
+    for level in (1, 6, 9):
+        stored, share, enc, dec = at_rest(backend, messages, level, args.repeat)
+        mark = '*' if level == default_level else ' '
+        report.append(f"{level:>6}{mark} {stored:>12} {stored / max(plain, 1):>7.2f} {share:>11.0%} {enc:>8.1f} {dec:>8.1f}")
+    backend.MESSAGE_COMPRESS_LEVEL = default_level
+
+    codecs = [('identity', None, lambda b: b)]
+    codecs += [('gzip', level, lambda b, level=level: gzip.compress(b, level)) for level in (1, 6, 9)]
+    if brotli:
+        codecs += [('br', q, lambda b, q=q: brotli.compress(b, quality=q)) for q in (1, 5, 11)]
+    defaults = {('gzip', backend.RESPONSE_GZIP_LEVEL), ('br', backend.RESPONSE_BROTLI_QUALITY)}
+    report += ["", "In flight (one chat's JSON per response; * = default setting)",
+               f"{'encoding':>9} {'level':>6} {'sent':>12} {'ratio':>7} {'µs/resp':>9}"]
+    for name, level, compress in codecs:
+        sent, micros = in_flight(bodies, compress, args.repeat)
+        mark = '*' if (name, level) in defaults else ' '
+        report.append(f"{name:>9} {'-' if level is None else level:>5}{mark} {sent:>12} {sent / max(raw_body, 1):>7.2f} {micros:>9.1f}")
+    if not brotli:
+        report.append("(brotli not installed: br rows skipped)")
+
+    print("\n".join(report))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write("\n".join(report) + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+backend.py wired to the in-process fakes, for gunicorn workers started by
+load_test.py:
+
+    gunicorn -c gunicorn.conf.py benchmarks.fake_app:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker benchmarks.fake_app:asgi_app
+
+Each worker seeds its own fake database on import.
+"""
+import backend
+import asgi
+from benchmarks import fakes
+
+fakes.install(backend)
+# Pay the SDK imports the fakes still use up front, as a warmed-up worker would
+# (load_test.py turns WARM_START off since it would initialize the real Firebase app)
+backend.firestore.get()
+backend.api_exceptions.get()
+import google.cloud.firestore_v1  # noqa: E402,F401  (FieldFilter in the chat list)
+
+app = backend.app
+asgi_app = asgi.app
@@ -0,0 +1,450 @@
+"""
+In-process stand-ins for Firestore, Gemini and Firebase token verification,
+so backend.py can be load-tested without any Google services.
+
+Every fake models latency: Firestore RPCs sleep for a configurable time, and
+the Gemini fake streams chunks at a configurable size and rate. Settings come
+from BENCH_* environment variables (see FakeSettings) so gunicorn workers
+started by load_test.py pick them up.
+"""
+import os
+import copy
+import time
+import uuid
+import random
+import asyncio
+import datetime
+import threading
+from google.cloud.firestore_v1 import transforms
+
+
+class FakeSettings:
+    """Latency and size knobs, read from the environment."""
+
+    def __init__(self, env=os.environ):
+        self.firestore_latency_ms = float(env.get("BENCH_FIRESTORE_LATENCY_MS", 15))
+        self.firestore_jitter_ms = float(env.get("BENCH_FIRESTORE_JITTER_MS", 5))
+        self.verify_latency_ms = float(env.get("BENCH_VERIFY_LATENCY_MS", 3))
+        self.gemini_ttfb_ms = float(env.get("BENCH_GEMINI_TTFB_MS", 400))
+        self.gemini_chunk_interval_ms = float(env.get("BENCH_GEMINI_CHUNK_INTERVAL_MS", 40))
+        self.gemini_chunks = int(env.get("BENCH_GEMINI_CHUNKS", 30))
+        self.gemini_chunk_size = int(env.get("BENCH_GEMINI_CHUNK_SIZE", 120))
+        self.title_latency_ms = float(env.get("BENCH_TITLE_LATENCY_MS", 300))
+        self.seed_users = int(env.get("BENCH_SEED_USERS", 50))
+        self.seed_chats = int(env.get("BENCH_SEED_CHATS", 20))
+        self.seed_messages = int(env.get("BENCH_SEED_MESSAGES", 20))
+
+def _sleep_ms(ms):
+    if ms > 0:
+        time.sleep(ms / 1000.0)
+
+# --- FIRESTORE ---
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+def _apply_write(old, data, merge):
+    new = dict(old or {}) if merge else {}
+    for key, value in data.items():
+        if value is transforms.DELETE_FIELD:
+            new.pop(key, None)
+        elif value is transforms.SERVER_TIMESTAMP:
+            new[key] = datetime.datetime.now(datetime.timezone.utc)
+        elif isinstance(value, transforms.Increment):
+            new[key] = (new.get(key) or 0) + value.value
+        elif isinstance(value, transforms.ArrayUnion):
+            current = list(new.get(key) or [])
+            new[key] = current + [v for v in value.values if v not in current]
+        elif isinstance(value, transforms.ArrayRemove):
+            new[key] = [v for v in (new.get(key) or []) if v not in value.values]
+        else:
+            new[key] = copy.deepcopy(value)
+    return new
+
+class FakeFirestore:
+    """Dict-backed Firestore client; one RPC costs settings.firestore_latency_ms."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.docs = {}  # path tuple -> dict
+        self.update_times = {}  # path tuple -> datetime of the last write
+        self.lock = threading.RLock()
+        self.rpcs = 0
+
+    def rpc(self):
+        self.rpcs += 1
+        _sleep_ms(self.settings.firestore_latency_ms + random.uniform(0, self.settings.firestore_jitter_ms))
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def collection_group(self, name):
+        return FakeQuery(self, None, group=name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def write_option(self, **kwargs):
+        """Only last_update_time preconditions are modelled."""
+        return kwargs
+
+    def snapshot(self, ref):
+        with self.lock:
+            return FakeSnapshot(ref, copy.deepcopy(self.docs.get(ref.path)), self.update_times.get(ref.path))
+
+    def get_all(self, references, field_paths=None, **kwargs):
+        """Batched reads in one RPC; missing documents come back with exists False."""
+        self.rpc()
+        return [self.snapshot(ref) for ref in references]
+
+class FakeDocument:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path[-1]
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocument) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def parent(self):
+        return FakeCollection(self._client, self.path[:-1])
+
+    def collection(self, name):
+        return FakeCollection(self._client, self.path + (name,))
+
+    def get(self, *args, **kwargs):
+        self._client.rpc()
+        return self._client.snapshot(self)
+
+    def _set(self, data, merge=False):
+        with self._client.lock:
+            self._client.docs[self.path] = _apply_write(self._client.docs.get(self.path), data, merge)
+            # Strictly increasing, like Firestore's commit times
+            now = datetime.datetime.now(datetime.timezone.utc)
+            last = self._client.update_times.get(self.path)
+            self._client.update_times[self.path] = max(now, last + datetime.timedelta(microseconds=1)) if last else now
+
+    def _create(self, data):
+        from google.api_core.exceptions import AlreadyExists
+        with self._client.lock:
+            if self.path in self._client.docs:
+                raise AlreadyExists(f"Document already exists: {'/'.join(self.path)}")
+            self._set(data)
+
+    def _update(self, data, option=None):
+        from google.api_core.exceptions import NotFound, FailedPrecondition
+        with self._client.lock:
+            if self.path not in self._client.docs:
+                raise NotFound(f"No document to update: {'/'.join(self.path)}")
+            if option and option.get('last_update_time') != self._client.update_times.get(self.path):
+                raise FailedPrecondition(f"Document changed since it was read: {'/'.join(self.path)}")
+            self._set(data, merge=True)
+
+    def _delete(self):
+        with self._client.lock:
+            self._client.docs.pop(self.path, None)
+            self._client.update_times.pop(self.path, None)
+
+    def set(self, data, merge=False):
+        self._client.rpc()
+        self._set(data, merge)
+
+    def create(self, data):
+        self._client.rpc()
+        self._create(data)
+
+    def update(self, data, option=None, *args, **kwargs):
+        self._client.rpc()
+        self._update(data, option)
+
+    def delete(self, *args, **kwargs):
+        self._client.rpc()
+        self._delete()
+
+class FakeQuery:
+    def __init__(self, client, path, group=None):
+        self._client = client
+        self.path = path
+        self.group = group
+        self.orders = []
+        self.filters = []
+        self.projection = None
+        self.limit_count = None
+        self.cursor = None
+
+    def _copy(self, **changes):
+        query = copy.copy(self)
+        query.orders = list(self.orders)
+        query.filters = list(self.filters)
+        for key, value in changes.items():
+            setattr(query, key, value)
+        return query
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self.orders + [(field, str(direction).upper().endswith('DESCENDING'))])
+
+    def where(self, field=None, op=None, value=None, filter=None):
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self.filters + [(field, op, value)])
+
+    def select(self, fields):
+        return self._copy(projection=list(fields))
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def start_after(self, values):
+        return self._copy(cursor=values)
+
+    def _value(self, path, data, field):
+        if field == '__name__':
+            return path[-1]
+        return data.get(field)
+
+    def _matches(self, data):
+        for field, op, value in self.filters:
+            actual = data.get(field)
+            if op == '==' and actual != value:
+                return False
+            if op == '<' and not (actual is not None and actual < value):
+                return False
+            if op == '<=' and not (actual is not None and actual <= value):
+                return False
+            if op == '>' and not (actual is not None and actual > value):
+                return False
+            if op == '>=' and not (actual is not None and actual >= value):
+                return False
+            if op == 'in' and actual not in value:
+                return False
+        return True
+
+    def _rows(self):
+        with self._client.lock:
+            rows = []
+            for path, data in self._client.docs.items():
+                if self.group is not None:
+                    if len(path) < 2 or path[-2] != self.group:
+                        continue
+                elif len(path) != len(self.path) + 1 or path[:-1] != self.path:
+                    continue
+                if self._matches(data):
+                    rows.append((path, copy.deepcopy(data)))
+        # Firestore omits documents missing an ordered field
+        for field, _ in self.orders:
+            if field != '__name__':
+                rows = [row for row in rows if row[1].get(field) is not None]
+        for field, descending in reversed(self.orders):
+            rows.sort(key=lambda row: self._value(row[0], row[1], field), reverse=descending)
+        if not self.orders:
+            rows.sort(key=lambda row: row[0])
+        return rows
+
+    def _after_cursor(self, row):
+        if isinstance(self.cursor, FakeSnapshot):
+            values = [self._value(self.cursor.reference.path, self.cursor._data, f) for f, _ in self.orders]
+        else:
+            values = [self.cursor.get(f) for f, _ in self.orders[:len(self.cursor)]]
+        for (field, descending), value in zip(self.orders, values):
+            actual = self._value(row[0], row[1], field)
+            if actual == value:
+                continue
+            return actual < value if descending else actual > value
+        return False
+
+    def stream(self, *args, **kwargs):
+        self._client.rpc()
+        rows = self._rows()
+        if self.cursor is not None:
+            rows = [row for row in rows if self._after_cursor(row)]
+        if self.limit_count is not None:
+            rows = rows[:self.limit_count]
+        snapshots = []
+        for path, data in rows:
+            if self.projection is not None:
+                data = {k: v for k, v in data.items() if k in self.projection}
+            snapshots.append(FakeSnapshot(FakeDocument(self._client, path), data))
+        return iter(snapshots)
+
+    def get(self, *args, **kwargs):
+        return list(self.stream())
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    def document(self, doc_id=None):
+        return FakeDocument(self._client, self.path + (doc_id or uuid.uuid4().hex,))
+
+    def list_documents(self, *args, **kwargs):
+        self._client.rpc()
+        with self._client.lock:
+            return [FakeDocument(self._client, path) for path in self._client.docs
+                    if len(path) == len(self.path) + 1 and path[:-1] == self.path]
+
+class FakeBatch:
+    """Batched writes applied atomically in one RPC."""
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref, lambda: ref._set(data, merge)))
+
+    def create(self, ref, data):
+        self._writes.append((ref, lambda: ref._create(data)))
+
+    def update(self, ref, data, option=None, *args, **kwargs):
+        self._writes.append((ref, lambda: ref._update(data, option)))
+
+    def delete(self, ref, *args, **kwargs):
+        self._writes.append((ref, ref._delete))
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self, *args, **kwargs):
+        if len(self._writes) > 500:
+            raise ValueError("A batch can contain at most 500 writes")
+        self._client.rpc()
+        client = self._client
+        with client.lock:
+            # All or nothing: a failed precondition or create rolls back the writes before it
+            before = {ref.path: (client.docs.get(ref.path), client.update_times.get(ref.path)) for ref, _ in self._writes}
+            try:
+                for _, write in self._writes:
+                    write()
+            except Exception:
+                for path, (data, update_time) in before.items():
+                    for store, value in ((client.docs, data), (client.update_times, update_time)):
+                        if value is None:
+                            store.pop(path, None)
+                        else:
+                            store[path] = value
+                raise
+        self._writes = []
+
+def seed(client, settings):
+    """Creates bench-user-<n> profiles with chats and subcollection messages."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    answer = "Here is how you can do it:\n```c\nint main(void) {\n    return 0;\n}\n```\n" * 4
+    for u in range(settings.seed_users):
+        user_path = ('users', f"bench-user-{u}")
+        client.docs[user_path] = {"uid": user_path[1], "isGuest": False, "displayName": f"Bench {u}",
+                                  "theme": "dark", "createdAt": now}
+        for c in range(settings.seed_chats):
+            chat_path = user_path + ('chats', f"chat-{c}")
+            updated = now - datetime.timedelta(minutes=c)
+            client.docs[chat_path] = {"title": f"Benchmark chat {c}", "createdAt": updated, "updatedAt": updated,
+                                      "userId": user_path[1], "isGuest": False, "isPinned": c == 0,
+                                      "messageCount": settings.seed_messages, "lastMessageAt": updated}
+            for m in range(settings.seed_messages):
+                ts = updated - datetime.timedelta(seconds=settings.seed_messages - m)
+                msg_id = f"{int(ts.timestamp() * 1_000_000):016d}-{m % 2:04d}"
+                client.docs[chat_path + ('messages', msg_id)] = {
+                    "role": "user" if m % 2 == 0 else "model",
+                    "content": f"How do I fix bug {m} in my C program?" if m % 2 == 0 else answer,
+                    "timestamp": ts
+                }
+
+# --- GEMINI ---
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeAsyncStream:
+    def __init__(self, settings):
+        self.settings = settings
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        await asyncio.sleep(self.settings.gemini_ttfb_ms / 1000.0)
+        for i in range(self.settings.gemini_chunks):
+            if i:
+                await asyncio.sleep(self.settings.gemini_chunk_interval_ms / 1000.0)
+            yield FakeChunk(_chunk_text(self.settings, i))
+
+def _chunk_text(settings, index):
+    return (f"[{index}] " + "lorem ipsum code " * settings.gemini_chunk_size)[:settings.gemini_chunk_size]
+
+class FakeChatSession:
+    def __init__(self, settings, history):
+        self.settings = settings
+        self.history = history
+
+    def _stream(self):
+        _sleep_ms(self.settings.gemini_ttfb_ms)
+        for i in range(self.settings.gemini_chunks):
+            if i:
+                _sleep_ms(self.settings.gemini_chunk_interval_ms)
+            yield FakeChunk(_chunk_text(self.settings, i))
+
+    def send_message(self, content, stream=False, **kwargs):
+        if stream:
+            return self._stream()
+        return FakeChunk("".join(chunk.text for chunk in self._stream()))
+
+    async def send_message_async(self, content, stream=False, **kwargs):
+        if stream:
+            return FakeAsyncStream(self.settings)
+        await asyncio.sleep((self.settings.gemini_ttfb_ms + self.settings.gemini_chunk_interval_ms * self.settings.gemini_chunks) / 1000.0)
+        return FakeChunk(_chunk_text(self.settings, 0))
+
+class FakeGenerativeModel:
+    """Stands in for genai.GenerativeModel: chat streams and one-shot title/summary calls."""
+
+    def __init__(self, settings, model_name="models/fake-gemini"):
+        self.settings = settings
+        self.model_name = model_name
+
+    def start_chat(self, history=None, **kwargs):
+        return FakeChatSession(self.settings, history or [])
+
+    def generate_content(self, prompt, **kwargs):
+        _sleep_ms(self.settings.title_latency_ms)
+        return FakeChunk("Benchmark Chat Title")
+
+    async def generate_content_async(self, prompt, **kwargs):
+        await asyncio.sleep(self.settings.title_latency_ms / 1000.0)
+        return FakeChunk("Benchmark Chat Title")
+
+# --- AUTH ---
+def make_verify_id_token(settings):
+    """Accepts any token; 'guest-*' tokens are anonymous users, others registered."""
+    def verify_id_token(token, *args, **kwargs):
+        _sleep_ms(settings.verify_latency_ms)
+        provider = 'anonymous' if token.startswith('guest-') else 'password'
+        return {'uid': token, 'exp': time.time() + 3600, 'firebase': {'sign_in_provider': provider}}
+    return verify_id_token
+
+def install(backend, settings=None):
+    """Points an imported backend module at the fakes and seeds the fake database."""
+    settings = settings or FakeSettings()
+    client = FakeFirestore(settings)
+    seed(client, settings)
+    backend.db = client
+    backend.model = FakeGenerativeModel(settings)
+    backend.title_model = FakeGenerativeModel(settings)
+    # Set on the lazy auth proxy, so firebase_admin is never imported or initialized
+    backend.auth.verify_id_token = make_verify_id_token(settings)
+    return client
@@ -0,0 +1,278 @@
+"""
+Offline load test: boots backend.py under gunicorn with the in-process fakes
+(benchmarks/fakes.py) and drives a weighted mix of /api/chat, /api/chats,
+/api/profile and export requests (optionally chat search) at increasing
+concurrency.
+
+For every gunicorn configuration and concurrency level it reports requests,
+throughput, errors, and p50/p95/p99 latency per route mix entry; for chat
+streams it also reports time to first byte.
+
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --configs sync:2x2,sync:4x8,async:1 --concurrency 1,16,64 --duration 15
+    python -m benchmarks.load_test --firestore-ms 40 --gemini-ttfb-ms 800 --output bench_output.txt
+
+Configurations are 'sync:<workers>x<threads>' (backend:app on threaded
+workers) or 'async:<workers>' (asgi:app on uvicorn workers). Firestore and
+Gemini latencies are set with the flags below or BENCH_* environment
+variables (see fakes.FakeSettings).
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = "chat=4,list=3,profile=2,export=1"
+SEARCH_QUERIES = ["main", "loop", "return+int", "how+do"]  # for search=<weight> in --mix
+# Share of chat requests that start a new session instead of continuing one
+NEW_SESSION_RATE = 0.3
+# Admission control would turn most of the load into 429s; --with-limits keeps it on
+NO_LIMITS_ENV = {name: '0' for name in (
+    'RATE_LIMIT_REGISTERED_PER_MINUTE', 'RATE_LIMIT_REGISTERED_TIER_PER_MINUTE', 'STREAM_LIMIT_REGISTERED',
+    'RATE_LIMIT_GUEST_PER_MINUTE', 'RATE_LIMIT_GUEST_TIER_PER_MINUTE', 'STREAM_LIMIT_GUEST', 'ADMISSION_MAX_ACTIVE')}
+
+# --- HELPER: Server ---
+def parse_config(spec):
+    """'sync:2x4' -> ('sync', 2, 4); 'async:1' -> ('async', 1, None)."""
+    mode, _, size = spec.partition(':')
+    if mode == 'async':
+        return mode, int(size or 1), None
+    if mode == 'sync':
+        workers, _, threads = (size or '2x2').partition('x')
+        return mode, int(workers), int(threads or 1)
+    raise ValueError(f"Unknown configuration '{spec}' (expected sync:<workers>x<threads> or async:<workers>)")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class Server:
+    """A gunicorn process serving benchmarks.fake_app with one configuration."""
+
+    def __init__(self, spec, env):
+        self.spec = spec
+        self.mode, self.workers, self.threads = parse_config(spec)
+        self.port = free_port()
+        self.env = dict(os.environ, **env)
+        self.log = tempfile.NamedTemporaryFile(prefix="ada-bench-", suffix=".log", delete=False)
+        self.proc = None
+
+    def command(self):
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+               '-b', f'127.0.0.1:{self.port}', '-w', str(self.workers), '--log-level', 'warning']
+        if self.mode == 'async':
+            return cmd + ['-k', 'uvicorn.workers.UvicornWorker', 'benchmarks.fake_app:asgi_app']
+        return cmd + ['--threads', str(self.threads), 'benchmarks.fake_app:app']
+
+    def start(self, timeout=60):
+        self.env['SERVER_MODE'] = self.mode
+        self.env['WARM_START'] = 'false'  # the fakes stand in for the real clients
+        self.env['SWEEP_INTERVAL'] = '0'
+        self.proc = subprocess.Popen(self.command(), cwd=REPO_ROOT, env=self.env,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                status, _, _ = request('127.0.0.1', self.port, 'GET', '/health')
+                if status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"gunicorn ({self.spec}) did not become healthy; see {self.log.name}")
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+# --- HELPER: Client ---
+def request(host, port, method, path, body=None, token=None, timeout=120):
+    """Sends one request; returns (status, ttfb, total) in seconds, timed from connect."""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        headers = {}
+        payload = None
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        ttfb = None
+        while True:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+        total = time.perf_counter() - started
+        return response.status, ttfb if ttfb is not None else total, total
+    finally:
+        conn.close()
+
+class Client:
+    """One simulated user: a registered bench-user-<n> with its own chat sessions."""
+
+    def __init__(self, index, seed_users, seed_chats):
+        self.token = f"bench-user-{index % seed_users}"
+        self.seed_chats = seed_chats
+        self.session_id = None
+
+    def next_request(self, scenario):
+        if scenario == 'chat':
+            if self.session_id is None or random.random() < NEW_SESSION_RATE:
+                self.session_id = f"bench-{uuid.uuid4().hex[:12]}"
+            # No 'history': the server rebuilds it from the stored session
+            return 'POST', '/api/chat', {"message": "Why does my loop never end?", "sessionId": self.session_id}
+        if scenario == 'list':
+            return 'GET', '/api/chats?limit=30', None
+        if scenario == 'profile':
+            return 'GET', '/api/profile', None
+        if scenario == 'export':
+            return 'GET', f'/api/chats/chat-{random.randrange(self.seed_chats)}/export', None
+        if scenario == 'search':
+            return 'GET', f'/api/chats/search?q={random.choice(SEARCH_QUERIES)}', None
+        raise ValueError(f"Unknown scenario '{scenario}'")
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def run_level(port, concurrency, duration, warmup, mix, seed_users, seed_chats):
+    """Runs `concurrency` looping clients for warmup + duration seconds; returns samples after warmup."""
+    names, weights = list(mix), list(mix.values())
+    samples = []  # (scenario, status, ttfb, total)
+    lock = threading.Lock()
+    started = time.perf_counter()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    def worker(index):
+        client = Client(index, seed_users, seed_chats)
+        while time.perf_counter() < stop_at:
+            scenario = random.choices(names, weights)[0]
+            method, path, body = client.next_request(scenario)
+            sent_at = time.perf_counter()
+            try:
+                status, ttfb, total = request('127.0.0.1', port, method, path, body, client.token)
+            except OSError:
+                status, ttfb, total = 0, None, time.perf_counter() - sent_at
+            if sent_at >= measure_from:
+                with lock:
+                    samples.append((scenario, status, ttfb, total))
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+# --- HELPER: Report ---
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list; None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))]
+
+def ms(value):
+    return f"{value * 1000:8.1f}" if value is not None else f"{'-':>8}"
+
+HEADER = (f"{'conc':>5} {'route':<8} {'reqs':>6} {'rps':>8} {'err':>5} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttfb50':>8} {'ttfb95':>8} {'ttfb99':>8}")
+
+def summarize(concurrency, samples, duration, mix):
+    lines = []
+    for name in list(mix) + ['all']:
+        rows = [s for s in samples if name == 'all' or s[0] == name]
+        if not rows:
+            continue
+        ok = [s for s in rows if 200 <= s[1] < 400]
+        totals = [s[3] for s in ok]
+        # Time to first byte only means something for streamed answers
+        ttfbs = [s[2] for s in ok if s[0] == 'chat' and s[2] is not None]
+        lines.append(f"{concurrency:>5} {name:<8} {len(rows):>6} {len(rows) / duration:>8.1f} {len(rows) - len(ok):>5} "
+                     f"{ms(percentile(totals, 50))} {ms(percentile(totals, 95))} {ms(percentile(totals, 99))} "
+                     f"{ms(percentile(ttfbs, 50))} {ms(percentile(ttfbs, 95))} {ms(percentile(ttfbs, 99))}")
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for backend.py against fake Firestore and Gemini.")
+    parser.add_argument('--configs', default='sync:2x2,sync:4x8,async:1',
+                        help="comma-separated gunicorn configurations: sync:<workers>x<threads> or async:<workers>")
+    parser.add_argument('--concurrency', default='1,8,32', help="comma-separated concurrent client counts")
+    parser.add_argument('--duration', type=float, default=10, help="measured seconds per concurrency level")
+    parser.add_argument('--warmup', type=float, default=2, help="unmeasured seconds before each level")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="scenario weights, e.g. chat=4,list=3,profile=2,export=1")
+    parser.add_argument('--firestore-ms', type=float, help="latency per Firestore RPC (BENCH_FIRESTORE_LATENCY_MS)")
+    parser.add_argument('--gemini-ttfb-ms', type=float, help="Gemini time to first chunk (BENCH_GEMINI_TTFB_MS)")
+    parser.add_argument('--chunk-interval-ms', type=float, help="time between streamed chunks (BENCH_GEMINI_CHUNK_INTERVAL_MS)")
+    parser.add_argument('--chunks', type=int, help="chunks per answer (BENCH_GEMINI_CHUNKS)")
+    parser.add_argument('--chunk-size', type=int, help="characters per chunk (BENCH_GEMINI_CHUNK_SIZE)")
+    parser.add_argument('--with-limits', action='store_true', help="keep the backend's rate limits and stream caps")
+    parser.add_argument('--output', help="also append the report to this file")
+    args = parser.parse_args(argv)
+
+    env = {} if args.with_limits else dict(NO_LIMITS_ENV)
+    for flag, var in (('firestore_ms', 'BENCH_FIRESTORE_LATENCY_MS'), ('gemini_ttfb_ms', 'BENCH_GEMINI_TTFB_MS'),
+                      ('chunk_interval_ms', 'BENCH_GEMINI_CHUNK_INTERVAL_MS'), ('chunks', 'BENCH_GEMINI_CHUNKS'),
+                      ('chunk_size', 'BENCH_GEMINI_CHUNK_SIZE')):
+        if getattr(args, flag) is not None:
+            env[var] = str(getattr(args, flag))
+
+    sys.path.insert(0, REPO_ROOT)
+    from benchmarks.fakes import FakeSettings
+    settings = FakeSettings(dict(os.environ, **env))
+    mix = parse_mix(args.mix)
+    levels = [int(c) for c in args.concurrency.split(',')]
+
+    report = [f"Fakes: firestore {settings.firestore_latency_ms:g}ms/rpc, gemini ttfb {settings.gemini_ttfb_ms:g}ms, "
+              f"{settings.gemini_chunks} chunks x {settings.gemini_chunk_size} chars every {settings.gemini_chunk_interval_ms:g}ms; "
+              f"mix {args.mix}"]
+    print(report[0])
+    for spec in args.configs.split(','):
+        server = Server(spec.strip(), env)
+        print(f"\n== {server.spec} ==  (starting gunicorn on port {server.port}, log {server.log.name})")
+        server.start()
+        report += ["", f"== {server.spec} ==", HEADER]
+        print(HEADER)
+        try:
+            for concurrency in levels:
+                samples = run_level(server.port, concurrency, args.duration, args.warmup, mix,
+                                    settings.seed_users, settings.seed_chats)
+                lines = summarize(concurrency, samples, args.duration, mix)
+                report += lines
+                print("\n".join(lines))
+        finally:
+            server.stop()
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write("\n".join(report) + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Gunicorn settings: gunicorn -c gunicorn.conf.py
+# SERVER_MODE picks how the app is served:
+#   sync  (default) - backend:app on threaded workers, one thread per open stream
+#   async           - asgi:app on uvicorn workers, streams run on the event loop
+import os
+import tempfile
+
+SERVER_MODE = os.environ.get("SERVER_MODE", "sync").lower()
+
+# Workers write their metrics here so /metrics can aggregate them (prometheus_client multiprocess mode).
+# Must be set before the app (and prometheus_client) is imported in the workers.
+if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="ada-metrics-")
+
+# Rate-limit buckets and per-user stream counts shared by all workers (see backend.py, Admission Control)
+if not os.environ.get("ADMISSION_DB_PATH"):
+    os.environ["ADMISSION_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="ada-admission-"), "admission.sqlite")
+
+# Only the worker holding this lock runs the temp-users sweeper (see backend.py, Temp-User Sweeper)
+if not os.environ.get("SWEEP_LOCK_PATH"):
+    os.environ["SWEEP_LOCK_PATH"] = os.path.join(os.path.dirname(os.environ["ADMISSION_DB_PATH"]), "sweeper.lock")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+timeout = 120
+
+# GUNICORN_PRELOAD=true imports the app once in the master and forks workers from it.
+# Safe because Firebase/Firestore/Gemini clients are built lazily, after the fork.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+# Build those clients in the background as soon as a worker boots (see backend.py, Lazy Clients)
+WARM_START = os.environ.get("WARM_START", "true").lower() == "true"
+
+if SERVER_MODE == "async":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+else:
+    wsgi_app = "backend:app"
+    workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+    threads = 2
+
+
+def post_worker_init(worker):
+    import backend
+    if WARM_START:
+        backend.warm_up()
+    backend.temp_user_sweeper.start()
+
+
+def worker_exit(server, worker):
+    # Flush chat turns still waiting in the write-behind queue
+    import backend
+    backend.temp_user_sweeper.stop()
+    backend.chat_write_queue.stop()
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges from the aggregate
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)